@@ -0,0 +1,134 @@
+#!/usr/bin/env python
+
+# Copyright 2018 Paul Archer
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Microbenchmark of the register block decode cost
+
+Compares the original per-register dict lookup decoder against the compiled
+struct decoder (and the NumPy decoder when installed) on the SG-KTL register
+map. Run:
+    python benchmarks/bench_decode.py
+"""
+
+import argparse
+import random
+import struct
+import timeit
+
+from pvstats.pvinverter.sungrow_sg_ktl import _register_map
+from pvstats.pvinverter.planner import plan_reads
+from pvstats.pvinverter.decoder import compile_decoders, numpy
+
+
+def _2x_16_to_32(int16_1, int16_2):
+    """The original 32 bit join, kept here as the baseline"""
+    if int16_1 < 0 and int16_2 < 0:
+        tag = 3
+        sign = -1
+    elif int16_1 >= 0 and int16_2 >= 0:
+        tag = 2
+        sign = 1
+    else:
+        raise ArithmeticError("Signs don't match for ints")
+    hx32 = str(hex(abs(int(int16_1))))[tag:] + str(hex(abs(int(int16_2))))[tag:]
+    return int(hx32, 16) * sign
+
+
+def legacy_map(register_map):
+    """Rebuilds the original map, 32 bit values split into 'name' and 'name_2' entries"""
+    legacy = {}
+    for func, registers in register_map.items():
+        legacy[func] = {}
+        for k, reg in registers.items():
+            legacy[func][k] = reg
+            if reg['type'] in ('uint32', 'int32'):
+                legacy[func][str(int(k) + 1)] = dict(reg, name=reg['name'] + '_2')
+    return legacy
+
+
+def legacy_decode(register_map, func, start, registers, out):
+    """The original per-register decode loop, kept here as the baseline"""
+    for x, val in enumerate(registers):
+        key = str(start + x + 1)
+        if key in register_map[func]:
+            reg = register_map[func][key]
+            reg_name = reg.get('name')
+            reg_scale = reg.get('scale')
+            reg_type = reg.get('type')
+            if reg_type == 'int16' and val >= 2**15:
+                out[reg_name] = (val - 2**16) * reg_scale
+            elif reg_type == 'int32' and val >= 2**15:
+                out[reg_name] = (val - 2**16) * reg_scale
+            else:
+                out[reg_name] = val * reg_scale
+            if reg_name.endswith('_2'):
+                reg_2 = out[reg_name] / reg_scale
+                reg_1 = out[reg_name[0:-2]] / reg_scale
+                out[reg_name[0:-2]] = _2x_16_to_32(reg_2, reg_1) * reg_scale
+                out.pop(reg_name)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Register block decode microbenchmark")
+    parser.add_argument("--number", type=int, default=2000, help="Decodes per measurement")
+    parser.add_argument("--repeat", type=int, default=5, help="Measurements, the best is reported")
+    args = parser.parse_args()
+
+    plan = plan_reads(_register_map)
+    original_map = legacy_map(_register_map)
+    decoders = compile_decoders(_register_map, plan, word_order='little')
+    blocks = []
+    for func, address, count in plan:
+        words = [random.randint(0, 5000) for _ in range(count)]
+        blocks.append((func, address, words, struct.pack('>{}H'.format(count), *words)))
+
+    def legacy():
+        out = {}
+        for func, address, words, _ in blocks:
+            legacy_decode(original_map, func, address, words, out)
+
+    def compiled_words():
+        out = {}
+        for func, address, words, _ in blocks:
+            decoders[(func, address)].decode(words, out)
+
+    def compiled_bytes():
+        out = {}
+        for func, address, _, data in blocks:
+            decoders[(func, address)].decode(data, out)
+
+    def vectorized():
+        out = {}
+        for func, address, _, data in blocks:
+            dec = decoders[(func, address)]
+            out.update(zip(dec.names, dec.decode_numpy(data).tolist()))
+
+    cases = [("legacy dict lookups", legacy),
+             ("compiled struct (words)", compiled_words),
+             ("compiled struct (bytes)", compiled_bytes)]
+    if numpy is not None:
+        cases.append(("numpy vectorized (bytes)", vectorized))
+
+    print("{} blocks, {} registers per cycle".format(len(blocks), sum(len(b[2]) for b in blocks)))
+    baseline = None
+    for name, fn in cases:
+        best = min(timeit.repeat(fn, number=args.number, repeat=args.repeat)) / args.number
+        baseline = baseline or best
+        print("{:28s} {:8.1f} us/cycle {:8.1f} us/block {:6.1f}x".format(
+            name, best * 1e6, best * 1e6 / len(blocks), baseline / best))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,228 @@
+#!/usr/bin/env python
+
+# Copyright 2018 Paul Archer
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Benchmark suite of the inverter read path against simulated inverters
+
+For each Sungrow model it starts a simulator and measures the full read()
+cycle latency over Modbus TCP, pipelined async Modbus TCP and (SG-KTL)
+Modbus RTU, the decode time of each planned register block and the memory
+a decoded sample takes in each numeric mode. Every figure is lower is
+better; the results are written as JSON and can be checked against an
+earlier run. Run:
+    python benchmarks/bench_read.py --output bench-read.json
+    python benchmarks/bench_read.py --baseline bench-read.json --tolerance 0.25
+"""
+
+import argparse
+import asyncio
+import json
+import platform
+import sys
+import time
+import timeit
+import tracemalloc
+from datetime import datetime
+
+from pvstats.pvinverter.factory import PVInverterFactory
+from pvstats.pvinverter.planner import plan_reads
+from pvstats.pvinverter.decoder import compile_decoders
+from pvstats.pvinverter.simulator import simulator
+
+MODELS = ('sungrow-sg-ktl', 'sungrow-sh5k-20')
+NUMERIC = ('decimal', 'float', 'scaled-int')
+
+
+def _percentiles(samples):
+    samples = sorted(samples)
+
+    def at(p):
+        return samples[min(len(samples) - 1, int(p * len(samples)))]
+    return {'p50_ms': at(0.5) * 1000, 'p95_ms': at(0.95) * 1000, 'max_ms': samples[-1] * 1000}
+
+
+def read_cycles(model, cfg, cycles):
+    """Latencies of full synchronous read() cycles"""
+    inverter = PVInverterFactory(model, cfg)
+    inverter.connect()
+    try:
+        inverter.read()
+        times = []
+        for _ in range(cycles):
+            start = time.perf_counter()
+            inverter.read()
+            times.append(time.perf_counter() - start)
+    finally:
+        inverter.close()
+    return _percentiles(times)
+
+
+def read_cycles_async(model, cfg, cycles):
+    """Latencies of full read_async() cycles, the blocks pipelined"""
+    inverter = PVInverterFactory(model, dict(cfg, **{'async': True}))
+
+    async def run():
+        await inverter.connect_async()
+        try:
+            await inverter.read_async()
+            times = []
+            for _ in range(cycles):
+                start = time.perf_counter()
+                await inverter.read_async()
+                times.append(time.perf_counter() - start)
+        finally:
+            await inverter.close_async()
+        return times
+    return _percentiles(asyncio.run(run()))
+
+
+def decode_blocks(sim, number):
+    """Microseconds per decode of each planned block, in words and per register"""
+    model = sim.model
+    plan = plan_reads(model.register_map)
+    decoders = compile_decoders(model.register_map, plan, word_order=model.word_order,
+                                byte_order=model.byte_order)
+    out = {}
+    for func, address, count in plan:
+        decoder = decoders[(func, address)]
+        words = model.words(func, address, count)
+        registers = {}
+        best = min(timeit.repeat(lambda: decoder.decode(words, registers), number=number, repeat=3)) / number
+        out['{}/{}+{}'.format(func, address, count)] = {'us': best * 1e6, 'us_per_register': best * 1e6 / count}
+    return out
+
+
+def sample_memory(sim, numeric, samples):
+    """Bytes of a decoded sample dict, averaged over many retained samples"""
+    model = sim.model
+    plan = plan_reads(model.register_map)
+    decoders = compile_decoders(model.register_map, plan, word_order=model.word_order,
+                                byte_order=model.byte_order, numeric=numeric)
+    blocks = [(decoders[(func, address)], model.words(func, address, count)) for func, address, count in plan]
+    tracemalloc.start()
+    try:
+        before = tracemalloc.get_traced_memory()[0]
+        kept = []
+        for _ in range(samples):
+            registers = {}
+            for decoder, words in blocks:
+                decoder.decode(words, registers)
+            registers['timestamp'] = datetime.now()
+            kept.append(registers)
+        used = tracemalloc.get_traced_memory()[0] - before
+    finally:
+        tracemalloc.stop()
+    return {'bytes_per_sample': used / samples, 'fields': len(kept[0])}
+
+
+def _flatten(results, prefix=''):
+    out = {}
+    for k, v in results.items():
+        if isinstance(v, dict):
+            out.update(_flatten(v, prefix + k + '/'))
+        else:
+            out[prefix + k] = v
+    return out
+
+
+def compare(results, baseline, tolerance):
+    """The metrics more than tolerance worse than in the baseline"""
+    current = _flatten(results)
+    previous = _flatten(baseline)
+    regressions = []
+    for name, value in sorted(current.items()):
+        old = previous.get(name)
+        if name.endswith('/fields') or not old:
+            continue
+        if value > old * (1 + tolerance):
+            regressions.append((name, old, value))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--cycles", type=int, default=50, help="Read cycles per measurement")
+    parser.add_argument("--number", type=int, default=2000, help="Decodes per block measurement")
+    parser.add_argument("--samples", type=int, default=1000, help="Samples kept for the memory measurement")
+    parser.add_argument("--latency", type=float, default=0.002, help="Simulated response latency in seconds")
+    parser.add_argument("--jitter", type=float, default=0.001, help="Simulated latency variation in seconds")
+    parser.add_argument("--request-interval", type=float, default=0.0,
+                        help="Seconds between requests, overriding the model's pacing (SH5K-20: 0.5)")
+    parser.add_argument("--output", default="bench-read.json", help="JSON file the results are written to")
+    parser.add_argument("--baseline", help="JSON results of an earlier run to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.25,
+                        help="Fraction a metric may worsen by before it counts as a regression")
+    args = parser.parse_args()
+
+    results = {}
+    for model in MODELS:
+        sim = simulator(model, latency=args.latency, jitter=args.jitter, seed=1).start_thread()
+        try:
+            cfg = {'mode': 'tcp', 'host': sim.host, 'port': sim.port, 'request_interval': args.request_interval}
+            read = {'tcp': read_cycles(model, cfg, args.cycles),
+                    'tcp_async': read_cycles_async(model, cfg, args.cycles)}
+            blocks = decode_blocks(sim, args.number)
+            memory = {numeric: sample_memory(sim, numeric, args.samples) for numeric in NUMERIC}
+        finally:
+            sim.stop()
+        if model == 'sungrow-sg-ktl':
+            rtu = simulator(model, framer='rtu', latency=args.latency, jitter=args.jitter, seed=1).start_thread()
+            try:
+                cfg = {'mode': 'rtu', 'dev': 'socket://{}:{}'.format(rtu.host, rtu.port),
+                       'request_interval': args.request_interval}
+                read['rtu'] = read_cycles(model, cfg, args.cycles)
+            finally:
+                rtu.stop()
+        results[model] = {'read': read, 'decode': blocks, 'memory': memory}
+
+        print(model)
+        for name, figures in read.items():
+            print("  read {:10s} p50 {:7.2f} ms  p95 {:7.2f} ms  max {:7.2f} ms".format(
+                name, figures['p50_ms'], figures['p95_ms'], figures['max_ms']))
+        for name, figures in blocks.items():
+            print("  decode {:18s} {:7.2f} us  {:6.3f} us/register".format(
+                name, figures['us'], figures['us_per_register']))
+        for name, figures in memory.items():
+            print("  memory {:10s} {:8.0f} bytes/sample ({} fields)".format(
+                name, figures['bytes_per_sample'], figures['fields']))
+
+    report = {
+        'meta': {
+            'time': datetime.now().isoformat(timespec='seconds'),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'latency': args.latency,
+            'jitter': args.jitter,
+            'cycles': args.cycles,
+            'request_interval': args.request_interval,
+        },
+        'results': results,
+    }
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2, sort_keys=True)
+    print("Results written to {}".format(args.output))
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)['results']
+        regressions = compare(results, baseline, args.tolerance)
+        for name, old, new in regressions:
+            print("REGRESSION {}: {:.3f} -> {:.3f}".format(name, old, new))
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,69 @@
+#!/usr/bin/env python
+
+# Copyright 2018 Paul Archer
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Microbenchmark of the sample encoders
+
+Encodes a full SG-KTL sample, in each numeric mode, with the original
+pretty printed json.dumps() and each serialize Encoder format available.
+Run:
+    python benchmarks/bench_serialize.py
+"""
+
+import argparse
+import json
+import random
+import timeit
+from datetime import datetime
+
+from pvstats.pvinverter.sungrow_sg_ktl import _register_map
+from pvstats.pvinverter.planner import plan_reads
+from pvstats.pvinverter.decoder import compile_decoders
+from pvstats.serialize import Encoder, FORMATS, msgpack, orjson
+
+
+def sample(numeric):
+    """A decoded SG-KTL sample from random register words"""
+    plan = plan_reads(_register_map, 125, 20)
+    decoders = compile_decoders(_register_map, plan, word_order='little', numeric=numeric)
+    registers = {}
+    for (func, address), decoder in decoders.items():
+        decoder.decode([random.randrange(0, 2**16) for _ in range(decoder.count)], registers)
+    registers['timestamp'] = datetime.now()
+    registers['tag_inverter'] = 'north'
+    return registers
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('-n', '--number', type=int, default=2000)
+    args = parser.parse_args()
+
+    for numeric in ('decimal', 'float', 'scaled-int'):
+        data = sample(numeric)
+        print("{} ({} fields)".format(numeric, len(data)))
+        legacy = lambda data: json.dumps(data, sort_keys=True, indent=2, separators=(',', ': '), default=str)
+        cases = [('legacy json', legacy)]
+        for format in FORMATS:
+            if (format == 'msgpack' and msgpack is None) or (format == 'orjson' and orjson is None):
+                continue
+            cases.append((format, Encoder(format).encode))
+        for name, encode in cases:
+            seconds = timeit.timeit(lambda: encode(data), number=args.number) / args.number
+            print("  {:12} {:8.1f} us {:6d} bytes".format(name, seconds * 1e6, len(encode(data))))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,305 @@
+#!/usr/bin/env python
+
+# Copyright 2018 Paul Archer
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Soak and load harness of the whole polling pipeline
+
+Starts N simulated inverters and local stand-ins for PVOutput, MQTT and
+InfluxDB, then runs the poll engine pvstats builds from its configuration
+against them for a while. It reports the sustained samples/s against the
+configured cadence, percentiles of the inverter read, hand over to the
+reports, sample interval slip and report queue latency, the report queue
+depths and the process RSS over time. Given several inverter counts it runs
+each in turn, to find where the cadence slips. Run:
+    python benchmarks/soak.py --inverters 10 50 100 --duration 120 --output soak.json
+    python benchmarks/soak.py --inverters 20 --influxdb-latency 0.5 --influxdb-failures 0.1
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import platform
+import threading
+import time
+from datetime import datetime
+
+from pvstats.poller import build_engine
+from pvstats.pvinverter.simulator import simulator
+
+from standins import FakePVOutput, FakeInfluxDB, FakeMQTTBroker
+
+SERVICES = {'pvoutput': FakePVOutput, 'mqtt': FakeMQTTBroker, 'influxdb': FakeInfluxDB}
+
+_log = logging.getLogger('soak')
+
+
+def _percentiles(values):
+    if not values:
+        return {'p50': None, 'p95': None, 'p99': None, 'max': None}
+    values = sorted(values)
+
+    def at(p):
+        return values[min(len(values) - 1, int(p * len(values)))]
+    return {'p50': at(0.5), 'p95': at(0.95), 'p99': at(0.99), 'max': values[-1]}
+
+
+def rss_mb():
+    """Resident set size of the process in MiB"""
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    import resource
+    # Peak rather than current where /proc is missing, in KiB on Linux and bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 2**20 if platform.system() == 'Darwin' else peak / 1024
+
+
+class SimulatorFleet():
+    """Simulated inverters all served from one event loop thread"""
+
+    def __init__(self, count, model, latency=0.0, jitter=0.0):
+        self.simulators = [simulator(model, latency=latency, jitter=jitter, seed=i) for i in range(count)]
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._loop.run_forever, name='soak-simulators', daemon=True)
+
+    def start(self):
+        self._thread.start()
+        for sim in self.simulators:
+            asyncio.run_coroutine_threadsafe(sim.start(), self._loop).result()
+        return self
+
+    def stop(self):
+        for sim in self.simulators:
+            asyncio.run_coroutine_threadsafe(sim.close(), self._loop).result()
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+        self._loop.close()
+
+
+def configuration(args, fleet, services):
+    """The pvstats configuration of the simulated fleet and stand-ins"""
+    inverters = []
+    for i, sim in enumerate(fleet.simulators):
+        inverters.append({'name': 'inv{:04d}'.format(i), 'model': args.model, 'mode': 'tcp',
+                          'host': sim.host, 'port': sim.port, 'async': args.use_async})
+    channel = {'queue_size': args.queue_size, 'overflow': args.overflow}
+    reports = []
+    if 'pvoutput' in services:
+        s = services['pvoutput']
+        reports.append(dict(channel, type='pvoutput', host='{}:{}'.format(s.host, s.port), tls=False,
+                            key='soak', system_id='1', rate_limit=args.status_window,
+                            requests_per_hour=10**6,
+                            systems={inv['name']: str(i + 1) for i, inv in enumerate(inverters)}))
+    if 'mqtt' in services:
+        s = services['mqtt']
+        reports.append(dict(channel, type='mqtt', host=s.host, port=s.port, user=None, password=None,
+                            tls=False, topic='pvstats/soak', qos=1, fields=args.mqtt_fields))
+    if 'influxdb' in services:
+        s = services['influxdb']
+        reports.append(dict(channel, type='influxdb', host=s.host, port=s.port, user='soak', password='soak',
+                            db='pvstats', ssl=False, verify_ssl=False, measurement='pvstats', tags={},
+                            batch_size=100, flush_interval=5))
+    return {'sample_period': args.sample_period, 'numeric': args.numeric,
+            'inverters': inverters, 'reports': reports}
+
+
+class Probe():
+    """Times the stages of the engine's pollers and its publishing"""
+
+    def __init__(self, engine, sample_period):
+        self.sample_period = sample_period
+        self.reads = []
+        self.handovers = []
+        self.slips = []
+        self.samples = 0
+        self._last = {}
+        for poller in engine.pollers:
+            inverter = poller.inverter
+            if inverter.is_async:
+                inverter.read_async = self._timed_async(inverter.read_async)
+            else:
+                inverter.read = self._timed(inverter.read)
+        publish = engine.publish
+
+        def timed_publish(registers):
+            now = time.monotonic()
+            name = registers.get('tag_inverter')
+            if name in self._last:
+                self.slips.append(now - self._last[name] - self.sample_period)
+            self._last[name] = now
+            publish(registers)
+            self.handovers.append(time.monotonic() - now)
+            self.samples += 1
+        engine.publish = timed_publish
+
+    def _timed(self, read):
+        def timed():
+            start = time.perf_counter()
+            try:
+                return read()
+            finally:
+                self.reads.append(time.perf_counter() - start)
+        return timed
+
+    def _timed_async(self, read):
+        async def timed():
+            start = time.perf_counter()
+            try:
+                return await read()
+            finally:
+                self.reads.append(time.perf_counter() - start)
+        return timed
+
+
+async def _drive(engine, probe, services, args):
+    """Runs the engine for the duration, sampling the timeline every interval"""
+    task = asyncio.ensure_future(engine.run())
+    timeline = []
+    start = time.monotonic()
+    samples = 0
+    while time.monotonic() - start < args.duration:
+        await asyncio.sleep(args.interval)
+        elapsed = time.monotonic() - start
+        count = probe.samples
+        point = {'t': round(elapsed, 1), 'samples': count,
+                 'samples_per_s': (count - samples) / args.interval, 'rss_mb': rss_mb(),
+                 'reports': engine.metrics(),
+                 'services': {name: s.stats() for name, s in services.items()}}
+        samples = count
+        timeline.append(point)
+        _log.info("{t:7.1f}s {samples_per_s:8.1f} samples/s, {rss_mb:6.1f} MiB, depths {depths}".format(
+            depths={k: m['depth'] for k, m in point['reports'].items()}, **point))
+        if task.done():
+            break
+    task.cancel()
+    try:
+        await task
+    except asyncio.CancelledError:
+        pass
+    return timeline
+
+
+def run(args, count, services):
+    """Soaks a fleet of count inverters, returns the results"""
+    fleet = SimulatorFleet(count, args.model, args.modbus_latency, args.modbus_jitter).start()
+    try:
+        engine = build_engine(configuration(args, fleet, services))
+        engine.metrics_period = 0
+        probe = Probe(engine, args.sample_period)
+        before = {name: s.stats() for name, s in services.items()}
+        rss_start = rss_mb()
+        timeline = asyncio.run(_drive(engine, probe, services, args))
+        engine.read_executor.shutdown(wait=False)
+        engine.publish_executor.shutdown(wait=False)
+    finally:
+        fleet.stop()
+
+    # The first interval includes connecting, leave it out of the rate
+    steady = timeline[1:] or timeline
+    expected = count / args.sample_period
+    sustained = sum(p['samples_per_s'] for p in steady) / len(steady) if steady else 0.0
+    slips = _percentiles(probe.slips)
+    reports = {}
+    for name, metrics in (timeline[-1]['reports'] if timeline else {}).items():
+        reports[name] = {
+            'max_depth': max(p['reports'][name]['max_depth'] for p in timeline),
+            'final_depth': metrics['depth'],
+            'published': metrics['published'],
+            'dropped': metrics['dropped'],
+            'failed': metrics['failed'],
+            'latency_p50': metrics['latency_p50'],
+            'latency_p95': metrics['latency_p95'],
+        }
+    return {
+        'inverters': count,
+        'expected_samples_per_s': expected,
+        'sustained_samples_per_s': sustained,
+        'keeping_up': sustained >= 0.95 * expected and (slips['p95'] or 0) < args.sample_period,
+        'latency_s': {'read': _percentiles(probe.reads), 'handover': _percentiles(probe.handovers),
+                      'interval_slip': slips},
+        'reports': reports,
+        'services': {name: {k: v - before[name][k] for k, v in s.stats().items()}
+                     for name, s in services.items()},
+        'rss_mb': {'start': rss_start, 'end': timeline[-1]['rss_mb'] if timeline else rss_start,
+                   'max': max([p['rss_mb'] for p in timeline] + [rss_start])},
+        'timeline': timeline,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--inverters", type=int, nargs='+', default=[10], help="Fleet sizes to soak in turn")
+    parser.add_argument("--duration", type=float, default=60, help="Seconds to run each fleet size for")
+    parser.add_argument("--interval", type=float, default=5, help="Seconds between timeline points")
+    parser.add_argument("--sample-period", type=float, default=1, help="Seconds between reads of an inverter")
+    parser.add_argument("--model", default="sungrow-sg-ktl", choices=("sungrow-sg-ktl", "sungrow-sh5k-20"))
+    parser.add_argument("--async", dest="use_async", action="store_true", help="Read with the async client")
+    parser.add_argument("--numeric", default="decimal", choices=("decimal", "float", "scaled-int"))
+    parser.add_argument("--modbus-latency", type=float, default=0.002, help="Simulated inverter latency")
+    parser.add_argument("--modbus-jitter", type=float, default=0.001, help="Simulated inverter jitter")
+    parser.add_argument("--reports", nargs='*', default=sorted(SERVICES), choices=sorted(SERVICES))
+    parser.add_argument("--queue-size", type=int, default=100, help="Report channel queue size")
+    parser.add_argument("--overflow", default="drop-oldest", help="Report channel overflow policy")
+    parser.add_argument("--status-window", type=int, default=10, help="PVOutput rate_limit window in seconds")
+    parser.add_argument("--mqtt-fields", action="store_true", help="Also publish MQTT per field topics")
+    for name in sorted(SERVICES):
+        parser.add_argument("--{}-latency".format(name), type=float, default=0.0,
+                            help="Seconds the {} stand-in takes to answer".format(name))
+        parser.add_argument("--{}-failures".format(name), type=float, default=0.0,
+                            help="Fraction of {} requests that fail".format(name))
+    parser.add_argument("--output", default="soak.json", help="JSON file the results are written to")
+    parser.add_argument("--log-level", default="INFO")
+    args = parser.parse_args()
+
+    logging.basicConfig(format="%(asctime)s: %(levelname)s %(message)s", datefmt="%Y-%m-%d %H:%M:%S")
+    logging.getLogger().setLevel('WARNING')
+    _log.setLevel(args.log_level)
+
+    services = {}
+    for name in args.reports:
+        services[name] = SERVICES[name](latency=getattr(args, name + '_latency'),
+                                        failure_rate=getattr(args, name + '_failures'), seed=1).start()
+    results = []
+    try:
+        for count in args.inverters:
+            _log.info("Soaking {} inverters for {}s".format(count, args.duration))
+            result = run(args, count, services)
+            results.append(result)
+            read, slip = result['latency_s']['read'], result['latency_s']['interval_slip']
+            print("{:5d} inverters: {:8.1f}/{:8.1f} samples/s, read p95 {:6.1f} ms, slip p95 {}, "
+                  "RSS {:6.1f} MiB{}".format(
+                      count, result['sustained_samples_per_s'], result['expected_samples_per_s'],
+                      (read['p95'] or 0) * 1000,
+                      'n/a' if slip['p95'] is None else '{:6.1f} ms'.format(slip['p95'] * 1000),
+                      result['rss_mb']['max'], '' if result['keeping_up'] else '  FALLING BEHIND'))
+    finally:
+        for s in services.values():
+            s.stop()
+
+    with open(args.output, 'w') as f:
+        json.dump({'meta': {'time': datetime.now().isoformat(timespec='seconds'),
+                            'python': platform.python_version(), 'platform': platform.platform(),
+                            'args': vars(args)},
+                   'results': results}, f, indent=2, sort_keys=True, default=str)
+    print("Results written to {}".format(args.output))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,270 @@
+#!/usr/bin/env python
+
+# Copyright 2018 Paul Archer
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Local stand-ins for the report services, for the soak harness
+
+FakePVOutput and FakeInfluxDB are HTTP servers accepting the requests the
+reports make, FakeMQTTBroker a minimal MQTT 3.1.1 broker that acknowledges
+publishes and drops them. Each waits `latency` seconds, give or take
+`jitter`, before answering and fails a `failure_rate` fraction of requests:
+an HTTP 503 (500 for InfluxDB), or a dropped MQTT connection. The
+attributes can be changed while a stand-in runs.
+"""
+
+import asyncio
+import gzip
+import random
+import struct
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+
+class _Faults():
+    """Latency and failure injection, and the request counters"""
+
+    def __init__(self, latency=0.0, jitter=0.0, failure_rate=0.0, seed=None):
+        self.latency = latency
+        self.jitter = jitter
+        self.failure_rate = failure_rate
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.failures = 0
+        # Statuses, points or messages accepted
+        self.items = 0
+        self.bytes = 0
+
+    def delay(self):
+        return max(0.0, self.latency + self.random.uniform(-self.jitter, self.jitter))
+
+    def fail(self):
+        with self.lock:
+            self.requests += 1
+            failed = self.random.random() < self.failure_rate
+            if failed:
+                self.failures += 1
+            return failed
+
+    def accepted(self, items, size):
+        with self.lock:
+            self.items += items
+            self.bytes += size
+
+    def stats(self):
+        with self.lock:
+            return {'requests': self.requests, 'failures': self.failures, 'items': self.items, 'bytes': self.bytes}
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def _reply(self, status, body=b'', headers=None):
+        self.send_response(status)
+        for k, v in (headers or {}).items():
+            self.send_header(k, v)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _body(self):
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        if self.headers.get('Content-Encoding') == 'gzip':
+            body = gzip.decompress(body)
+        return body
+
+    def do_GET(self):
+        self.do_POST()
+
+    def do_POST(self):
+        body = self._body()
+        stand_in = self.server.stand_in
+        time.sleep(stand_in.delay())
+        if stand_in.fail():
+            self._reply(stand_in.failure_status, b'Service Unavailable')
+            return
+        self.server.stand_in.handle(self, urlparse(self.path), body)
+
+
+class _HTTPStandIn(_Faults):
+    failure_status = 503
+
+    def __init__(self, host='127.0.0.1', port=0, **kwargs):
+        super().__init__(**kwargs)
+        self._server = ThreadingHTTPServer((host, port), _Handler)
+        self._server.daemon_threads = True
+        self._server.stand_in = self
+        self.host, self.port = self._server.server_address[:2]
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, name=type(self).__name__, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+
+class FakePVOutput(_HTTPStandIn):
+    """Accepts addstatus, addbatchstatus and addoutput requests, with an unlimited quota"""
+
+    def handle(self, handler, url, body):
+        params = parse_qs(body.decode('utf-8'))
+        if url.path.endswith('addbatchstatus.jsp'):
+            items = len(params.get('data', [''])[0].split(';'))
+        else:
+            items = 1
+        self.accepted(items, len(body))
+        reset = str(int(time.time()) + 3600)
+        handler._reply(200, b'OK 200: Added Status', {'X-Rate-Limit-Limit': '1000000',
+                                                      'X-Rate-Limit-Remaining': '1000000',
+                                                      'X-Rate-Limit-Reset': reset})
+
+
+class FakeInfluxDB(_HTTPStandIn):
+    """Accepts line protocol writes to /write"""
+    failure_status = 500
+
+    def handle(self, handler, url, body):
+        if url.path == '/write':
+            self.accepted(body.count(b'\n') + (0 if body.endswith(b'\n') or not body else 1), len(body))
+        handler._reply(204)
+
+
+# MQTT control packet types
+_CONNECT, _CONNACK, _PUBLISH, _PUBACK, _PUBREC, _PUBREL, _PUBCOMP = 1, 2, 3, 4, 5, 6, 7
+_SUBSCRIBE, _SUBACK, _PINGREQ, _PINGRESP, _DISCONNECT = 8, 9, 12, 13, 14
+
+
+class FakeMQTTBroker(_Faults):
+    """Acknowledges MQTT 3.1.1 connects, publishes, subscribes and pings
+
+    Nothing is routed to subscribers. A failed publish closes the
+    connection without an acknowledgement, the client then reconnects.
+    """
+
+    def __init__(self, host='127.0.0.1', port=0, **kwargs):
+        super().__init__(**kwargs)
+        self.host = host
+        self.port = port
+        self._server = None
+        self._connections = set()
+        self._loop = None
+        self._thread = None
+
+    async def _packet(self, reader):
+        header = (await reader.readexactly(1))[0]
+        length, shift = 0, 0
+        while True:
+            b = (await reader.readexactly(1))[0]
+            length |= (b & 0x7f) << shift
+            shift += 7
+            if not b & 0x80:
+                break
+        return header >> 4, header & 0x0f, await reader.readexactly(length)
+
+    async def _serve(self, reader, writer):
+        task = asyncio.current_task()
+        self._connections.add(task)
+        try:
+            while True:
+                kind, flags, body = await self._packet(reader)
+                if kind == _CONNECT:
+                    writer.write(bytes([_CONNACK << 4, 2, 0, 0]))
+                elif kind == _PUBLISH:
+                    qos = (flags >> 1) & 3
+                    (topic_length,) = struct.unpack_from('>H', body)
+                    pid = body[2 + topic_length:4 + topic_length]
+                    delay = self.delay()
+                    if delay:
+                        await asyncio.sleep(delay)
+                    if self.fail():
+                        break
+                    self.accepted(1, len(body))
+                    if qos == 1:
+                        writer.write(bytes([_PUBACK << 4, 2]) + pid)
+                    elif qos == 2:
+                        writer.write(bytes([_PUBREC << 4, 2]) + pid)
+                elif kind == _PUBREL:
+                    writer.write(bytes([_PUBCOMP << 4, 2]) + body[:2])
+                elif kind == _SUBSCRIBE:
+                    # Every filter granted at QoS 0
+                    topics = _topics(body[2:])
+                    writer.write(bytes([_SUBACK << 4, 2 + topics]) + body[:2] + bytes(topics))
+                elif kind == _PINGREQ:
+                    writer.write(bytes([_PINGRESP << 4, 0]))
+                elif kind == _DISCONNECT:
+                    break
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError, asyncio.CancelledError):
+            pass
+        finally:
+            self._connections.discard(task)
+            writer.close()
+
+    async def _start(self):
+        self._server = await asyncio.start_server(self._serve, self.host, self.port)
+        self.port = self._server.sockets[0].getsockname()[1]
+
+    async def _close(self):
+        self._server.close()
+        for task in list(self._connections):
+            task.cancel()
+        await asyncio.gather(*self._connections, return_exceptions=True)
+        await self._server.wait_closed()
+
+    def start(self):
+        self._loop = asyncio.new_event_loop()
+        started = threading.Event()
+
+        def run():
+            asyncio.set_event_loop(self._loop)
+            self._loop.run_until_complete(self._start())
+            started.set()
+            self._loop.run_forever()
+            self._loop.close()
+
+        self._thread = threading.Thread(target=run, name='FakeMQTTBroker', daemon=True)
+        self._thread.start()
+        started.wait()
+        return self
+
+    def stop(self):
+        asyncio.run_coroutine_threadsafe(self._close(), self._loop).result()
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+
+
+def _topics(payload):
+    """Number of topic filters in a SUBSCRIBE payload"""
+    count, pos = 0, 0
+    while pos < len(payload):
+        (length,) = struct.unpack_from('>H', payload, pos)
+        pos += 2 + length + 1
+        count += 1
+    return count
+
+
+#-----------------
+# Exported symbols
+#-----------------
+__all__ = ["FakePVOutput", "FakeInfluxDB", "FakeMQTTBroker"]
@@ -0,0 +1,360 @@
+#!/usr/bin/env python
+
+# Copyright 2018 Paul Archer
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import time
+from collections import deque
+from datetime import datetime
+from decimal import Decimal
+
+from pvstats.numeric import ScaledInt
+
+import logging
+
+_log = logging.getLogger(__name__)
+
+# Aggregate functions, 'integral' is the trapezoidal integral in value hours
+# and 'time_mean' the mean weighted by the time each value was held
+FUNCTIONS = ('mean', 'time_mean', 'min', 'max', 'first', 'last', 'integral')
+
+_NUMBERS = (int, float, Decimal, ScaledInt)
+
+# Running statistics of a field, one list per field and pane
+_COUNT, _SUM, _MIN, _MAX, _FIRST, _LAST, _AREA, _DURATION = range(8)
+
+
+def _is_field(key, value):
+    """Numeric sample values are aggregated, tags, dates and fault codes are labels"""
+    return isinstance(value, _NUMBERS) and not isinstance(value, bool) and \
+        not key.startswith(('tag_', 'date_', 'fault_')) and key != 'timestamp'
+
+
+def _merge(a, b):
+    """Combines the statistics of an earlier pane a with a later pane b"""
+    return [a[_COUNT] + b[_COUNT], a[_SUM] + b[_SUM], min(a[_MIN], b[_MIN]), max(a[_MAX], b[_MAX]),
+            a[_FIRST], b[_LAST], a[_AREA] + b[_AREA], a[_DURATION] + b[_DURATION]]
+
+
+def _result(stats, function):
+    if function == 'mean':
+        return stats[_SUM] / stats[_COUNT]
+    if function == 'time_mean':
+        if stats[_DURATION] > 0:
+            return stats[_AREA] / stats[_DURATION]
+        return stats[_SUM] / stats[_COUNT]
+    if function == 'min':
+        return stats[_MIN]
+    if function == 'max':
+        return stats[_MAX]
+    if function == 'first':
+        return stats[_FIRST]
+    if function == 'last':
+        return stats[_LAST]
+    if function == 'integral':
+        return stats[_AREA] / 3600
+    raise ValueError("Unknown aggregate function {}".format(function))
+
+
+class _Series():
+    """Window state of one inverter"""
+
+    def __init__(self, panes):
+        # (pane start, {field: stats}, sequence number of the first sample)
+        # of the panes of the current window, oldest first
+        self.panes = deque(maxlen=panes)
+        self.pane_start = None
+        self.current = {}
+        self.current_first = None
+        self.labels = {}
+        self.previous = None
+        self.previous_time = None
+        self.received = None
+        self.timestamp_type = None
+
+
+class WindowAggregator():
+    """Streaming tumbling or sliding window statistics of samples
+
+    Windows are `window` seconds long and aligned to multiples of it. With a
+    `step` shorter than the window they slide, a window is emitted every
+    step. Each step is a pane of running statistics per field, so memory is
+    constant in the number of samples and a window is the merge of its
+    window/step panes.
+
+    Time weighting and integrals join consecutive samples with trapezoids,
+    attributed to the pane of the later sample. Samples further than
+    `max_gap` seconds apart are not joined. Labels (tag_, date_ and fault_
+    fields and anything non-numeric) take the latest value. Samples are
+    grouped per 'tag_inverter'.
+
+    Samples are numbered as they are added; `origins` lists the number of
+    the first sample of each window emitted since take_origins() was last
+    called, and held_from() the first sample still needed by a window yet
+    to be emitted.
+    """
+
+    def __init__(self, window, step=None, functions=None, default='mean', max_gap=None):
+        self.window = float(window)
+        self.step = float(step or window)
+        if self.window % self.step:
+            raise ValueError("Aggregate window {} is not a multiple of the step {}".format(window, step))
+        self.functions = {}
+        for name, function in (functions or {}).items():
+            for f in [function] if isinstance(function, str) else function:
+                if f not in FUNCTIONS:
+                    raise ValueError("Unknown aggregate function {}".format(f))
+            self.functions[name] = function
+        if default not in FUNCTIONS:
+            raise ValueError("Unknown aggregate function {}".format(default))
+        self.default = default
+        self.max_gap = float(max_gap) if max_gap else 2 * self.step
+        self.series = {}
+        self.added = 0
+        self.origins = []
+
+    def add(self, sample):
+        """Adds a sample, returns the windows it closes"""
+        seq = self.added
+        self.added += 1
+        timestamp = sample['timestamp']
+        t = timestamp if isinstance(timestamp, (int, float)) else timestamp.timestamp()
+        key = sample.get('tag_inverter')
+        series = self.series.get(key)
+        if series is None:
+            series = self.series[key] = _Series(int(round(self.window / self.step)))
+        series.timestamp_type = type(timestamp)
+
+        out = []
+        if series.previous_time is not None and t <= series.previous_time:
+            # Out of order, or replayed after a failure
+            _log.debug("Dropping out of order sample at {}".format(timestamp))
+            return out
+        pane_start = t - t % self.step
+        if series.pane_start is not None and pane_start != series.pane_start:
+            out += self._advance(series, pane_start)
+        series.pane_start = pane_start
+
+        joined = series.previous_time is not None and 0 < t - series.previous_time <= self.max_gap
+        current = series.current
+        if not current:
+            series.current_first = seq
+        for k, v in sample.items():
+            if not _is_field(k, v):
+                if k != 'timestamp':
+                    series.labels[k] = v
+                continue
+            v = float(v)
+            stats = current.get(k)
+            if stats is None:
+                stats = current[k] = [0, 0.0, v, v, v, v, 0.0, 0.0]
+            stats[_COUNT] += 1
+            stats[_SUM] += v
+            if v < stats[_MIN]:
+                stats[_MIN] = v
+            if v > stats[_MAX]:
+                stats[_MAX] = v
+            stats[_LAST] = v
+            if joined and k in series.previous:
+                dt = t - series.previous_time
+                stats[_AREA] += (series.previous[k] + v) * dt / 2
+                stats[_DURATION] += dt
+
+        series.previous = {k: current[k][_LAST] for k in current}
+        series.previous_time = t
+        series.received = time.monotonic()
+        return out
+
+    def _advance(self, series, pane_start):
+        """Closes panes up to the one starting at pane_start, returns the windows ending with them"""
+        out = []
+        end = series.pane_start
+        while end < pane_start:
+            series.panes.append((end, series.current, series.current_first if series.current else None))
+            series.current = {}
+            end += self.step
+            if any(fields for _, fields, _ in series.panes):
+                out.append(self._emit(series, end))
+            else:
+                # Nothing left in the window, skip ahead
+                end = max(end, pane_start)
+        if pane_start - series.pane_start > self.window:
+            series.panes.clear()
+        return out
+
+    def _emit(self, series, end):
+        merged = {}
+        for _, fields, _ in series.panes:
+            for k, stats in fields.items():
+                merged[k] = _merge(merged[k], stats) if k in merged else stats
+        self.origins.append(min(first for _, _, first in series.panes if first is not None))
+
+        out = dict(series.labels)
+        if series.timestamp_type in (int, float):
+            out['timestamp'] = end
+        else:
+            out['timestamp'] = datetime.fromtimestamp(end)
+        for k, stats in merged.items():
+            function = self.functions.get(k, self.default)
+            if isinstance(function, str):
+                out[k] = _result(stats, function)
+            else:
+                for f in function:
+                    out['{}_{}'.format(k, f)] = _result(stats, f)
+        return out
+
+    def pending(self):
+        """True if samples are held that no window has been emitted for"""
+        return any(series.current for series in self.series.values())
+
+    def held_from(self):
+        """Number of the first sample a window yet to be emitted needs, `added` if none"""
+        firsts = [self.added]
+        for series in self.series.values():
+            panes = list(series.panes)
+            if len(panes) == series.panes.maxlen:
+                # The oldest pane drops out of the next window
+                panes = panes[1:]
+            firsts += [first for _, _, first in panes if first is not None]
+            if series.current:
+                firsts.append(series.current_first)
+        return min(firsts)
+
+    def take_origins(self):
+        """Returns and clears the origins of the windows emitted"""
+        origins, self.origins = self.origins, []
+        return origins
+
+    @staticmethod
+    def _pane_end(series, step):
+        # Projected from when its latest sample arrived, so the inverter
+        # clocks need not agree with ours
+        return series.received + series.pane_start + step - series.previous_time
+
+    def next_close(self):
+        """Monotonic time the current pane of any inverter ends, None if none is held"""
+        ends = [self._pane_end(series, self.step) for series in self.series.values() if series.current]
+        return min(ends) if ends else None
+
+    def _close(self, series):
+        out = self._advance(series, series.pane_start + self.step)
+        series.pane_start += self.step
+        return out
+
+    def close_due(self, now):
+        """Closes the current panes that ended by monotonic time now, returns the windows ending with them"""
+        out = []
+        for series in self.series.values():
+            if series.current and self._pane_end(series, self.step) <= now:
+                out += self._close(series)
+        return out
+
+    def close(self):
+        """Closes the current panes, ended or not, returns the windows ending with them"""
+        out = []
+        for series in self.series.values():
+            if series.current:
+                out += self._close(series)
+        return out
+
+    def reset(self):
+        self.series = {}
+        self.origins = []
+
+
+class AggregatedReport():
+    """Publishes windowed aggregates of the samples to a report
+
+    Configured by a report's 'aggregate' entry: 'window' and 'step' in
+    seconds, the per field 'functions' and the 'default' function. A window
+    still open 'grace' seconds after its end has passed, e.g. overnight, is
+    closed by the report's flush. Flushes leave windows that have not ended
+    open, only close() ends them early. Windows the report fails to take
+    are kept and sent again with the next ones, or by a flush 'grace'
+    seconds on; samples replayed after a failure that were already added
+    are dropped. held() counts the samples of open windows, of windows not
+    yet sent and of windows the report still holds.
+    """
+
+    def __init__(self, report, cfg):
+        self.report = report
+        self.aggregator = WindowAggregator(cfg['window'], cfg.get('step'), cfg.get('functions'),
+                                           cfg.get('default', 'mean'), cfg.get('max_gap'))
+        # Allowance for the sample closing a window to arrive
+        self.grace = float(cfg.get('grace', self.aggregator.step))
+        # Number of the first sample of each window forwarded, the latest the
+        # report may still hold, then those of the failed windows
+        self._origins = deque()
+        # Windows the report failed to take and the monotonic time to retry them
+        self._failed = []
+        self._retry_at = None
+
+    def publish(self, data):
+        self.publish_batch([data])
+
+    def publish_batch(self, samples):
+        out = []
+        for data in samples:
+            out += self.aggregator.add(data)
+        self._forward(out)
+
+    def _forward(self, out):
+        self._origins.extend(self.aggregator.take_origins())
+        out = self._failed + out
+        self._failed = []
+        self._retry_at = None
+        try:
+            if len(out) == 1:
+                self.report.publish(out[0])
+            elif out:
+                self.report.publish_batch(out)
+        except Exception:
+            self._failed = out
+            self._retry_at = time.monotonic() + self.grace
+            raise
+
+    def flush(self):
+        self._forward(self.aggregator.close_due(time.monotonic() - self.grace))
+        self.report.flush()
+
+    def flush_deadline(self):
+        deadline = self.report.flush_deadline()
+        end = self.aggregator.next_close()
+        if end is not None:
+            end += self.grace
+            deadline = end if deadline is None else min(deadline, end)
+        if self._retry_at is not None:
+            deadline = self._retry_at if deadline is None else min(deadline, self._retry_at)
+        return deadline
+
+    def held(self):
+        held = self.report.held()
+        if held is None:
+            return None
+        while len(self._origins) > held + len(self._failed):
+            self._origins.popleft()
+        first = self.aggregator.held_from()
+        if self._origins:
+            first = min(first, self._origins[0])
+        return self.aggregator.added - first
+
+    def close(self):
+        self._forward(self.aggregator.close())
+        self.report.close()
+
+
+#-----------------
+# Exported symbols
+#-----------------
+__all__ = ["WindowAggregator", "AggregatedReport", "FUNCTIONS"]
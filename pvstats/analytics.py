@@ -0,0 +1,215 @@
+#!/usr/bin/env python
+
+# Copyright 2018 Paul Archer
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from datetime import datetime, time, timedelta
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+import logging
+
+_log = logging.getLogger(__name__)
+
+# Sample fields the daily summary is computed from
+POWER = 'total_pv_power'
+ENERGY = 'daily_pv_energy'
+EXPORT = 'daily_export_energy'
+TEMPERATURE = 'internal_temp'
+STRINGS = (('pv1_power', 'pv1_voltage', 'pv1_current'), ('pv2_power', 'pv2_voltage', 'pv2_current'))
+
+FIELDS = (POWER, ENERGY, EXPORT, TEMPERATURE) + tuple(f for string in STRINGS for f in string)
+
+# Samples further apart are not joined by the energy integrals
+DEFAULT_MAX_GAP = 900
+
+_NAN = float('nan')
+
+
+def _seconds(timestamp):
+    return timestamp if isinstance(timestamp, (int, float)) else timestamp.timestamp()
+
+
+def local_date(timestamp):
+    """Local calendar date of a sample timestamp"""
+    if isinstance(timestamp, datetime):
+        return timestamp.date()
+    return datetime.fromtimestamp(timestamp).date()
+
+
+class DayBuffer():
+    """The FIELDS of one inverter's samples, kept as columns for summarize()"""
+
+    def __init__(self):
+        self.times = []
+        self.columns = {name: [] for name in FIELDS}
+
+    def __len__(self):
+        return len(self.times)
+
+    def append(self, sample):
+        self.times.append(_seconds(sample['timestamp']))
+        for name, column in self.columns.items():
+            v = sample.get(name)
+            column.append(_NAN if v is None else float(v))
+
+    def arrays(self):
+        return (numpy.array(self.times, dtype=numpy.float64),
+                {name: numpy.array(column, dtype=numpy.float64) for name, column in self.columns.items()})
+
+
+def _finite(values):
+    return values is not None and bool(numpy.isfinite(values).any())
+
+
+def _integral(times, values, max_gap):
+    """Trapezoidal integral in value hours, not across gaps or missing values"""
+    dt = numpy.diff(times)
+    area = (values[:-1] + values[1:]) * dt / 2
+    ok = (dt > 0) & (dt <= max_gap) & numpy.isfinite(area)
+    return float(area[ok].sum()) / 3600
+
+
+def _string_power(columns, power, voltage, current):
+    values = columns.get(power)
+    if _finite(values):
+        return values
+    if voltage in columns and current in columns:
+        return columns[voltage] * columns[current]
+    return None
+
+
+def summarize(times, columns, max_gap=DEFAULT_MAX_GAP, clip_limit=None, clip_fraction=0.99):
+    """Daily figures of the samples of one inverter
+
+    times are float seconds, oldest first, and columns maps field names to
+    arrays of the same length, NaN where a sample lacked the field, e.g. as
+    returned by DayBuffer.arrays() or ArchiveReader.read(). Returns a dict
+    of:
+
+    peak_power (W) and peak_time (seconds), generated (Wh, the inverter's
+    daily_pv_energy counter, else the power integral), energy_integral (Wh),
+    exported (Wh), min_temperature and max_temperature, clipping_minutes,
+    the time spent at or above clip_fraction of clip_limit (W), and
+    string_imbalance, the difference between the energies of the two PV
+    strings as a fraction of their sum. Figures the samples cannot give are
+    None.
+    """
+    if numpy is None:
+        raise RuntimeError("numpy is not installed")
+    times = numpy.asarray(times, dtype=numpy.float64)
+    columns = {name: numpy.asarray(values, dtype=numpy.float64) for name, values in columns.items()}
+    out = dict.fromkeys(('peak_power', 'peak_time', 'generated', 'energy_integral', 'exported',
+                         'min_temperature', 'max_temperature', 'clipping_minutes', 'string_imbalance'))
+    out['samples'] = len(times)
+
+    power = columns.get(POWER)
+    if _finite(power):
+        i = int(numpy.nanargmax(power))
+        out['peak_power'] = float(power[i])
+        out['peak_time'] = float(times[i])
+        out['energy_integral'] = _integral(times, power, max_gap)
+        if clip_limit:
+            dt = numpy.diff(times)
+            clipped = power >= clip_fraction * float(clip_limit)
+            clipped = clipped[:-1] & clipped[1:] & (dt > 0) & (dt <= max_gap)
+            out['clipping_minutes'] = float(dt[clipped].sum()) / 60
+
+    energy = columns.get(ENERGY)
+    out['generated'] = float(numpy.nanmax(energy)) if _finite(energy) else out['energy_integral']
+    exported = columns.get(EXPORT)
+    if _finite(exported):
+        out['exported'] = float(numpy.nanmax(exported))
+
+    temperature = columns.get(TEMPERATURE)
+    if _finite(temperature):
+        out['min_temperature'] = float(numpy.nanmin(temperature))
+        out['max_temperature'] = float(numpy.nanmax(temperature))
+
+    strings = [_string_power(columns, *fields) for fields in STRINGS]
+    if all(_finite(s) for s in strings):
+        e1, e2 = (_integral(times, s, max_gap) for s in strings)
+        if e1 + e2 > 0:
+            out['string_imbalance'] = abs(e1 - e2) / (e1 + e2)
+    return out
+
+
+def daily_summaries(times, columns, **kwargs):
+    """Splits samples into local days, returns (date, summarize()) for each day with samples
+
+    Each day is a slice of the arrays, so months of samples take one pass.
+    """
+    if numpy is None:
+        raise RuntimeError("numpy is not installed")
+    times = numpy.asarray(times, dtype=numpy.float64)
+    if not len(times):
+        return []
+    first, last = local_date(float(times[0])), local_date(float(times[-1]))
+    days = [first + timedelta(days=i) for i in range((last - first).days + 1)]
+    bounds = numpy.searchsorted(times, [datetime.combine(d, time()).timestamp() for d in days[1:]])
+    bounds = [0] + list(bounds) + [len(times)]
+    out = []
+    for d, lo, hi in zip(days, bounds[:-1], bounds[1:]):
+        if hi > lo:
+            out.append((d, summarize(times[lo:hi], {k: v[lo:hi] for k, v in columns.items()}, **kwargs)))
+    return out
+
+
+def combine(summaries):
+    """Summary of a system fed by several inverters
+
+    Energies add up, peak power and temperatures are the extremes of the
+    individual inverters.
+    """
+    def values(key):
+        return [s[key] for s in summaries if s[key] is not None]
+
+    out = {'samples': sum(s['samples'] for s in summaries)}
+    for key in ('generated', 'energy_integral', 'exported', 'clipping_minutes'):
+        out[key] = sum(values(key)) if values(key) else None
+    peaks = [s for s in summaries if s['peak_power'] is not None]
+    peak = max(peaks, key=lambda s: s['peak_power']) if peaks else None
+    out['peak_power'] = peak and peak['peak_power']
+    out['peak_time'] = peak and peak['peak_time']
+    out['min_temperature'] = min(values('min_temperature')) if values('min_temperature') else None
+    out['max_temperature'] = max(values('max_temperature')) if values('max_temperature') else None
+    imbalance = values('string_imbalance')
+    out['string_imbalance'] = max(imbalance) if imbalance else None
+    return out
+
+
+def output_params(day, summary):
+    """PVOutputClient.add_output() arguments of a day's summary, None without generation"""
+    if summary['generated'] is None:
+        return None
+    params = {'date': day.strftime("%Y%m%d"), 'generated': int(round(summary['generated']))}
+    if summary['exported'] is not None:
+        params['exported'] = int(round(summary['exported']))
+    if summary['peak_power'] is not None:
+        params['peak_power'] = int(round(summary['peak_power']))
+        params['peak_time'] = datetime.fromtimestamp(summary['peak_time']).strftime("%H:%M")
+    if summary['min_temperature'] is not None:
+        params['min_temperature'] = round(summary['min_temperature'], 1)
+        params['max_temperature'] = round(summary['max_temperature'], 1)
+    return params
+
+
+#-----------------
+# Exported symbols
+#-----------------
+__all__ = ["DayBuffer", "summarize", "daily_summaries", "combine", "output_params", "local_date", "FIELDS",
+           "DEFAULT_MAX_GAP"]
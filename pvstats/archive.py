@@ -0,0 +1,357 @@
+#!/usr/bin/env python
+
+# Copyright 2018 Paul Archer
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import struct
+import zlib
+from array import array
+from datetime import datetime, timezone
+
+from pvstats.history import numeric_fields
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+import logging
+
+_log = logging.getLogger(__name__)
+
+_DATA_SUFFIX = '.dat'
+_INDEX_SUFFIX = '.idx'
+
+# Partitions are UTC days
+_PARTITION_SECONDS = 86400
+
+# Index record: first and last timestamp (ms), offset and length of the chunk, CRC32
+_INDEX = struct.Struct('=qqQII')
+
+# Chunk header: sample count, field count
+_CHUNK = struct.Struct('=IH')
+_NAME = struct.Struct('=H')
+_BLOCK = struct.Struct('=I')
+
+_NAN = float('nan')
+
+
+class _BitWriter():
+    def __init__(self):
+        self.out = bytearray()
+        self.acc = 0
+        self.bits = 0
+
+    def write(self, value, bits):
+        self.acc = (self.acc << bits) | value
+        self.bits += bits
+        if self.bits >= 64:
+            extra = self.bits % 8
+            self.out += (self.acc >> extra).to_bytes((self.bits - extra) // 8, 'big')
+            self.acc &= (1 << extra) - 1
+            self.bits = extra
+
+    def getvalue(self):
+        pad = -self.bits % 8
+        return bytes(self.out) + (self.acc << pad).to_bytes((self.bits + pad) // 8, 'big')
+
+
+class _BitReader():
+    def __init__(self, data):
+        self.value = int.from_bytes(data, 'big')
+        self.size = 8 * len(data)
+        self.pos = 0
+
+    def read(self, bits):
+        self.pos += bits
+        return (self.value >> (self.size - self.pos)) & ((1 << bits) - 1)
+
+
+def _signed(value, bits):
+    return value - (1 << bits) if value >> (bits - 1) else value
+
+
+# Delta of delta buckets: control bits, control value and value bits
+_DOD_BUCKETS = ((2, 0b10, 7), (3, 0b110, 9), (4, 0b1110, 12))
+
+
+def encode_times(times):
+    """Delta of delta encodes integer timestamps"""
+    w = _BitWriter()
+    w.write(times[0] & (2**64 - 1), 64)
+    previous, delta = times[0], 0
+    for t in times[1:]:
+        dod = (t - previous) - delta
+        delta = t - previous
+        previous = t
+        if dod == 0:
+            w.write(0, 1)
+            continue
+        for control_bits, control, bits in _DOD_BUCKETS:
+            offset = (1 << (bits - 1)) - 1
+            if -offset <= dod <= offset + 1:
+                w.write(control, control_bits)
+                w.write(dod + offset, bits)
+                break
+        else:
+            w.write(0b1111, 4)
+            w.write(dod & (2**64 - 1), 64)
+    return w.getvalue()
+
+
+def decode_times(data, count):
+    r = _BitReader(data)
+    times = [_signed(r.read(64), 64)]
+    delta = 0
+    for _ in range(count - 1):
+        if r.read(1):
+            for _, _, bits in _DOD_BUCKETS:
+                if not r.read(1):
+                    delta += r.read(bits) - ((1 << (bits - 1)) - 1)
+                    break
+            else:
+                delta += _signed(r.read(64), 64)
+        times.append(times[-1] + delta)
+    return times
+
+
+def encode_values(values):
+    """XOR encodes float64 values, Gorilla style"""
+    words = memoryview(array('d', values)).cast('B').cast('Q')
+    w = _BitWriter()
+    previous = words[0]
+    w.write(previous, 64)
+    lead = trail = None
+    for word in words[1:]:
+        x = word ^ previous
+        previous = word
+        if x == 0:
+            w.write(0, 1)
+            continue
+        x_lead = min(64 - x.bit_length(), 31)
+        x_trail = (x & -x).bit_length() - 1
+        if lead is not None and x_lead >= lead and x_trail >= trail:
+            w.write(0b10, 2)
+            w.write(x >> trail, 64 - lead - trail)
+        else:
+            lead, trail = x_lead, x_trail
+            meaningful = 64 - lead - trail
+            w.write(0b11, 2)
+            w.write(lead, 5)
+            w.write(meaningful & 63, 6)
+            w.write(x >> trail, meaningful)
+    return w.getvalue()
+
+
+def decode_values(data, count):
+    r = _BitReader(data)
+    words = array('Q', [r.read(64)])
+    previous = words[0]
+    lead = trail = 0
+    for _ in range(count - 1):
+        if r.read(1):
+            if r.read(1):
+                lead = r.read(5)
+                trail = 64 - lead - (r.read(6) or 64)
+            previous ^= r.read(64 - lead - trail) << trail
+        words.append(previous)
+    return array('d', words.tobytes())
+
+
+def _milliseconds(timestamp):
+    if not isinstance(timestamp, (int, float)):
+        timestamp = timestamp.timestamp()
+    return int(round(timestamp * 1000))
+
+
+def _partition_name(ms):
+    day = datetime.fromtimestamp(ms // 1000 - (ms // 1000) % _PARTITION_SECONDS, timezone.utc)
+    return day.strftime('%Y-%m-%d')
+
+
+class ArchiveWriter():
+    """Appends samples of one inverter to a compressed columnar archive
+
+    Samples are held in memory until the `chunk_seconds` slot they fall in
+    ends, then written as a chunk: the delta of delta encoded timestamps and
+    a Gorilla XOR encoded float64 block per field, missing values as NaN.
+    Chunks are appended to a data file per UTC day and located by a fixed
+    size index record, the time range, offset, length and CRC of the chunk,
+    in the day's index file. flush() writes the open chunk early.
+
+    Not thread safe, the report channel serialises access.
+    """
+
+    def __init__(self, path, chunk_seconds=3600, fields=None):
+        if _PARTITION_SECONDS % chunk_seconds:
+            raise ValueError("Archive chunk_seconds {} does not divide a day".format(chunk_seconds))
+        self.path = path
+        self.chunk_ms = int(chunk_seconds * 1000)
+        self.fields = list(fields) if fields else None
+        self._times = []
+        self._columns = {}
+        self._slot = None
+        self._last = None
+        os.makedirs(path, exist_ok=True)
+
+    def append(self, timestamp, values):
+        """Adds a sample, values maps field names to numbers, returns False if it was dropped"""
+        t = _milliseconds(timestamp)
+        if self._last is not None and t < self._last:
+            _log.debug("Archive {}: dropping out of order sample at {}".format(self.path, timestamp))
+            return False
+        slot = t // self.chunk_ms
+        if self._times and slot != self._slot:
+            self.flush()
+        self._slot = slot
+        self._last = t
+
+        for name in self.fields or numeric_fields(values):
+            if name not in self._columns:
+                self._columns[name] = [_NAN] * len(self._times)
+        for name, column in self._columns.items():
+            v = values.get(name)
+            column.append(_NAN if v is None else float(v))
+        self._times.append(t)
+        return True
+
+    def held(self):
+        """Number of samples held for the open chunk"""
+        return len(self._times)
+
+    def _chunk(self):
+        parts = [_CHUNK.pack(len(self._times), len(self._columns))]
+        block = encode_times(self._times)
+        parts += [_BLOCK.pack(len(block)), block]
+        for name, column in self._columns.items():
+            encoded = name.encode('utf-8')
+            block = encode_values(column)
+            parts += [_NAME.pack(len(encoded)), encoded, _BLOCK.pack(len(block)), block]
+        return b''.join(parts)
+
+    def flush(self):
+        """Writes the samples held to a chunk"""
+        if not self._times:
+            return
+        chunk = self._chunk()
+        base = os.path.join(self.path, _partition_name(self._times[0]))
+        with open(base + _DATA_SUFFIX, 'ab') as f:
+            offset = f.tell()
+            f.write(chunk)
+            f.flush()
+            os.fsync(f.fileno())
+        # The chunk is on disk before the index points at it
+        with open(base + _INDEX_SUFFIX, 'ab') as f:
+            f.write(_INDEX.pack(self._times[0], self._times[-1], offset, len(chunk), zlib.crc32(chunk)))
+        self._times = []
+        self._columns = {}
+
+    def close(self):
+        self.flush()
+
+
+class ArchiveReader():
+    """Range queries over an archive written by ArchiveWriter
+
+    Only the day partitions and then the chunks whose time range overlaps
+    the query are read, and only the requested fields are decoded.
+    Timestamps are float seconds. Results are NumPy arrays when NumPy is
+    installed, arrays of doubles otherwise.
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+    def partitions(self):
+        return sorted(name[:-len(_INDEX_SUFFIX)] for name in os.listdir(self.path)
+                      if name.endswith(_INDEX_SUFFIX))
+
+    def chunks(self, start=None, end=None):
+        """(partition, first, last, offset, length, crc) of the chunks overlapping start <= t < end"""
+        lo = None if start is None else _milliseconds(start)
+        hi = None if end is None else _milliseconds(end)
+        out = []
+        for name in self.partitions():
+            day = int(datetime.strptime(name, '%Y-%m-%d').replace(tzinfo=timezone.utc).timestamp()) * 1000
+            if (lo is not None and day + _PARTITION_SECONDS * 1000 <= lo) or (hi is not None and day >= hi):
+                continue
+            with open(os.path.join(self.path, name + _INDEX_SUFFIX), 'rb') as f:
+                index = f.read()
+            # A torn trailing record is ignored
+            for record in _INDEX.iter_unpack(index[:len(index) - len(index) % _INDEX.size]):
+                first, last = record[0], record[1]
+                if (lo is None or last >= lo) and (hi is None or first < hi):
+                    out.append((name,) + record)
+        out.sort(key=lambda chunk: chunk[1])
+        return out
+
+    def _decode(self, chunk, fields):
+        count, nfields = _CHUNK.unpack_from(chunk, 0)
+        pos = _CHUNK.size
+        (length,) = _BLOCK.unpack_from(chunk, pos)
+        pos += _BLOCK.size
+        times = decode_times(chunk[pos:pos + length], count)
+        pos += length
+        columns = {}
+        for _ in range(nfields):
+            (length,) = _NAME.unpack_from(chunk, pos)
+            name = chunk[pos + _NAME.size:pos + _NAME.size + length].decode('utf-8')
+            pos += _NAME.size + length
+            (length,) = _BLOCK.unpack_from(chunk, pos)
+            pos += _BLOCK.size
+            if fields is None or name in fields:
+                columns[name] = decode_values(chunk[pos:pos + length], count)
+            pos += length
+        return times, columns
+
+    def read(self, start=None, end=None, fields=None):
+        """Timestamps and {field: values} of the samples with start <= t < end"""
+        lo = None if start is None else _milliseconds(start)
+        hi = None if end is None else _milliseconds(end)
+        times = array('d')
+        columns = {}
+        files = {}
+        try:
+            for name, first, last, offset, length, crc in self.chunks(start, end):
+                f = files.get(name)
+                if f is None:
+                    f = files[name] = open(os.path.join(self.path, name + _DATA_SUFFIX), 'rb')
+                f.seek(offset)
+                chunk = f.read(length)
+                if len(chunk) != length or zlib.crc32(chunk) != crc:
+                    _log.error("Archive {}: corrupt chunk at {} of {}, skipping it".format(self.path, offset, name))
+                    continue
+                chunk_times, chunk_columns = self._decode(chunk, fields)
+                keep = [i for i, t in enumerate(chunk_times)
+                        if (lo is None or t >= lo) and (hi is None or t < hi)]
+                for field in chunk_columns.keys() - columns.keys():
+                    columns[field] = array('d', [_NAN] * len(times))
+                for field, column in columns.items():
+                    values = chunk_columns.get(field)
+                    column.extend([_NAN] * len(keep) if values is None else [values[i] for i in keep])
+                times.extend([chunk_times[i] / 1000 for i in keep])
+        finally:
+            for f in files.values():
+                f.close()
+        if numpy is not None:
+            return (numpy.frombuffer(times, dtype=numpy.float64),
+                    {name: numpy.frombuffer(column, dtype=numpy.float64) for name, column in columns.items()})
+        return times, columns
+
+
+#-----------------
+# Exported symbols
+#-----------------
+__all__ = ["ArchiveWriter", "ArchiveReader", "encode_times", "decode_times", "encode_values", "decode_values"]
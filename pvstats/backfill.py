@@ -0,0 +1,268 @@
+#!/usr/bin/env python
+
+# Copyright 2018 Paul Archer
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+import math
+import os
+import time
+import traceback
+from datetime import datetime, timezone
+
+from pvstats.archive import ArchiveReader
+from pvstats.fanout import MAX_RETRY
+from pvstats.pvoutput import RateLimitExceeded
+from pvstats.report import PVReportFactory
+from pvstats.spool import Spool
+
+import logging
+
+_log = logging.getLogger(__name__)
+
+SOURCES = ('archive', 'spool')
+
+# Seconds of samples published and flushed at a time
+DEFAULT_CHUNK = 86400
+
+# Inverter directory of the archive report for untagged samples
+_UNTAGGED = 'inverter'
+
+
+def _seconds(timestamp):
+    return timestamp if isinstance(timestamp, (int, float)) else timestamp.timestamp()
+
+
+class Checkpoint():
+    """The time up to which a backfill has been delivered, kept in a file"""
+
+    def __init__(self, path, report):
+        self.path = path
+        self.report = report
+
+    def load(self):
+        """Returns the position saved by an earlier run, None if there is none"""
+        try:
+            with open(self.path) as f:
+                state = json.load(f)
+        except FileNotFoundError:
+            return None
+        if state.get('report') != self.report:
+            raise ValueError("Checkpoint {} belongs to report {}".format(self.path, state.get('report')))
+        return state['position']
+
+    def save(self, position):
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump({'report': self.report, 'position': position,
+                       'time': datetime.now().isoformat(timespec='seconds')}, f)
+        os.replace(tmp, self.path)
+
+
+def archive_chunks(path, start, end, chunk=DEFAULT_CHUNK):
+    """Yields (chunk end, samples) for the chunk aligned slices of an archive report's directory
+
+    Samples of all inverters are merged in timestamp order. Timestamps are
+    local datetimes, as read from the inverters. Slices without archived
+    samples are skipped.
+    """
+    readers = {name: ArchiveReader(os.path.join(path, name)) for name in sorted(os.listdir(path))
+               if os.path.isdir(os.path.join(path, name))}
+    slots = set()
+    for reader in readers.values():
+        for _, first, last, _, _, _ in reader.chunks(start, end):
+            slots.update(range(int(first / 1000 // chunk), int(last / 1000 // chunk) + 1))
+    for slot in sorted(slots):
+        lo = slot * chunk
+        hi = lo + chunk
+        samples = []
+        for name, reader in readers.items():
+            times, columns = reader.read(max(lo, start), min(hi, end))
+            columns = [(k, v.tolist()) for k, v in columns.items()]
+            for i, t in enumerate(times.tolist()):
+                sample = {k: v[i] for k, v in columns if not math.isnan(v[i])}
+                sample['timestamp'] = datetime.fromtimestamp(t)
+                if name != _UNTAGGED:
+                    sample['tag_inverter'] = name
+                samples.append(sample)
+        samples.sort(key=lambda s: s['timestamp'])
+        yield min(hi, end), samples
+    yield end, []
+
+
+def spool_chunks(path, start, end, chunk=DEFAULT_CHUNK, batch=1000):
+    """Yields (chunk end, samples) for the chunk aligned slices of a spool
+
+    The spool is opened read only, its cursor is left where it is.
+    """
+    spool = Spool(path, readonly=True)
+    try:
+        position = None
+        slice_end = None
+        samples = []
+        while True:
+            records, position = spool.read(batch, position)
+            if not records:
+                break
+            for sample in records:
+                t = _seconds(sample['timestamp'])
+                if not start <= t < end:
+                    continue
+                if slice_end is not None and t >= slice_end:
+                    yield slice_end, samples
+                    samples = []
+                if slice_end is None or t >= slice_end:
+                    slice_end = t - t % chunk + chunk
+                samples.append(sample)
+        if samples:
+            yield min(slice_end, end), samples
+    finally:
+        spool.close()
+
+
+def deliver(report, samples, retries=None):
+    """Publishes samples to a report and flushes it, retrying until it accepts them
+
+    A report out of quota is waited for. A ValueError, a request the service
+    rejected, is raised at once as retrying cannot help. After other
+    failures the samples are published again, up to retries times, as the
+    report may have lost what it held.
+    """
+    failures = 0
+    retry = 0
+    published = False
+    while True:
+        try:
+            if not published:
+                report.publish_batch(samples)
+                published = True
+            report.flush()
+            return
+        except RateLimitExceeded as err:
+            _log.info("Backfill: {}".format(err))
+            time.sleep(err.delay)
+        except ValueError as err:
+            _log.error("Backfill: report rejected the samples: {}".format(err))
+            raise
+        except Exception as err:
+            failures += 1
+            if retries is not None and failures > retries:
+                raise
+            _log.debug(traceback.format_exc())
+            retry = min(max(2 * retry, 1), MAX_RETRY)
+            _log.error("Backfill: report failed, retrying in {}s: {}".format(retry, err))
+            time.sleep(retry)
+            published = False
+
+
+def _delivered_to(report, samples, end):
+    """Time up to which the samples of a chunk flushed to a report are sent, None if not known
+
+    A report still holding samples, e.g. in an open PVOutput window, has
+    only sent those before the first it holds.
+    """
+    held = report.held()
+    if held == 0:
+        return end
+    if held is None or held > len(samples):
+        return None
+    return _seconds(samples[-held]['timestamp'])
+
+
+def backfill(report, chunks, checkpoint=None, max_rate=None, retries=None):
+    """Delivers the chunks of samples to a report, oldest first
+
+    The checkpoint is advanced once the report has been flushed after each
+    chunk, up to the first sample the report still holds. max_rate caps the
+    samples per second. Returns the number of samples delivered.
+    """
+    delivered = 0
+    started = time.monotonic()
+    for end, samples in chunks:
+        if samples:
+            deliver(report, samples, retries)
+            delivered += len(samples)
+        position = _delivered_to(report, samples, end)
+        if checkpoint is not None and position is not None:
+            checkpoint.save(position)
+        _log.info("Backfill: {} samples delivered, up to {}".format(delivered, datetime.fromtimestamp(end)))
+        if max_rate:
+            ahead = started + delivered / max_rate - time.monotonic()
+            if ahead > 0:
+                time.sleep(ahead)
+    return delivered
+
+
+def _report_config(cfg, name):
+    for rpt in cfg['reports']:
+        if rpt.get('name', rpt['type']) == name:
+            return rpt
+    raise ValueError("No report named {}".format(name))
+
+
+def run(cfg, report, source='archive', path=None, start=None, end=None, chunk=DEFAULT_CHUNK,
+        checkpoint=None, max_rate=None, retries=None):
+    """Backfills the named report of a configuration from an archive or spool
+
+    The report is built without its queue and spool, and published to
+    directly. start and end are datetimes, by default the whole archive or
+    spool up to now. The checkpoint file defaults to
+    backfill-<report>.json; a run resumes from it. A chunk failing more than
+    retries times in a row ends the run, None retries forever.
+    """
+    if source not in SOURCES:
+        raise ValueError("Unknown backfill source {}".format(source))
+    if path is None:
+        path = next((rpt['path'] for rpt in cfg['reports'] if rpt['type'] == 'archive'), None)
+        if source != 'archive' or path is None:
+            raise ValueError("No {} to backfill from, give its path".format(source))
+    rpt = dict(_report_config(cfg, report), queue_size=0)
+    rpt.pop('spool', None)
+    target = PVReportFactory(rpt)
+    if target is None:
+        raise ValueError("Report {} cannot be backfilled".format(report))
+
+    checkpoint = Checkpoint(checkpoint or 'backfill-{}.json'.format(report), report)
+    start = 0 if start is None else start.timestamp()
+    end = time.time() if end is None else end.timestamp()
+    position = checkpoint.load()
+    if position is not None and position > start:
+        _log.info("Backfill: resuming from {}".format(datetime.fromtimestamp(position)))
+        start = position
+
+    chunk = int(chunk)
+    if source == 'archive':
+        if not start:
+            # Start with the first archived day
+            days = [d for name in os.listdir(path) if os.path.isdir(os.path.join(path, name))
+                    for d in ArchiveReader(os.path.join(path, name)).partitions()]
+            if days:
+                start = datetime.strptime(min(days), '%Y-%m-%d').replace(tzinfo=timezone.utc).timestamp()
+        chunks = archive_chunks(path, start, end, chunk)
+    else:
+        chunks = spool_chunks(path, start, end, chunk)
+    try:
+        delivered = backfill(target, chunks, checkpoint, max_rate, retries)
+    finally:
+        # Sends what the report still holds, e.g. the last PVOutput windows
+        target.close()
+    checkpoint.save(end)
+    return delivered
+
+
+#-----------------
+# Exported symbols
+#-----------------
+__all__ = ["Checkpoint", "archive_chunks", "spool_chunks", "deliver", "backfill", "run", "SOURCES",
+           "DEFAULT_CHUNK"]
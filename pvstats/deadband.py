@@ -0,0 +1,164 @@
+#!/usr/bin/env python
+
+# Copyright 2018 Paul Archer
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from collections import deque
+from decimal import Decimal
+
+from pvstats.numeric import ScaledInt
+
+import logging
+
+_log = logging.getLogger(__name__)
+
+# State fields forwarded on any change, whatever the deadbands
+DEFAULT_ALWAYS = ('work_state', 'tag_fault_code')
+
+_NUMBERS = (int, float, Decimal, ScaledInt)
+
+
+class _State():
+    """What was last forwarded for one inverter"""
+
+    def __init__(self, sample, t):
+        self.sent = dict(sample)
+        self.heartbeat_at = t
+
+
+class DeadbandFilter():
+    """Report by exception, passes on only the fields that changed significantly
+
+    A numeric field is forwarded once it differs from the value last
+    forwarded by more than its 'abs' deadband and by more than its 'pct'
+    deadband, a percentage of the last value. The bands set for a field in
+    'fields' replace the defaults, an unset band is 0, so with neither set
+    any change is forwarded. Other fields, and the 'always' fields, are
+    forwarded whenever they change. The inverter clock (date_ fields) never
+    triggers an update.
+
+    A forwarded update carries the changed fields plus the timestamp and
+    tag_ fields. The whole sample is forwarded for the first sample of an
+    inverter and then every 'heartbeat' seconds of sample time.
+    """
+
+    def __init__(self, abs=0, pct=0, fields=None, heartbeat=None, always=DEFAULT_ALWAYS):
+        self.band = (float(abs), float(pct) / 100)
+        self.bands = {k: (float(f.get('abs', 0)), float(f.get('pct', 0)) / 100)
+                      for k, f in (fields or {}).items()}
+        self.heartbeat = float(heartbeat) if heartbeat else None
+        self.always = frozenset(always)
+        self.state = {}
+
+    def _changed(self, k, v, last):
+        if k in self.always or not isinstance(v, _NUMBERS) or not isinstance(last, _NUMBERS):
+            return v != last
+        d = abs(float(v) - float(last))
+        band_abs, band_pct = self.bands.get(k, self.band)
+        return d > band_abs and d > band_pct * abs(float(last))
+
+    def filter(self, sample):
+        """Returns the update to forward for the sample, or None"""
+        timestamp = sample['timestamp']
+        t = timestamp if isinstance(timestamp, (int, float)) else timestamp.timestamp()
+        key = sample.get('tag_inverter')
+        state = self.state.get(key)
+        if state is None or (self.heartbeat is not None and t - state.heartbeat_at >= self.heartbeat):
+            self.state[key] = _State(sample, t)
+            return sample
+
+        out = {}
+        sent = state.sent
+        for k, v in sample.items():
+            if k == 'timestamp' or k.startswith('date_'):
+                continue
+            if k not in sent or self._changed(k, v, sent[k]):
+                out[k] = v
+                sent[k] = v
+        if not out:
+            return None
+
+        out['timestamp'] = timestamp
+        for k, v in sample.items():
+            if k.startswith('tag_'):
+                out.setdefault(k, v)
+        return out
+
+    def reset(self):
+        """Forgets what was forwarded, the next samples are passed on whole"""
+        self.state = {}
+
+
+class DeadbandReport():
+    """Publishes only the significant changes of the samples to a report
+
+    Configured by a report's 'deadband' entry, see DeadbandFilter.
+    """
+
+    def __init__(self, report, cfg):
+        self.report = report
+        self.filter = DeadbandFilter(cfg.get('abs', 0), cfg.get('pct', 0), cfg.get('fields'),
+                                     cfg.get('heartbeat'), cfg.get('always', DEFAULT_ALWAYS))
+        self.suppressed = 0
+        self.received = 0
+        # Number of the sample each update forwarded came from, the latest
+        # the report may still hold
+        self._sources = deque()
+
+    def publish(self, data):
+        self.publish_batch([data])
+
+    def publish_batch(self, samples):
+        out = []
+        for data in samples:
+            update = self.filter.filter(data)
+            if update is None:
+                self.suppressed += 1
+            else:
+                out.append(update)
+                self._sources.append(self.received)
+            self.received += 1
+        try:
+            if len(out) == 1:
+                self.report.publish(out[0])
+            elif out:
+                self.report.publish_batch(out)
+        except Exception:
+            # Changes the report missed must not be filtered out on a retry
+            self.filter.reset()
+            self._sources.clear()
+            raise
+
+    def flush(self):
+        self.report.flush()
+
+    def flush_deadline(self):
+        return self.report.flush_deadline()
+
+    def held(self):
+        held = self.report.held()
+        if held is None:
+            return None
+        while len(self._sources) > held:
+            self._sources.popleft()
+        return self.received - self._sources[0] if self._sources else 0
+
+    def close(self):
+        self.report.close()
+
+
+#-----------------
+# Exported symbols
+#-----------------
+__all__ = ["DeadbandFilter", "DeadbandReport", "DEFAULT_ALWAYS"]
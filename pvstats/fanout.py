@@ -0,0 +1,354 @@
+#!/usr/bin/env python
+
+# Copyright 2018 Paul Archer
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import threading
+import time
+import traceback
+from collections import deque
+
+from pvstats.spool import Spool
+
+import logging
+
+_log = logging.getLogger(__name__)
+
+# What to do with a new sample when a report queue is full
+OVERFLOW_POLICIES = ('drop-oldest', 'block', 'coalesce')
+
+DEFAULT_QUEUE_SIZE = 100
+
+# Spooled samples handed to a report at once when catching up
+DEFAULT_SPOOL_BATCH = 100
+
+# Longest wait before retrying a failed spooled publish
+MAX_RETRY = 300
+
+# Recent publish latencies the metrics percentiles are taken over
+LATENCY_WINDOW = 1000
+
+
+def _percentile(values, fraction):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+class PVReportChannel():
+    """Publishes to a report on its own worker thread
+
+    publish() only queues the sample, so a slow or failing report never
+    delays the inverter reads or the other reports. When the queue is full
+    the overflow policy decides: 'drop-oldest' discards the oldest queued
+    sample, 'block' waits for room and 'coalesce' merges the sample into the
+    newest queued one.
+
+    With 'spool' set to a directory the queue is a durable on-disk Spool
+    instead. Samples stay spooled until the report accepts them, failures
+    are retried with backoff and a backlog is replayed in batches through
+    the report's publish_batch().
+
+    Reports that hold samples back to send them in bulk are flushed by the
+    worker once their flush_deadline() passes. Spooled samples are only
+    committed once the report no longer holds them, as its held() tells.
+    """
+
+    def __init__(self, report, cfg):
+        self.report = report
+        self.name = cfg.get('name', cfg['type'])
+        self.queue_size = max(1, int(cfg.get('queue_size', DEFAULT_QUEUE_SIZE)))
+        self.overflow = cfg.get('overflow', 'drop-oldest')
+        if self.overflow not in OVERFLOW_POLICIES:
+            raise ValueError("Unknown overflow policy {} for report {}".format(self.overflow, self.name))
+
+        self._queue = deque()
+        self._lock = threading.Lock()
+        self._ready = threading.Condition(self._lock)
+        self._room = threading.Condition(self._lock)
+        self._closing = False
+        self._busy = False
+        self._flush_requested = False
+
+        self.spool = None
+        if cfg.get('spool'):
+            self.spool = Spool(os.path.join(cfg['spool'], self.name),
+                               max_bytes=int(cfg.get('spool_max_mb', 256) * 2**20),
+                               fsync_interval=cfg.get('spool_fsync', 1.0),
+                               eviction=cfg.get('spool_eviction', 'drop-oldest'))
+            self.spool_batch = int(cfg.get('spool_batch', DEFAULT_SPOOL_BATCH))
+            # Read but not yet committed, while the report holds samples back
+            self._read_position = None
+            # Spool position after each of those samples
+            self._positions = deque()
+
+        # Metrics
+        self.enqueued = 0
+        self.published = 0
+        self.failed = 0
+        self.dropped = 0
+        self.coalesced = 0
+        self.max_depth = 0
+        self.last_latency = None
+        self.latencies = deque(maxlen=LATENCY_WINDOW)
+
+        self._thread = threading.Thread(target=self._run if self.spool is None else self._run_spooled,
+                                        name='pvstats-report-{}'.format(self.name),
+                                        daemon=True)
+        self._thread.start()
+
+    def publish(self, data):
+        with self._lock:
+            if self._closing:
+                return
+            if self.spool is not None:
+                if self.spool.append(data):
+                    self.enqueued += 1
+                else:
+                    self.dropped += 1
+                self._ready.notify()
+                return
+            if len(self._queue) >= self.queue_size:
+                if self.overflow == 'block':
+                    while len(self._queue) >= self.queue_size and not self._closing:
+                        self._room.wait()
+                elif self.overflow == 'coalesce':
+                    queued_at, queued = self._queue[-1]
+                    merged = dict(queued)
+                    merged.update(data)
+                    self._queue[-1] = (queued_at, merged)
+                    self.coalesced += 1
+                    return
+                else:
+                    self._queue.popleft()
+                    self.dropped += 1
+                    if self.dropped == 1 or self.dropped % 100 == 0:
+                        _log.warning("Report {} is falling behind, {} samples dropped".format(self.name, self.dropped))
+
+            self._queue.append((time.monotonic(), data))
+            self.enqueued += 1
+            self.max_depth = max(self.max_depth, len(self._queue))
+            self._ready.notify()
+
+    def _flush_due(self):
+        """Seconds until the report must be flushed, 0 when due, None if never"""
+        if self._flush_requested:
+            return 0
+        deadline = self.report.flush_deadline()
+        if deadline is None:
+            return None
+        return max(0, deadline - time.monotonic())
+
+    def _flush_report(self):
+        try:
+            self.report.flush()
+            return True
+        except Exception as err:
+            self.failed += 1
+            _log.debug(traceback.format_exc())
+            _log.error("Report {} flush failed: {}".format(self.name, err))
+            return False
+        finally:
+            with self._lock:
+                self._flush_requested = False
+                self._room.notify_all()
+
+    def _run(self):
+        retry = 0
+        while True:
+            data = None
+            with self._lock:
+                while not self._queue and not self._closing:
+                    wait = self._flush_due()
+                    if wait == 0:
+                        break
+                    self._ready.wait(wait)
+                if self._queue:
+                    queued_at, data = self._queue.popleft()
+                    self._room.notify()
+                elif self._closing:
+                    return
+                self._busy = True
+
+            if data is None:
+                if self._flush_report():
+                    retry = 0
+                    with self._lock:
+                        self._busy = False
+                        self._room.notify_all()
+                else:
+                    retry = self._retry_later(retry)
+                continue
+
+            try:
+                self.report.publish(data)
+                self.published += 1
+            except Exception as err:
+                self.failed += 1
+                _log.debug(traceback.format_exc())
+                _log.error("Report {} failed: {}".format(self.name, err))
+            finally:
+                self.last_latency = time.monotonic() - queued_at
+                self.latencies.append(self.last_latency)
+                with self._lock:
+                    self._busy = False
+                    self._room.notify_all()
+
+    def _run_spooled(self):
+        retry = 0
+        while True:
+            samples = None
+            with self._lock:
+                while not self.spool.pending(self._read_position) and not self._closing:
+                    wait = self._flush_due()
+                    if wait == 0:
+                        break
+                    self._ready.wait(self.spool.fsync_interval if wait is None else min(wait, self.spool.fsync_interval))
+                    self.spool.maybe_sync()
+                if self._closing:
+                    break
+                if self.spool.pending(self._read_position):
+                    samples, self._read_position = self.spool.read(self.spool_batch, self._read_position,
+                                                                   self._positions)
+                self._busy = True
+
+            if samples is None:
+                if self._flush_report():
+                    retry = 0
+                    with self._lock:
+                        self._commit_delivered()
+                        self._busy = False
+                        self._room.notify_all()
+                else:
+                    retry = self._retry_later(retry)
+                continue
+
+            try:
+                if len(samples) == 1:
+                    self.report.publish(samples[0])
+                else:
+                    _log.info("Report {}: replaying {} spooled samples".format(self.name, len(samples)))
+                    self.report.publish_batch(samples)
+                self.published += len(samples)
+                retry = 0
+                with self._lock:
+                    self._commit_delivered()
+            except Exception as err:
+                self.failed += 1
+                _log.debug(traceback.format_exc())
+                _log.error("Report {} failed: {}".format(self.name, err))
+                retry = self._retry_later(retry, replay=True)
+            finally:
+                with self._lock:
+                    self._busy = False
+                    self._room.notify_all()
+
+        # Whatever is left stays spooled for the next run
+        if self._read_position is not None and self._flush_report():
+            with self._lock:
+                self._commit_delivered()
+        with self._lock:
+            self.spool.close()
+
+    def _commit_delivered(self):
+        """Commits the samples read that the report no longer holds"""
+        held = self.report.held()
+        positions = self._positions
+        if held is None or self._read_position is None:
+            return
+        if held == 0:
+            self.spool.commit(self._read_position)
+            self._read_position = None
+            positions.clear()
+        elif held < len(positions):
+            while len(positions) > held + 1:
+                positions.popleft()
+            self.spool.commit(positions.popleft())
+
+    def _retry_later(self, retry, replay=False):
+        """Waits out the next backoff step, returns it
+
+        After a failed publish the report may have lost what it held, so
+        with replay everything not yet committed to the spool is read again.
+        A failed flush leaves the report holding its samples.
+        """
+        retry = min(max(2 * retry, 1), MAX_RETRY)
+        _log.info("Report {}: retrying in {}s".format(self.name, retry))
+        with self._lock:
+            if replay:
+                self._read_position = None
+                self._positions.clear()
+            self._busy = False
+            self._room.notify_all()
+            self._ready.wait_for(lambda: self._closing, retry)
+        return retry
+
+    def _pending(self):
+        if self.spool is not None:
+            return self.spool.pending(self._read_position)
+        return bool(self._queue)
+
+    def depth(self):
+        """Samples waiting to be published, or bytes for a spool"""
+        if self.spool is not None:
+            return self.spool.pending_bytes()
+        return len(self._queue)
+
+    def metrics(self):
+        latencies = list(self.latencies)
+        return {
+            'depth': self.depth(),
+            'max_depth': self.max_depth,
+            'enqueued': self.enqueued,
+            'published': self.published,
+            'failed': self.failed,
+            'dropped': self.dropped,
+            'coalesced': self.coalesced,
+            'last_latency': self.last_latency,
+            'latency_p50': _percentile(latencies, 0.5),
+            'latency_p95': _percentile(latencies, 0.95),
+            'spool_evicted_bytes': self.spool.evicted_bytes if self.spool is not None else 0,
+        }
+
+    def flush(self, timeout=None):
+        """Waits until the queue is drained and the worker has flushed the report"""
+        end = None if timeout is None else time.monotonic() + timeout
+        with self._lock:
+            self._flush_requested = True
+            self._ready.notify()
+            while (self._pending() or self._busy or self._flush_requested) and self._thread.is_alive():
+                remaining = None if end is None else end - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._room.wait(remaining)
+        return True
+
+    def close(self, timeout=10):
+        """Publishes what is queued, within the timeout, then stops the worker"""
+        with self._lock:
+            self._closing = True
+            self._ready.notify()
+            self._room.notify_all()
+        self._thread.join(timeout)
+        if self._thread.is_alive():
+            _log.warning("Report {} closed with {} samples unpublished".format(self.name, self.depth()))
+        self.report.close()
+
+
+#-----------------
+# Exported symbols
+#-----------------
+__all__ = ["PVReportChannel", "OVERFLOW_POLICIES"]
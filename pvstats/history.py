@@ -0,0 +1,242 @@
+#!/usr/bin/env python
+
+# Copyright 2018 Paul Archer
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+import mmap
+import os
+import struct
+import sys
+from decimal import Decimal
+
+from pvstats.numeric import ScaledInt
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+import logging
+
+_log = logging.getLogger(__name__)
+
+_MAGIC = b'PVHIST1\0'
+
+# Magic, byte order, capacity, field count, field name bytes, head, count, sequence
+_HEADER = struct.Struct('=8sc7xQIIQQQ')
+_HEAD_OFFSET = 32
+
+_NUMBERS = (int, float, Decimal, ScaledInt)
+
+_NAN = float('nan')
+
+
+def numeric_fields(sample):
+    """The keys of a sample the history stores"""
+    return [k for k, v in sample.items()
+            if isinstance(v, _NUMBERS) and not isinstance(v, bool) and k != 'timestamp'
+            and not k.startswith(('tag_', 'date_'))]
+
+
+class _Times():
+    """Sequence of the timestamps in ring order, for bisect"""
+
+    def __init__(self, history):
+        self.history = history
+        self.count = history.count
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, i):
+        return self.history._times[self.history._physical(i)]
+
+
+class RingHistory():
+    """Fixed size columnar ring buffer of samples in a memory mapped file
+
+    The file holds a header, the field names and one float64 column per
+    field plus a timestamp column, each `capacity` long. Appending
+    overwrites the oldest sample once the ring is full, so the file size
+    is fixed when it is created. Missing values are stored as NaN.
+
+    Column reads are zero copy views of the mapping, memoryviews or NumPy
+    arrays when NumPy is installed, unless the range wraps around the end
+    of the ring. A sequence number in the header is odd while an append is
+    in progress, readers in other processes can use it to retry a read
+    that raced a write.
+    """
+
+    def __init__(self, path, fields=None, capacity=8640, readonly=False):
+        self.path = path
+        self.readonly = readonly
+        exists = os.path.exists(path)
+        if not exists:
+            if readonly or fields is None:
+                raise FileNotFoundError(path)
+            self._create(path, list(fields), int(capacity))
+
+        with open(path, 'rb' if readonly else 'r+b') as f:
+            self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ if readonly else mmap.ACCESS_WRITE)
+
+        magic, order, self.capacity, nfields, names_len, _, _, _ = _HEADER.unpack_from(self._mm, 0)
+        if magic != _MAGIC:
+            raise ValueError("{} is not a pvstats history file".format(path))
+        if order != self._order():
+            raise ValueError("{} was written with a different byte order".format(path))
+        self.fields = json.loads(bytes(self._mm[_HEADER.size:_HEADER.size + names_len]).decode('utf-8'))
+        if fields is not None and list(fields) != self.fields:
+            _log.warning("History {} keeps its fields {}, delete it to change them".format(path, self.fields))
+
+        self.index = {name: i for i, name in enumerate(self.fields)}
+        start = self._columns_offset(names_len)
+        size = 8 * self.capacity
+        view = memoryview(self._mm)
+        self._times = view[start:start + size].cast('d')
+        self._columns = [view[start + (i + 1) * size:start + (i + 2) * size].cast('d')
+                         for i in range(len(self.fields))]
+
+    @staticmethod
+    def _order():
+        return b'<' if sys.byteorder == 'little' else b'>'
+
+    @staticmethod
+    def _columns_offset(names_len):
+        # Align the columns to 8 bytes
+        return (_HEADER.size + names_len + 7) & ~7
+
+    @classmethod
+    def _create(cls, path, fields, capacity):
+        names = json.dumps(fields).encode('utf-8')
+        size = cls._columns_offset(len(names)) + 8 * capacity * (len(fields) + 1)
+        tmp = path + '.tmp'
+        with open(tmp, 'wb') as f:
+            f.write(_HEADER.pack(_MAGIC, cls._order(), capacity, len(fields), len(names), 0, 0, 0))
+            f.write(names)
+            f.truncate(size)
+        os.replace(tmp, path)
+
+    def _state(self):
+        return struct.unpack_from('=QQQ', self._mm, _HEAD_OFFSET)
+
+    @property
+    def count(self):
+        return self._state()[1]
+
+    def __len__(self):
+        return self.count
+
+    def _physical(self, i):
+        """Slot of the i-th oldest sample"""
+        head, count, _ = self._state()
+        return (head - count + i) % self.capacity
+
+    def append(self, timestamp, values):
+        """Stores a sample, values maps field names to numbers"""
+        # Converted first, a value that is not a number leaves the file untouched
+        timestamp = float(timestamp)
+        row = [values.get(name) for name in self.fields]
+        row = [_NAN if v is None else float(v) for v in row]
+        head, count, sequence = self._state()
+        struct.pack_into('=Q', self._mm, _HEAD_OFFSET + 16, sequence + 1)
+        self._times[head] = timestamp
+        for column, v in zip(self._columns, row):
+            column[head] = v
+        struct.pack_into('=QQQ', self._mm, _HEAD_OFFSET,
+                         (head + 1) % self.capacity, min(count + 1, self.capacity), sequence + 2)
+
+    def sequence(self):
+        """Append sequence number, odd while an append is in progress"""
+        return self._state()[2]
+
+    def search(self, start=None, end=None):
+        """Logical index range of the samples with start <= timestamp < end"""
+        times = _Times(self)
+        lo = 0 if start is None else _bisect(times, start)
+        hi = times.count if end is None else _bisect(times, end)
+        return lo, max(lo, hi)
+
+    def _slices(self, lo, hi):
+        """Physical slot ranges of a logical range, two when it wraps"""
+        if lo >= hi:
+            return []
+        a = self._physical(lo)
+        b = a + (hi - lo)
+        if b <= self.capacity:
+            return [(a, b)]
+        return [(a, self.capacity), (0, b - self.capacity)]
+
+    def _read(self, column, lo, hi):
+        parts = [column[a:b] for a, b in self._slices(lo, hi)]
+        if numpy is not None:
+            arrays = [numpy.frombuffer(p, dtype=numpy.float64) for p in parts]
+            if len(arrays) == 1:
+                return arrays[0]
+            return numpy.concatenate(arrays) if arrays else numpy.empty(0)
+        if len(parts) == 1:
+            return parts[0]
+        return [v for p in parts for v in p]
+
+    def timestamps(self, start=None, end=None):
+        """Sample times between start and end, oldest first"""
+        return self._read(self._times, *self.search(start, end))
+
+    def column(self, name, start=None, end=None):
+        """Values of a field between start and end, oldest first"""
+        return self._read(self._columns[self.index[name]], *self.search(start, end))
+
+    def latest(self, n=1):
+        """Timestamps and {field: values} of the n newest samples"""
+        count = self.count
+        lo = max(0, count - n)
+        return (self._read(self._times, lo, count),
+                {name: self._read(column, lo, count) for name, column in zip(self.fields, self._columns)})
+
+    def flush(self):
+        if not self.readonly:
+            self._mm.flush()
+
+    def close(self):
+        """Flushes and unmaps the file
+
+        While views returned by column(), timestamps() or latest() are still
+        alive the mapping stays open, it is unmapped once they are garbage
+        collected.
+        """
+        self.flush()
+        try:
+            self._times.release()
+            for column in self._columns:
+                column.release()
+            self._mm.close()
+        except BufferError:
+            pass
+
+
+def _bisect(times, t):
+    lo, hi = 0, len(times)
+    while lo < hi:
+        mid = (lo + hi) // 2
+        if times[mid] < t:
+            lo = mid + 1
+        else:
+            hi = mid
+    return lo
+
+
+#-----------------
+# Exported symbols
+#-----------------
+__all__ = ["RingHistory", "numeric_fields"]
@@ -0,0 +1,186 @@
+#!/usr/bin/env python
+
+# Copyright 2018 Paul Archer
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from decimal import Decimal
+
+# Numeric representations of the sample values
+NUMERIC_MODES = ('decimal', 'float', 'scaled-int')
+
+
+class ScaledInt():
+    """An integer register value stored with its power of ten scale
+
+    The value is ``raw * 10 ** exponent``. Addition and multiplication stay
+    exact integers, anything else falls back to float.
+    """
+    __slots__ = ('raw', 'exponent')
+
+    def __init__(self, raw, exponent=0):
+        self.raw = raw
+        self.exponent = exponent
+
+    @classmethod
+    def from_value(cls, value):
+        sign, digits, exponent = Decimal(str(value)).as_tuple()
+        raw = int(''.join(map(str, digits)) or 0)
+        return cls(-raw if sign else raw, exponent)
+
+    def to_decimal(self):
+        return Decimal(self.raw).scaleb(self.exponent)
+
+    def _align(self, other):
+        """Returns both raw values at the smaller exponent"""
+        exponent = min(self.exponent, other.exponent)
+        return (self.raw * 10 ** (self.exponent - exponent),
+                other.raw * 10 ** (other.exponent - exponent), exponent)
+
+    def __float__(self):
+        if self.exponent < 0:
+            return self.raw / 10 ** -self.exponent
+        return float(self.raw * 10 ** self.exponent)
+
+    def __int__(self):
+        return int(self.to_decimal())
+
+    def __round__(self, ndigits=None):
+        return round(self.to_decimal(), ndigits)
+
+    def __bool__(self):
+        return self.raw != 0
+
+    def __neg__(self):
+        return ScaledInt(-self.raw, self.exponent)
+
+    def __abs__(self):
+        return ScaledInt(abs(self.raw), self.exponent)
+
+    def __add__(self, other):
+        if isinstance(other, int):
+            other = ScaledInt(other)
+        if isinstance(other, ScaledInt):
+            a, b, exponent = self._align(other)
+            return ScaledInt(a + b, exponent)
+        return float(self) + other
+
+    __radd__ = __add__
+
+    def __sub__(self, other):
+        return self + -other
+
+    def __rsub__(self, other):
+        return -self + other
+
+    def __mul__(self, other):
+        if isinstance(other, int):
+            return ScaledInt(self.raw * other, self.exponent)
+        if isinstance(other, ScaledInt):
+            return ScaledInt(self.raw * other.raw, self.exponent + other.exponent)
+        return float(self) * other
+
+    __rmul__ = __mul__
+
+    def __truediv__(self, other):
+        return float(self) / float(other)
+
+    def __rtruediv__(self, other):
+        return float(other) / float(self)
+
+    def __eq__(self, other):
+        if isinstance(other, ScaledInt):
+            a, b, _ = self._align(other)
+            return a == b
+        try:
+            return float(self) == float(other)
+        except (TypeError, ValueError):
+            return NotImplemented
+
+    def __lt__(self, other):
+        return float(self) < float(other)
+
+    def __le__(self, other):
+        return float(self) <= float(other)
+
+    def __gt__(self, other):
+        return float(self) > float(other)
+
+    def __ge__(self, other):
+        return float(self) >= float(other)
+
+    def __hash__(self):
+        return hash(float(self))
+
+    def __str__(self):
+        return str(self.to_decimal())
+
+    def __repr__(self):
+        return "ScaledInt({}, {})".format(self.raw, self.exponent)
+
+
+class _Scale():
+    """Multiplying a raw integer by this yields a ScaledInt"""
+    __slots__ = ('exponent',)
+
+    def __init__(self, exponent):
+        self.exponent = exponent
+
+    def __rmul__(self, raw):
+        return ScaledInt(raw, self.exponent)
+
+
+def scale_exponent(scale):
+    """Returns the power of ten of a register scale, or None if it is not one"""
+    sign, digits, exponent = Decimal(str(scale)).normalize().as_tuple()
+    if sign or digits != (1,):
+        return None
+    return exponent
+
+
+def scale_factor(scale, mode):
+    """Returns the factor a raw register value is multiplied by in the given mode"""
+    if mode == 'decimal':
+        # The register maps already hold Decimal scales
+        return scale
+    if mode == 'scaled-int':
+        exponent = scale_exponent(scale)
+        if exponent is not None:
+            return _Scale(exponent)
+    elif mode != 'float':
+        raise ValueError("Unknown numeric mode {}".format(mode))
+    return float(scale)
+
+
+def number(value, mode):
+    """Converts a value from a non Modbus source to the given mode"""
+    if mode == 'decimal':
+        return value if isinstance(value, Decimal) else Decimal(value)
+    if mode == 'float':
+        return float(value)
+    if mode == 'scaled-int':
+        return ScaledInt.from_value(value)
+    raise ValueError("Unknown numeric mode {}".format(mode))
+
+
+def json_default(value):
+    """json.dumps() default, ScaledInt as a number and anything else as a string"""
+    if isinstance(value, ScaledInt):
+        return float(value)
+    return str(value)
+
+
+#-----------------
+# Exported symbols
+#-----------------
+__all__ = ["ScaledInt", "NUMERIC_MODES", "scale_factor", "scale_exponent", "number", "json_default"]
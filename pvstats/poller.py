@@ -0,0 +1,268 @@
+#!/usr/bin/env python
+
+# Copyright 2018 Paul Archer
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import asyncio
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+
+from pymodbus.exceptions import ModbusIOException, ConnectionException
+
+from pvstats.pvinverter.factory import PVInverterFactory
+from pvstats.report import PVReportFactory
+from pvstats.serialize import Pretty
+
+import logging
+
+_log = logging.getLogger(__name__)
+
+# Read errors after which the connection is dropped and reopened
+_CONNECTION_ERRORS = (ModbusIOException, ConnectionException, OSError, asyncio.TimeoutError)
+
+
+def inverter_configs(cfg):
+    """Returns the list of inverter configurations
+
+    Supports both the fleet style "inverters" list and the original single
+    "inverter" entry. Each entry inherits the global sample period unless it
+    sets its own, likewise for the numeric mode.
+    """
+    if cfg.get('inverters') is not None:
+        entries = cfg['inverters']
+    else:
+        entries = [cfg['inverter']]
+
+    configs = []
+    for entry in entries:
+        entry = dict(entry)
+        entry.setdefault('sample_period', cfg['sample_period'])
+        if 'numeric' in cfg:
+            entry.setdefault('numeric', cfg['numeric'])
+        configs.append(entry)
+    return configs
+
+
+class PVPoller():
+    """Polls a single inverter on its own schedule"""
+
+    def __init__(self, inverter, cfg):
+        self.inverter = inverter
+        self.sample_period = float(cfg['sample_period'])
+        self.tag = cfg.get('name')
+        self.name = self.tag or "{}@{}".format(cfg['model'], cfg.get('host', cfg.get('dev', '')))
+
+        # Error state
+        self.errors = 0
+        self.last_error = None
+        self.last_sample = None
+
+    def _sample(self):
+        """Read and return a snapshot of the registers (blocking)
+
+        The connection is kept open across samples and only dropped, to be
+        reopened on the next sample, when a read fails.
+        """
+        self.inverter.ensure_connected()
+        try:
+            self.inverter.read()
+        except _CONNECTION_ERRORS:
+            self.inverter.connection_failed()
+            raise
+        self.inverter.connection_ok()
+        registers = dict(self.inverter.registers)
+
+        if self.tag is not None:
+            registers['tag_inverter'] = self.tag
+        return registers
+
+    async def _sample_async(self):
+        """Read and return a snapshot of the registers (non-blocking)"""
+        await self.inverter.ensure_connected_async()
+        try:
+            await self.inverter.read_async()
+        except _CONNECTION_ERRORS:
+            await self.inverter.connection_failed_async()
+            raise
+        self.inverter.connection_ok()
+        registers = dict(self.inverter.registers)
+
+        if self.tag is not None:
+            registers['tag_inverter'] = self.tag
+        return registers
+
+    async def _disconnect(self, engine):
+        if self.inverter.is_async:
+            await self.inverter.disconnect_async()
+        else:
+            await asyncio.get_running_loop().run_in_executor(engine.read_executor, self.inverter.disconnect)
+
+    async def run(self, engine):
+        loop = asyncio.get_running_loop()
+        while True:
+            if not engine.awake.is_set():
+                # No point holding the connection open overnight
+                await self._disconnect(engine)
+                await engine.awake.wait()
+
+            tstart = loop.time()
+            try:
+                # Grab the data from the inverter
+                if self.inverter.is_async:
+                    registers = await self._sample_async()
+                else:
+                    registers = await loop.run_in_executor(engine.read_executor, self._sample)
+
+                # Log it
+                _log.debug("%s", Pretty(registers))
+
+                # Publish it
+                await loop.run_in_executor(engine.publish_executor, engine.publish, registers)
+
+                self.errors = 0
+                self.last_error = None
+                self.last_sample = time.time()
+            except (ModbusIOException, ConnectionException) as err:
+                self.errors += 1
+                self.last_error = err
+                _log.debug(traceback.format_exc())
+                _log.warning("{}: Error = {} ({} in a row)".format(self.name, err, self.errors))
+            except Exception as err:
+                self.last_error = err
+                _log.debug(traceback.format_exc())
+                _log.debug("{}: Ignoring = {}".format(self.name, err))
+
+            delay = max(tstart + self.sample_period - loop.time(), 0)
+            if self.inverter.idle_close is not None and delay >= self.inverter.idle_close:
+                await self._disconnect(engine)
+            await asyncio.sleep(delay)
+
+
+class PVPollEngine():
+    """Runs every inverter poller concurrently on one event loop
+
+    All pollers share the report channels. Inverter reads run in a thread pool
+    so a slow or dead inverter only delays itself. Samples are handed to the
+    reports on a single worker thread, each report channel then publishes
+    from its own queue so a slow report never holds up the others.
+    """
+
+    def __init__(self, pollers, reports, night_delay=None, night_check=60, metrics_period=300):
+        self.pollers = pollers
+        self.reports = reports
+        self.night_delay = night_delay
+        self.night_check = night_check
+        self.metrics_period = metrics_period
+
+        self.read_executor = ThreadPoolExecutor(max_workers=max(len(pollers), 1),
+                                                thread_name_prefix='pvstats-read')
+        self.publish_executor = ThreadPoolExecutor(max_workers=1,
+                                                   thread_name_prefix='pvstats-publish')
+        self.awake = None
+
+    def publish(self, registers):
+        for rpt in self.reports:
+            try:
+                rpt.publish(registers)
+            except Exception as err:
+                _log.debug(traceback.format_exc())
+                _log.error("Report {} failed: {}".format(type(rpt).__name__, err))
+
+    async def _night_watch(self):
+        while True:
+            delay = self.night_delay() if self.night_delay is not None else 0
+            if delay:
+                self.awake.clear()
+                await asyncio.sleep(delay)
+                self.awake.set()
+            else:
+                await asyncio.sleep(self.night_check)
+
+    async def _log_metrics(self):
+        while True:
+            await asyncio.sleep(self.metrics_period)
+            for name, m in self.metrics().items():
+                _log.info("Report {}: {depth} queued (max {max_depth}), {published} published, "
+                          "{failed} failed, {dropped} dropped, {coalesced} coalesced".format(name, **m))
+
+    async def run(self):
+        self.awake = asyncio.Event()
+        self.awake.set()
+
+        tasks = [asyncio.ensure_future(p.run(self)) for p in self.pollers]
+        tasks.append(asyncio.ensure_future(self._night_watch()))
+        if self.metrics_period:
+            tasks.append(asyncio.ensure_future(self._log_metrics()))
+        try:
+            await asyncio.gather(*tasks)
+        finally:
+            for t in tasks:
+                t.cancel()
+            for p in self.pollers:
+                await p._disconnect(self)
+            await asyncio.get_running_loop().run_in_executor(self.publish_executor, self.close_reports)
+
+    def close_reports(self):
+        for rpt in self.reports:
+            try:
+                rpt.close()
+            except Exception as err:
+                _log.error("Closing report {} failed: {}".format(type(rpt).__name__, err))
+
+    def metrics(self):
+        """Queue metrics of the report channels, by name, numbered when names repeat"""
+        out = {}
+        for rpt in self.reports:
+            if hasattr(rpt, 'metrics'):
+                name = key = getattr(rpt, 'name', type(rpt).__name__)
+                n = 1
+                while key in out:
+                    n += 1
+                    key = '{}#{}'.format(name, n)
+                out[key] = rpt.metrics()
+        return out
+
+    def start(self):
+        asyncio.run(self.run())
+
+
+def build_engine(cfg, night_delay=None):
+    """The poll engine of a configuration, a poller per inverter and its report channels"""
+    # Get a PV inverter client for each inverter in the fleet
+    pollers = []
+    for inv in inverter_configs(cfg):
+        pollers.append(PVPoller(PVInverterFactory(inv['model'], inv), inv))
+
+    # A spool directory is named after its report, it must not be shared
+    names = [rpt.get('name', rpt['type']) for rpt in cfg['reports']]
+    for rpt, name in zip(cfg['reports'], names):
+        if rpt.get('spool') and names.count(name) > 1:
+            raise ValueError("Spooled report {} shares its name with another report, give each a unique 'name'".format(name))
+
+    # Create the report channels, shared by every inverter
+    reports = []
+    for rpt in cfg['reports']:
+        _log.debug("%s", Pretty(rpt))
+        r = PVReportFactory(rpt)
+        if r != None:
+            reports.append(r)
+
+    return PVPollEngine(pollers, reports, night_delay=night_delay)
+
+
+#-----------------
+# Exported symbols
+#-----------------
+__all__ = ["PVPoller", "PVPollEngine", "inverter_configs", "build_engine"]
@@ -16,12 +16,46 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import asyncio
+import time
+
 from pymodbus.constants import Defaults
 from pymodbus.client.sync import ModbusTcpClient
 from pymodbus.transaction import ModbusSocketFramer
+from pymodbus.exceptions import ConnectionException
+
+import logging
+
+_logger = logging.getLogger(__name__)
 
 
 class BasePVInverter(object):
+    """Base inverter with a persistent connection lifecycle
+
+    The pollers call ensure_connected() before each read, which only
+    connects when there is no live connection, and connection_failed() when
+    a read fails, which drops the connection. Consecutive failures back off
+    exponentially from reconnect_min up to reconnect_max seconds.
+    """
+    # Set by inverters whose async methods read without blocking the event loop
+    is_async = False
+
+    # Representation of the sample values: decimal, float or scaled-int
+    numeric = 'decimal'
+
+    # Reconnect backoff in seconds
+    reconnect_min = 1
+    reconnect_max = 300
+
+    # Close the connection when the next read is at least this many seconds
+    # away, None keeps it open
+    idle_close = None
+
+    # Connection state
+    _connected = False
+    _failures = 0
+    _retry_at = 0
+
     def __init__(self):
         self.registers = {}
 
@@ -34,6 +68,89 @@ class BasePVInverter(object):
     def close(self):
         pass
 
+    async def connect_async(self):
+        await asyncio.get_running_loop().run_in_executor(None, self.connect)
+
+    async def read_async(self):
+        await asyncio.get_running_loop().run_in_executor(None, self.read)
+
+    async def close_async(self):
+        self.close()
+
+    def is_connected(self):
+        """True while the connection is believed to be usable"""
+        return self._connected
+
+    def _check_backoff(self):
+        wait = self._retry_at - time.monotonic()
+        if wait > 0:
+            raise ConnectionException("Reconnecting in {:.1f}s after {} failures".format(wait, self._failures))
+
+    def _connected_check(self):
+        self._connected = True
+        if not self.is_connected():
+            self.connection_failed()
+            raise ConnectionException("Unable to connect")
+
+    def ensure_connected(self):
+        """Connects unless already connected, honouring the reconnect backoff"""
+        if self.is_connected():
+            return
+        self._check_backoff()
+        self.disconnect()
+        try:
+            self.connect()
+        except Exception:
+            self.connection_failed()
+            raise
+        self._connected_check()
+
+    async def ensure_connected_async(self):
+        if self.is_connected():
+            return
+        self._check_backoff()
+        await self.disconnect_async()
+        try:
+            await self.connect_async()
+        except Exception:
+            await self.connection_failed_async()
+            raise
+        self._connected_check()
+
+    def connection_ok(self):
+        """Resets the backoff after a successful read"""
+        self._failures = 0
+        self._retry_at = 0
+
+    def _schedule_retry(self):
+        self._failures += 1
+        backoff = min(self.reconnect_min * 2**(self._failures - 1), self.reconnect_max)
+        self._retry_at = time.monotonic() + backoff
+
+    def connection_failed(self):
+        """Drops the connection after a failure and backs off the reconnect"""
+        self._schedule_retry()
+        self.disconnect()
+
+    async def connection_failed_async(self):
+        self._schedule_retry()
+        await self.disconnect_async()
+
+    def disconnect(self):
+        """Closes the connection, ignoring errors from a dead transport"""
+        self._connected = False
+        try:
+            self.close()
+        except Exception as err:
+            _logger.debug("Close failed: {}".format(err))
+
+    async def disconnect_async(self):
+        self._connected = False
+        try:
+            await self.close_async()
+        except Exception as err:
+            _logger.debug("Close failed: {}".format(err))
+
 
 #-----------------
 # Exported symbols
@@ -0,0 +1,149 @@
+#!/usr/bin/env python
+
+# Copyright 2018 Paul Archer
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Raw register captures of Modbus inverters
+
+A capture file holds a header, the JSON description of the inverter, then
+one record per read cycle: the time of the read and the raw register
+blocks read, as sent on the wire. Run:
+    python -m pvstats.pvinverter.capture <file>
+to summarise a capture.
+"""
+
+import argparse
+import json
+import os
+import struct
+from datetime import datetime
+
+import logging
+
+_logger = logging.getLogger(__name__)
+
+_MAGIC = b'PVCAP1\0\0'
+_HEADER = struct.Struct('<8sI')
+
+# Cycle record: read time (seconds), block count
+_CYCLE = struct.Struct('<dH')
+# Block record: Modbus function code, start address, register count
+_BLOCK = struct.Struct('<BHH')
+
+_FUNCTION_CODES = {'holding': 0x03, 'input': 0x04}
+_FUNCTIONS = {code: func for func, code in _FUNCTION_CODES.items()}
+
+
+def _raw(registers):
+    """Big endian register data of a block of words or raw bytes"""
+    if isinstance(registers, (bytes, bytearray, memoryview)):
+        return bytes(registers)
+    return struct.pack('>{}H'.format(len(registers)), *registers)
+
+
+class CaptureWriter():
+    """Appends the register blocks of each read cycle to a capture file
+
+    info describes the inverter, e.g. its model, and is written to the
+    header of a new file. Each cycle is flushed once written.
+    """
+
+    def __init__(self, path, info=None):
+        self.path = path
+        self._file = open(path, 'ab')
+        if self._file.tell() == 0:
+            header = json.dumps(dict(info or {}, created=datetime.now().isoformat(timespec='seconds')))
+            header = header.encode('utf-8')
+            self._file.write(_HEADER.pack(_MAGIC, len(header)) + header)
+            self._file.flush()
+
+    def write(self, timestamp, blocks):
+        """Records a read cycle of (func, address, registers) blocks"""
+        parts = [_CYCLE.pack(timestamp, len(blocks))]
+        for func, address, registers in blocks:
+            data = _raw(registers)
+            parts += [_BLOCK.pack(_FUNCTION_CODES[func], address, len(data) // 2), data]
+        self._file.write(b''.join(parts))
+        self._file.flush()
+
+    def close(self):
+        self._file.close()
+
+
+class CaptureReader():
+    """Reads the read cycles of a capture file back
+
+    Iterating yields (timestamp, [(func, address, data)]) for each cycle,
+    data being the big endian register bytes. A torn trailing cycle, from a
+    capture that was cut short, ends the iteration.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            magic, length = _HEADER.unpack(f.read(_HEADER.size))
+            if magic != _MAGIC:
+                raise ValueError("{} is not a pvstats register capture".format(path))
+            self.info = json.loads(f.read(length).decode('utf-8'))
+        self._start = _HEADER.size + length
+
+    def __iter__(self):
+        with open(self.path, 'rb') as f:
+            f.seek(self._start)
+            while True:
+                record = f.read(_CYCLE.size)
+                if len(record) < _CYCLE.size:
+                    return
+                timestamp, count = _CYCLE.unpack(record)
+                blocks = []
+                for _ in range(count):
+                    record = f.read(_BLOCK.size)
+                    if len(record) < _BLOCK.size:
+                        return
+                    code, address, length = _BLOCK.unpack(record)
+                    data = f.read(2 * length)
+                    if len(data) < 2 * length:
+                        return
+                    blocks.append((_FUNCTIONS[code], address, data))
+                yield timestamp, blocks
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("path", help="Capture file")
+    args = parser.parse_args()
+
+    capture = CaptureReader(args.path)
+    cycles = 0
+    registers = 0
+    first = last = None
+    for timestamp, blocks in capture:
+        cycles += 1
+        registers += sum(len(data) // 2 for _, _, data in blocks)
+        first = timestamp if first is None else first
+        last = timestamp
+    print(json.dumps(capture.info, sort_keys=True))
+    print("{} cycles, {} registers, {} bytes".format(cycles, registers, os.path.getsize(args.path)))
+    if cycles:
+        print("{} to {}".format(datetime.fromtimestamp(first), datetime.fromtimestamp(last)))
+
+
+#-----------------
+# Exported symbols
+#-----------------
+__all__ = ["CaptureWriter", "CaptureReader"]
+
+
+if __name__ == "__main__":
+    main()
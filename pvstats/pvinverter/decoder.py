@@ -0,0 +1,223 @@
+#!/usr/bin/env python
+
+# Copyright 2018 Paul Archer
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import struct
+
+from pvstats.numeric import scale_factor
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# Register type: (16 bit words, struct code)
+REGISTER_TYPES = {
+  'uint16':  (1, 'H'),
+  'int16':   (1, 'h'),
+  'uint32':  (2, 'I'),
+  'int32':   (2, 'i'),
+  'float32': (2, 'f'),
+  'uint64':  (4, 'Q'),
+  'int64':   (4, 'q'),
+  'float64': (4, 'd'),
+}
+
+
+def register_words(reg):
+    """Number of 16 bit words a register map entry occupies"""
+    return REGISTER_TYPES[reg.get('type', 'uint16')][0]
+
+
+def block_registers(registers, address, count):
+    """The register map entries lying wholly inside the block"""
+    return {k: reg for k, reg in registers.items()
+            if address <= int(k) - 1 and int(k) - 1 + register_words(reg) <= address + count}
+
+
+def _byteswap(word):
+    return ((word & 0xff) << 8) | (word >> 8)
+
+
+class BlockDecoder():
+    """Decodes one planned block of registers in a single pass
+
+    The register map section is compiled once into a struct format covering
+    the whole block, unmapped words become pad bytes, plus flat tables of the
+    tuple index, name and scale of each value. Decoding is then one
+    struct.unpack_from call and a loop over the precomputed entries.
+
+    Values in Modbus (big endian) byte and word order are unpacked directly
+    by the struct format. Multi-word values with a little endian word order
+    or byte order, set per entry with 'word_order'/'byte_order' or for the
+    whole map with the defaults, are unpacked as words and joined.
+
+    The scales are converted up front for the numeric mode, so decoding
+    yields Decimal, float or ScaledInt values without any conversion pass.
+    """
+
+    def __init__(self, registers, address, count, word_order='big', byte_order='big', numeric='decimal'):
+        self.address = address
+        self.count = count
+        self.word_order = word_order
+        self.byte_order = byte_order
+
+        fields = []
+        for k, reg in registers.items():
+            offset = int(k) - 1 - address
+            words = register_words(reg)
+            if 0 <= offset and offset + words <= count:
+                fields.append((offset, words, reg))
+            elif offset < count and offset + words > 0:
+                raise ValueError("Register {} is split across read blocks".format(reg['name']))
+        fields.sort(key=lambda f: f[0])
+
+        fmt = '>'
+        index = 0
+        position = 0
+        self.direct = []
+        self.joined = []
+        for offset, words, reg in fields:
+            if offset < position:
+                raise ValueError("Register {} overlaps the previous register".format(reg['name']))
+            if offset > position:
+                fmt += '{}x'.format(2 * (offset - position))
+
+            reg_type = reg.get('type', 'uint16')
+            code = REGISTER_TYPES[reg_type][1]
+            if reg_type.startswith('float'):
+                scale = float(reg['scale'])
+            else:
+                scale = scale_factor(reg['scale'], numeric)
+            little_words = reg.get('word_order', word_order) == 'little'
+            swap_bytes = reg.get('byte_order', byte_order) == 'little'
+
+            if (words == 1 or not little_words) and not swap_bytes:
+                fmt += code
+                self.direct.append((reg['name'], index, scale))
+                index += 1
+            else:
+                fmt += 'H' * words
+                # Integers are joined with shifts, floats need a repack
+                half = 1 << (16 * words - 1) if reg_type.startswith('int') else 0
+                float_code = code if reg_type.startswith('float') else None
+                self.joined.append((reg['name'], index, words, little_words, swap_bytes, half, float_code, scale))
+                index += words
+            position = offset + words
+
+        self._struct = struct.Struct(fmt)
+        self._words = struct.Struct('>{}H'.format(count))
+        self.fields = fields
+        self.names = [f[2]['name'] for f in fields]
+        self._np_plan = None
+
+    def unpack(self, data):
+        """Returns the raw mapped values as a tuple, data may be bytes or words"""
+        if not isinstance(data, (bytes, bytearray, memoryview)):
+            data = self._words.pack(*data)
+        return self._struct.unpack_from(data)
+
+    def decode(self, data, out):
+        """Decodes a block into the out dict"""
+        vals = self.unpack(data)
+        for name, i, scale in self.direct:
+            out[name] = vals[i] * scale
+        for name, i, words, little_words, swap_bytes, half, float_code, scale in self.joined:
+            parts = vals[i:i + words]
+            if swap_bytes:
+                parts = [_byteswap(w) for w in parts]
+            if little_words:
+                parts = parts[::-1]
+            v = 0
+            for w in parts:
+                v = (v << 16) | w
+            if float_code is not None:
+                v = struct.unpack('>' + float_code, v.to_bytes(2 * words, 'big'))[0]
+            elif half and v >= half:
+                v -= half << 1
+            out[name] = v * scale
+        return out
+
+    def _compile_numpy(self):
+        """Per field word index, shift, byte swap and type tables"""
+        n = len(self.fields)
+        index = numpy.full((n, 4), self.count, dtype=numpy.intp)
+        shift = numpy.zeros((n, 4), dtype=numpy.uint64)
+        swap = numpy.zeros((n, 4), dtype=bool)
+        half = numpy.zeros(n, dtype=numpy.int64)
+        unsigned = numpy.zeros(n, dtype=bool)
+        floats = numpy.zeros(n, dtype=bool)
+        doubles = numpy.zeros(n, dtype=bool)
+        scales = numpy.zeros(n)
+        for f, (offset, words, reg) in enumerate(self.fields):
+            reg_type = reg.get('type', 'uint16')
+            little_words = reg.get('word_order', self.word_order) == 'little'
+            for k in range(words):
+                # Index the words most significant first
+                index[f, k] = offset + (words - 1 - k if little_words else k)
+                shift[f, k] = 16 * (words - 1 - k)
+            swap[f, :] = reg.get('byte_order', self.byte_order) == 'little'
+            bits = 16 * words
+            if reg_type.startswith('int') and bits < 64:
+                half[f] = 1 << (bits - 1)
+            unsigned[f] = reg_type.startswith('uint')
+            floats[f] = reg_type == 'float32'
+            doubles[f] = reg_type == 'float64'
+            scales[f] = float(reg['scale'])
+        self._np_plan = (index, shift, swap, half, unsigned, floats, doubles, scales)
+
+    def decode_numpy(self, data):
+        """Decodes a block to a float64 array of scaled values, ordered as self.names"""
+        if numpy is None:
+            raise RuntimeError("numpy is not installed")
+        if self._np_plan is None:
+            self._compile_numpy()
+        index, shift, swap, half, unsigned, floats, doubles, scales = self._np_plan
+
+        if isinstance(data, (bytes, bytearray, memoryview)):
+            words = numpy.frombuffer(data, dtype='>u2', count=self.count)
+        else:
+            words = numpy.asarray(data, dtype=numpy.uint16)
+        # Pad with a zero word for the unused word slots
+        words = numpy.append(words.astype(numpy.uint64), numpy.uint64(0))
+
+        w = words[index]
+        w = numpy.where(swap, ((w & numpy.uint64(0xff)) << numpy.uint64(8)) | (w >> numpy.uint64(8)), w)
+        raw = numpy.bitwise_or.reduce(w << shift, axis=1)
+
+        signed = raw.view(numpy.int64)
+        values = numpy.where(unsigned, raw.astype(numpy.float64), ((signed ^ half) - half).astype(numpy.float64))
+        if floats.any():
+            values[floats] = raw[floats].astype(numpy.uint32).view(numpy.float32)
+        if doubles.any():
+            values[doubles] = raw[doubles].view(numpy.float64)
+        return values * scales
+
+
+def compile_decoders(register_map, plan, word_order='big', byte_order='big', numeric='decimal'):
+    """Compiles a BlockDecoder for every block of a read plan, keyed on (func, address)
+
+    Every register lying wholly inside a block is decoded, whichever poll
+    class it belongs to.
+    """
+    return {(func, address): BlockDecoder(block_registers(register_map[func], address, count), address, count,
+                                          word_order=word_order, byte_order=byte_order, numeric=numeric)
+            for func, address, count in plan}
+
+
+#-----------------
+# Exported symbols
+#-----------------
+__all__ = ["BlockDecoder", "compile_decoders", "block_registers", "register_words", "REGISTER_TYPES"]
@@ -27,14 +27,16 @@ from pvstats.pvinverter.fronius import PVInverter_Fronius
 from pvstats.pvinverter.solax import PVInverter_Solax
 from pvstats.pvinverter.sungrow_sg_ktl import PVInverter_SunGrow, PVInverter_SunGrowRTU
 from pvstats.pvinverter.sungrow_sh5k_20 import PVInverter_SunGrow_sh5k_20, PVInverter_SunGrow_sh5k_20RTU
+from pvstats.pvinverter.replay import PVInverter_Replay
 from pvstats.pvinverter.base import BasePVInverter
+from pvstats.numeric import number
 
 from random import randint
 
 
 class PVInverter_Test(BasePVInverter):
-    def __init__(self):
-        pass
+    def __init__(self, cfg=None):
+        self.numeric = (cfg or {}).get('numeric', self.numeric)
 
     def connect(self):
         pass
@@ -42,11 +44,11 @@ class PVInverter_Test(BasePVInverter):
     def read(self):
         self.registers = {
             'timestamp': datetime.now().timestamp(),
-            'daily_pv_energy': Decimal('2300') + randint(0, 1000),
-            'total_pv_power': Decimal('2100') + randint(0, 1000),
-            'internal_temp': Decimal('41.2') + randint(0, 10),
-            'pv1_voltage': Decimal('213') + randint(0, 30),
-            'pv2_voltage': Decimal('125') + randint(0, 20)
+            'daily_pv_energy': number(Decimal('2300') + randint(0, 1000), self.numeric),
+            'total_pv_power': number(Decimal('2100') + randint(0, 1000), self.numeric),
+            'internal_temp': number(Decimal('41.2') + randint(0, 10), self.numeric),
+            'pv1_voltage': number(Decimal('213') + randint(0, 30), self.numeric),
+            'pv2_voltage': number(Decimal('125') + randint(0, 20), self.numeric)
         }
 
     def close(self):
@@ -56,7 +58,7 @@ class PVInverter_Test(BasePVInverter):
 # Factory class for the PV Inverter
 def PVInverterFactory(model, cfg):
     if (model == "test"):
-        return PVInverter_Test()
+        return PVInverter_Test(cfg)
     elif (model == "sungrow-sg-ktl" and cfg['mode'] == 'rtu'):
         return PVInverter_SunGrowRTU(cfg)
     elif (model == "sungrow-sg-ktl"):
@@ -71,6 +73,8 @@ def PVInverterFactory(model, cfg):
     elif (model == "solax"):
         # Assume TCP
         return PVInverter_Solax(cfg)
+    elif (model == "replay"):
+        return PVInverter_Replay(cfg)
     else:
         raise ValueError("Unable to find PVInverter for {}".format(model))
 
@@ -15,9 +15,10 @@
 # limitations under the License.
 
 from pvstats.pvinverter.base import BasePVInverter
+from pvstats.numeric import number
+from pvstats.serialize import Pretty
 
 from datetime import datetime
-from decimal import Decimal
 # import urllib2
 from urllib.request import urlopen
 
@@ -32,6 +33,7 @@ class PVInverter_Fronius(BasePVInverter):
     def __init__(self, cfg, **kwargs):
         self.url = "http://{}:{}/solar_api/v1/GetInverterRealtimeData.cgi?Scope=Device&DeviceID=1&DataCollection=CommonInverterData".format(
             cfg["host"], cfg["port"])
+        self.numeric = cfg.get('numeric', self.numeric)
 
     def connect(self):
         pass
@@ -112,31 +114,26 @@ class PVInverter_Fronius(BasePVInverter):
 
         response = urlopen(self.url).read()
         data = json.loads(response)
-        d = json.dumps(data,
-                       sort_keys=True,
-                       indent=2,
-                       separators=(',', ': '),
-                       default=str)
-        print(d)
+        _logger.debug("%s", Pretty(data))
 
         self.registers = {
             'timestamp':
             datetime.strptime(data['Head']['Timestamp'][:-6],
                               "%Y-%m-%dT%H:%M:%S"),
             'daily_pv_energy':
-            Decimal(data['Body']['Data']['DAY_ENERGY']['Value']),
+            number(data['Body']['Data']['DAY_ENERGY']['Value'], self.numeric),
             'total_pv_power':
-            Decimal(data['Body']['Data']['PAC']['Value']),
+            number(data['Body']['Data']['PAC']['Value'], self.numeric),
             #'internal_temp': Decimal(data['Body']['Data']['T_AMBIENT']['Value']).quantize(Decimal('.1')),
             'internal_temp':
-            Decimal(0),
+            number(0, self.numeric),
             'pv1_voltage':
-            Decimal(data['Body']['Data']['UDC']['Value']),
+            number(data['Body']['Data']['UDC']['Value'], self.numeric),
             'pv2_voltage':
-            Decimal('0')
+            number(0, self.numeric)
         }
 
-        print(self.registers)
+        _logger.debug("%s", Pretty(self.registers))
 
 
 #-----------------
@@ -0,0 +1,210 @@
+#!/usr/bin/env python
+
+# Copyright 2018 Paul Archer
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import select
+import socket
+from time import sleep, time
+
+from pvstats.pvinverter.base import BasePVInverter
+from pvstats.pvinverter.planner import plan_tiers, DEFAULT_MAX_GAP, MAX_REGISTERS
+from pvstats.pvinverter.decoder import compile_decoders
+from pvstats.pvinverter.capture import CaptureWriter
+
+import logging
+
+_logger = logging.getLogger(__name__)
+
+
+def _socket_idle(sock):
+    """True if nothing is waiting to be read on an idle connection
+
+    Between reads a healthy Modbus connection has nothing to read. A
+    readable socket has either been closed by the peer or holds a stale
+    response, both of which need a new connection.
+    """
+    try:
+        readable, _, _ = select.select([sock], [], [], 0)
+    except (OSError, ValueError):
+        return False
+    return not readable
+
+
+class BaseModbusPVInverter(BasePVInverter):
+    """Common register map handling for the Modbus inverters
+
+    Subclasses provide _load_registers() for the blocking client, both read
+    paths decode through the compiled block decoders.
+
+    Registers are read by poll class: 'fast' every cycle, 'slow' every
+    slow_every cycles and 'static' once per connection. Values not read in a
+    cycle keep their last decoded value.
+
+    With 'record' set to a file, the raw blocks of each successful cycle are
+    appended to it for the replay inverter.
+    """
+    # Register ranges the device refuses to serve, {'input': [[first, last]]}
+    forbidden_ranges = {}
+
+    # Seconds to wait before each blocking register read
+    request_interval = 0
+
+    # Default word and byte order of multi-word registers
+    word_order = 'big'
+    byte_order = 'big'
+
+    # Cycles between reads of the 'slow' registers
+    slow_every = 10
+
+    def __init__(self, cfg, register_map):
+        super(BaseModbusPVInverter, self).__init__()
+        self._register_map = register_map
+        self.max_gap = cfg.get('max_gap', DEFAULT_MAX_GAP)
+        self.max_count = cfg.get('max_count', MAX_REGISTERS)
+        self.forbidden_ranges = cfg.get('forbidden_ranges', self.forbidden_ranges)
+        self.request_interval = cfg.get('request_interval', self.request_interval)
+        self.word_order = cfg.get('word_order', self.word_order)
+        self.byte_order = cfg.get('byte_order', self.byte_order)
+        self.numeric = cfg.get('numeric', self.numeric)
+        self.vectorize = cfg.get('decoder') == 'numpy'
+        self.slow_every = max(1, int(cfg.get('slow_every', self.slow_every)))
+        self.idle_close = cfg.get('idle_close', self.idle_close)
+        self.reconnect_min = cfg.get('reconnect_min', self.reconnect_min)
+        self.reconnect_max = cfg.get('reconnect_max', self.reconnect_max)
+        self._plan = None
+        self._decoders = None
+        self._cycle = 0
+        self._static_due = True
+        self._capture = None
+        self._captured = []
+        if cfg.get('record'):
+            self._capture = CaptureWriter(cfg['record'], {'model': cfg.get('model'),
+                                                          'word_order': self.word_order,
+                                                          'byte_order': self.byte_order})
+
+    def is_connected(self):
+        if not self._connected:
+            return False
+        if self.is_async:
+            return self.async_client.is_connected()
+        sock = getattr(self.client, 'socket', None)
+        if isinstance(sock, socket.socket):
+            return _socket_idle(sock)
+        return self.client.is_socket_open()
+
+    def disconnect(self):
+        super(BaseModbusPVInverter, self).disconnect()
+        # pymodbus remembers units that failed to respond and reads their
+        # next response until the timeout expires. After a reconnect that
+        # costs a whole timeout on the first read, so forget them.
+        transaction = getattr(self.client, 'transaction', None)
+        if transaction is not None and hasattr(transaction, '_no_response_devices'):
+            transaction._no_response_devices = []
+
+    def _read_plans(self):
+        """Returns the (func, address, count) blocks of each poll class, compiled once"""
+        if self._plan is None:
+            self._plan = plan_tiers(self._register_map,
+                                    max_count=self.max_count,
+                                    max_gap=self.max_gap,
+                                    forbidden=self.forbidden_ranges)
+            _logger.debug("Read plan: {}".format(self._plan))
+        return self._plan
+
+    def _read_plan(self):
+        """Returns the blocks due to be read this cycle"""
+        plans = self._read_plans()
+        plan = list(plans['fast'])
+        if self._cycle % self.slow_every == 0:
+            plan += plans['slow']
+        if self._static_due:
+            plan += plans['static']
+        return sorted(plan)
+
+    def _read_done(self, ok):
+        """Advances the poll cycle, a failed read retries the slow and static blocks"""
+        if ok:
+            self._cycle += 1
+            self._static_due = False
+        else:
+            self._static_due = True
+        if self._capture is not None:
+            if ok and self._captured:
+                self._capture.write(time(), self._captured)
+            self._captured = []
+
+    def reset_poll(self):
+        """Reads every register again on the next cycle, called on a new connection"""
+        self._cycle = 0
+        self._static_due = True
+
+    def _decode_registers(self, func, address, registers):
+        """Decodes a block of the read plan into self.registers"""
+        if self._decoders is None:
+            plan = [block for blocks in self._read_plans().values() for block in blocks]
+            self._decoders = compile_decoders(self._register_map, plan,
+                                              word_order=self.word_order,
+                                              byte_order=self.byte_order,
+                                              numeric=self.numeric)
+        decoder = self._decoders[(func, address)]
+        if self._capture is not None:
+            self._captured.append((func, address, registers))
+        if self.vectorize:
+            self.registers.update(zip(decoder.names, decoder.decode_numpy(registers).tolist()))
+        else:
+            decoder.decode(registers, self.registers)
+
+    def read(self):
+        """Reads the PV inverters status"""
+        try:
+            for func, address, count in self._read_plan():
+                if self.request_interval:
+                    sleep(self.request_interval)
+                self._load_registers(func, address, count)
+        except Exception:
+            self._read_done(False)
+            raise
+        self._read_done(True)
+        self._calculate()
+
+    async def connect_async(self):
+        await self.async_client.connect()
+        self.reset_poll()
+
+    async def close_async(self):
+        self.async_client.close()
+
+    async def read_async(self):
+        """Reads the PV inverters status, pipelining the register blocks"""
+        plan = self._read_plan()
+        try:
+            blocks = await self.async_client.read_many(plan)
+        except Exception:
+            self._read_done(False)
+            raise
+        for (func, address, count), registers in zip(plan, blocks):
+            self._decode_registers(func, address, registers)
+        self._read_done(True)
+        self._calculate()
+
+    def _calculate(self):
+        """Derives any calculated values once the registers are loaded"""
+        pass
+
+
+#-----------------
+# Exported symbols
+#-----------------
+__all__ = ["BaseModbusPVInverter"]
@@ -0,0 +1,184 @@
+#!/usr/bin/env python
+
+# Copyright 2018 Paul Archer
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import asyncio
+import struct
+
+from pymodbus.exceptions import ModbusIOException, ConnectionException
+
+import logging
+
+_logger = logging.getLogger(__name__)
+
+_FUNCTION_CODES = {
+  'holding': 0x03,
+  'input': 0x04,
+}
+
+# Transaction ID, protocol ID, length, unit ID
+_MBAP = struct.Struct('>HHHB')
+# Function code, start address, register count
+_READ_PDU = struct.Struct('>BHH')
+
+
+class _PipelineError(ModbusIOException):
+    """A request got no response, or one not matching it
+
+    What a device that mishandles more than one outstanding request does,
+    unlike an exception response, which it gives to a serialized read too.
+    """
+
+
+class AsyncModbusTcpClient():
+    """Minimal asyncio Modbus TCP client that can pipeline register reads
+
+    Up to ``max_inflight`` requests are written to the socket before their
+    responses arrive, responses are matched back to their request by the
+    transaction ID. With ``max_inflight`` of 1 the reads are strictly
+    serialized, ``request_interval`` adds a minimum gap between requests for
+    devices that need one.
+
+    Note: this speaks plain Modbus TCP, inverters behind an encrypted Sungrow
+    WiNet dongle still need the synchronous SungrowModbusTcpClient.
+    """
+
+    def __init__(self, host, port=502, unit=0x01, timeout=3, max_inflight=4, request_interval=0):
+        self.host = host
+        self.port = port
+        self.unit = unit
+        self.timeout = timeout
+        self.max_inflight = max(int(max_inflight), 1)
+        self.request_interval = request_interval
+
+        self._reader = None
+        self._writer = None
+        self._rx_task = None
+        self._pending = {}
+        self._tid = 0
+        self._window = None
+        self._last_request = 0
+
+    def is_connected(self):
+        return self._writer is not None and not self._writer.is_closing()
+
+    async def connect(self):
+        if self.is_connected():
+            return True
+        try:
+            self._reader, self._writer = await asyncio.wait_for(
+                asyncio.open_connection(self.host, self.port), self.timeout)
+        except (OSError, asyncio.TimeoutError) as err:
+            raise ConnectionException("Failed to connect[{}:{}] {}".format(self.host, self.port, err))
+
+        self._window = asyncio.Semaphore(self.max_inflight)
+        self._rx_task = asyncio.ensure_future(self._receive())
+        return True
+
+    def close(self):
+        if self._rx_task is not None:
+            self._rx_task.cancel()
+            self._rx_task = None
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+        self._reader = None
+        self._fail_pending(ConnectionException("Connection closed"))
+
+    def _fail_pending(self, err):
+        for fut, _, _ in self._pending.values():
+            if not fut.done():
+                fut.set_exception(err)
+        self._pending = {}
+
+    async def _receive(self):
+        try:
+            while True:
+                header = await self._reader.readexactly(_MBAP.size)
+                tid, _, length, unit = _MBAP.unpack(header)
+                pdu = await self._reader.readexactly(length - 1)
+                fut, code, count = self._pending.pop(tid, (None, None, None))
+                if fut is None or fut.done():
+                    _logger.debug("Dropping response for unknown transaction {}".format(tid))
+                    continue
+                if unit != self.unit or pdu[0] & 0x7f != code:
+                    fut.set_exception(_PipelineError("Mismatched response, unit {} function {:#04x}".format(
+                        unit, pdu[0])))
+                elif pdu[0] & 0x80:
+                    fut.set_exception(ModbusIOException("Exception response {:#04x}, code {}".format(pdu[0], pdu[1])))
+                elif pdu[1] != 2 * count or len(pdu) < 2 + pdu[1]:
+                    fut.set_exception(_PipelineError("Mismatched response, {} bytes for {} registers".format(
+                        pdu[1], count)))
+                else:
+                    fut.set_result(pdu[2:2 + pdu[1]])
+        except asyncio.CancelledError:
+            raise
+        except (OSError, asyncio.IncompleteReadError) as err:
+            self._writer = None
+            self._fail_pending(ConnectionException("Connection lost: {}".format(err)))
+
+    async def read_registers(self, func, address, count):
+        """Reads ``count`` registers from ``address``, returns the raw big endian register data"""
+        if not self.is_connected():
+            raise ConnectionException("Not connected[{}:{}]".format(self.host, self.port))
+
+        async with self._window:
+            loop = asyncio.get_running_loop()
+            if self.request_interval:
+                wait = self._last_request + self.request_interval - loop.time()
+                if wait > 0:
+                    await asyncio.sleep(wait)
+                self._last_request = loop.time()
+
+            self._tid = (self._tid + 1) & 0xffff
+            tid = self._tid
+            fut = loop.create_future()
+            code = _FUNCTION_CODES[func]
+            self._pending[tid] = (fut, code, count)
+
+            pdu = _READ_PDU.pack(code, address, count)
+            self._writer.write(_MBAP.pack(tid, 0, len(pdu) + 1, self.unit) + pdu)
+            try:
+                data = await asyncio.wait_for(fut, self.timeout)
+            except asyncio.TimeoutError:
+                self._pending.pop(tid, None)
+                raise _PipelineError("No response for {} {}+{}".format(func, address, count))
+
+        return data
+
+    async def read_many(self, requests):
+        """Reads a list of (func, address, count) blocks
+
+        The blocks are pipelined up to the in-flight window. If a pipelined
+        sweep times out or gets a mismatched response the client drops back
+        to strictly serialized reads and retries once, some devices mishandle
+        more than one outstanding request. Exception responses are raised.
+        """
+        try:
+            return await asyncio.gather(*[self.read_registers(*rq) for rq in requests])
+        except _PipelineError:
+            if self.max_inflight == 1:
+                raise
+            _logger.warning("{}: pipelined read failed, falling back to serialized reads".format(self.host))
+            self.max_inflight = 1
+            self.close()
+            await self.connect()
+            return [await self.read_registers(*rq) for rq in requests]
+
+
+#-----------------
+# Exported symbols
+#-----------------
+__all__ = ["AsyncModbusTcpClient"]
@@ -0,0 +1,129 @@
+#!/usr/bin/env python
+
+# Copyright 2018 Paul Archer
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from collections import namedtuple
+
+from pvstats.pvinverter.decoder import register_words
+
+# Largest register count a single Modbus read may request
+MAX_REGISTERS = 125
+
+# Unmapped registers worth reading to save a request
+DEFAULT_MAX_GAP = 20
+
+# Register poll classes, fastest first: read every cycle, every slow_every
+# cycles, once per connection
+POLL_CLASSES = ('fast', 'slow', 'static')
+
+ReadBlock = namedtuple('ReadBlock', ['func', 'address', 'count'])
+
+
+def _spans(registers):
+    """Sorted (address, words) spans of a register map section
+
+    Register map keys are the 1-based register numbers from the inverter
+    documentation, the Modbus address is one less.
+    """
+    return sorted((int(k) - 1, register_words(reg)) for k, reg in registers.items())
+
+
+def _forbidden(ranges, start, end):
+    """True if the addresses [start, end) overlap a forbidden range"""
+    for (first, last) in ranges:
+        # Ranges are inclusive register numbers
+        if start < last and first - 1 < end:
+            return True
+    return False
+
+
+def plan_reads(register_map, max_count=MAX_REGISTERS, max_gap=DEFAULT_MAX_GAP, forbidden=None):
+    """Compiles a register map into the minimal list of Modbus reads
+
+    Registers are coalesced into one read while the block stays within
+    ``max_count`` words, the unmapped gap between neighbours is at most
+    ``max_gap`` words and no forbidden range would be read. ``forbidden`` maps
+    the register type to a list of inclusive [first, last] register numbers
+    the device refuses to serve.
+
+    Returns a list of ReadBlock(func, address, count).
+    """
+    forbidden = forbidden or {}
+    max_count = min(max_count, MAX_REGISTERS)
+
+    plan = []
+    for func in register_map:
+        ranges = forbidden.get(func, [])
+        block_start = block_end = None
+        for address, words in _spans(register_map[func]):
+            end = address + words
+            if _forbidden(ranges, address, end):
+                raise ValueError("Register {} {} is inside a forbidden range".format(func, address + 1))
+
+            if block_start is not None:
+                if (end <= block_end):
+                    continue
+                if (address - block_end <= max_gap and end - block_start <= max_count and
+                        not _forbidden(ranges, block_end, address)):
+                    block_end = end
+                    continue
+                plan.append(ReadBlock(func, block_start, block_end - block_start))
+            block_start, block_end = address, end
+
+        if block_start is not None:
+            plan.append(ReadBlock(func, block_start, block_end - block_start))
+    return plan
+
+
+def _covered(plan, func, address, words):
+    """True if a block of the plan already reads the register"""
+    for block in plan:
+        if block.func == func and block.address <= address and address + words <= block.address + block.count:
+            return True
+    return False
+
+
+def plan_tiers(register_map, max_count=MAX_REGISTERS, max_gap=DEFAULT_MAX_GAP, forbidden=None):
+    """Compiles a register map into a read plan per poll class
+
+    Each register map entry may set 'poll' to one of POLL_CLASSES, the
+    default is 'fast'. The classes are planned fastest first and a register
+    already read by a faster block is left out of the slower plans, so the
+    slower classes only read what the faster ones do not.
+
+    Returns a dict of poll class to a list of ReadBlock(func, address, count).
+    """
+    for func, registers in register_map.items():
+        for k, reg in registers.items():
+            if reg.get('poll', 'fast') not in POLL_CLASSES:
+                raise ValueError("Register {} {} has an unknown poll class {}".format(func, k, reg['poll']))
+
+    tiers = {}
+    planned = []
+    for poll in POLL_CLASSES:
+        section = {}
+        for func, registers in register_map.items():
+            section[func] = {k: reg for k, reg in registers.items()
+                             if reg.get('poll', 'fast') == poll and
+                             not _covered(planned, func, int(k) - 1, register_words(reg))}
+        tiers[poll] = plan_reads(section, max_count=max_count, max_gap=max_gap, forbidden=forbidden)
+        planned += tiers[poll]
+    return tiers
+
+
+#-----------------
+# Exported symbols
+#-----------------
+__all__ = ["plan_reads", "plan_tiers", "ReadBlock", "MAX_REGISTERS", "POLL_CLASSES"]
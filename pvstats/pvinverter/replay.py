@@ -0,0 +1,152 @@
+#!/usr/bin/env python
+
+# Copyright 2018 Paul Archer
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from datetime import timedelta
+from time import monotonic, sleep
+
+from pymodbus.exceptions import ConnectionException
+
+from pvstats.pvinverter.modbus import BaseModbusPVInverter
+from pvstats.pvinverter.decoder import compile_decoders
+from pvstats.pvinverter.capture import CaptureReader
+from pvstats.pvinverter import sungrow_sg_ktl, sungrow_sh5k_20
+
+import logging
+
+_logger = logging.getLogger(__name__)
+
+# Inverter class and register map of each model a capture can be replayed as
+_MODELS = {
+    'sungrow-sg-ktl': (sungrow_sg_ktl.PVInverter_SunGrow, sungrow_sg_ktl._register_map),
+    'sungrow-sh5k-20': (sungrow_sh5k_20.PVInverter_SunGrow_sh5k_20, sungrow_sh5k_20._register_map),
+}
+
+
+class PVInverter_Replay(BaseModbusPVInverter):
+    """Replays a raw register capture through the decoders of the recorded model
+
+    Each read() returns the next recorded cycle, spaced as they were
+    recorded divided by 'speed'; a speed of 0 replays as fast as the cycles
+    are read. The poller's sample_period should then be 0. At the end of
+    the capture it starts over when 'loop' is set, otherwise reads fail.
+    Sample timestamps are the recorded ones, moved on by the length of the
+    capture, plus one cycle, on each pass after the first so they keep
+    increasing.
+    """
+
+    def __init__(self, cfg, **kwargs):
+        self.path = cfg['file']
+        self.speed = float(cfg.get('speed', 1))
+        self.loop = cfg.get('loop', False)
+        info = CaptureReader(self.path).info
+        model = info.get('model')
+        if model not in _MODELS:
+            raise ValueError("Unable to replay a capture of {}".format(model))
+        self.model_class, register_map = _MODELS[model]
+        self.word_order = info.get('word_order', self.model_class.word_order)
+        self.byte_order = info.get('byte_order', self.model_class.byte_order)
+        self.numeric = self.model_class.numeric
+        super(PVInverter_Replay, self).__init__(cfg, cfg.get('register_map', register_map))
+        # The capture stands in for the Modbus client
+        self.client = None
+        self._decoders = {}
+        self._cycles = None
+        self._origin = None
+        self._finished = False
+        # Seconds added to the recorded times of this pass
+        self._offset = 0.0
+        # Recorded times of the first and latest cycle of this pass, cycles read
+        self._first = None
+        self._last = None
+        self._count = 0
+
+    def is_connected(self):
+        return self._connected and not self._finished
+
+    def _rewind(self):
+        self._cycles = iter(CaptureReader(self.path))
+        if self._count:
+            # The next pass follows on one cycle after this one ended
+            span = self._last - self._first
+            self._offset += span + (span / (self._count - 1) if self._count > 1 else 1.0)
+        self._first = None
+        self._count = 0
+
+    def connect(self):
+        if self._finished:
+            raise ConnectionException("Replay of {} finished".format(self.path))
+        # A reconnect carries on where the replay was
+        if self._cycles is None:
+            self._rewind()
+        self.reset_poll()
+
+    def close(self):
+        pass
+
+    def _next_cycle(self):
+        cycle = next(self._cycles, None)
+        if cycle is None and self.loop:
+            _logger.info("Replay of {} starting over".format(self.path))
+            self._rewind()
+            cycle = next(self._cycles, None)
+        if cycle is None:
+            self._finished = True
+            raise ConnectionException("Replay of {} finished".format(self.path))
+        timestamp, blocks = cycle
+        if self._first is None:
+            self._first = timestamp
+        self._last = timestamp
+        self._count += 1
+        return timestamp + self._offset, blocks
+
+    def read(self):
+        """Decodes the next recorded cycle, once it is due"""
+        if self._cycles is None:
+            raise ConnectionException("Replay of {} not started".format(self.path))
+        timestamp, blocks = self._next_cycle()
+        if self.speed:
+            if self._origin is None:
+                self._origin = (timestamp, monotonic())
+            wait = self._origin[1] + (timestamp - self._origin[0]) / self.speed - monotonic()
+            if wait > 0:
+                sleep(wait)
+
+        for func, address, data in blocks:
+            count = len(data) // 2
+            decoder = self._decoders.get((func, address))
+            if decoder is None or decoder.count != count:
+                self._decoders.update(compile_decoders(self._register_map, [(func, address, count)],
+                                                       word_order=self.word_order,
+                                                       byte_order=self.byte_order,
+                                                       numeric=self.numeric))
+            self._decode_registers(func, address, data)
+        self._read_done(True)
+        self._calculate()
+        if self._offset and 'timestamp' in self.registers:
+            stamp = self.registers['timestamp']
+            if isinstance(stamp, (int, float)):
+                self.registers['timestamp'] = stamp + self._offset
+            else:
+                self.registers['timestamp'] = stamp + timedelta(seconds=self._offset)
+
+    def _calculate(self):
+        self.model_class._calculate(self)
+
+
+#-----------------
+# Exported symbols
+#-----------------
+__all__ = ["PVInverter_Replay"]
@@ -0,0 +1,383 @@
+#!/usr/bin/env python
+
+# Copyright 2018 Paul Archer
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Simulated Modbus inverter
+
+Serves a register map over Modbus TCP, or Modbus RTU frames over TCP, with
+time varying values and a configurable response latency. Run:
+    python -m pvstats.pvinverter.simulator --model sungrow-sg-ktl --port 5020
+and point an inverter entry at it, e.g.
+    {"model": "sungrow-sg-ktl", "mode": "tcp", "host": "127.0.0.1", "port": 5020}
+or, with --framer rtu,
+    {"model": "sungrow-sg-ktl", "mode": "rtu", "dev": "socket://127.0.0.1:5020"}
+"""
+
+import argparse
+import asyncio
+import math
+import random
+import struct
+import threading
+import time
+from datetime import datetime
+
+from pvstats.pvinverter.decoder import REGISTER_TYPES, register_words
+
+import logging
+
+_logger = logging.getLogger(__name__)
+
+_FUNCTIONS = {0x03: 'holding', 0x04: 'input'}
+
+# Transaction ID, protocol ID, length, unit ID
+_MBAP = struct.Struct('>HHHB')
+# Function code, start address, register count
+_READ_PDU = struct.Struct('>BHH')
+
+# Modbus exception codes
+_ILLEGAL_FUNCTION = 0x01
+_ILLEGAL_ADDRESS = 0x02
+
+FRAMERS = ('socket', 'rtu')
+
+MAX_READ = 125
+
+
+def _crc16(data):
+    crc = 0xffff
+    for b in data:
+        crc ^= b
+        for _ in range(8):
+            crc = (crc >> 1) ^ 0xa001 if crc & 1 else crc >> 1
+    return struct.pack('<H', crc)
+
+
+def _register_maps():
+    from pvstats.pvinverter import sungrow_sg_ktl, sungrow_sh5k_20
+    return {
+        'sungrow-sg-ktl': (sungrow_sg_ktl._register_map, sungrow_sg_ktl.PVInverter_SunGrow.word_order),
+        'sungrow-sh5k-20': (sungrow_sh5k_20._register_map, sungrow_sh5k_20.PVInverter_SunGrow_sh5k_20.word_order),
+    }
+
+
+class RegisterModel():
+    """Plausible, time varying values for the entries of a register map
+
+    Power follows a clear sky curve between 6:00 and 18:00 local time
+    scaled to nominal_power, with a little noise. Energies integrate it,
+    voltages, currents, temperatures and frequencies follow from it and the
+    date_ registers give the current time. Values are guessed from each
+    entry's name and units, anything unrecognised reads as 0 unless set in
+    'overrides'.
+    """
+
+    def __init__(self, register_map, word_order='big', byte_order='big', nominal_power=5000,
+                 overrides=None, seed=None):
+        self.register_map = register_map
+        self.word_order = word_order
+        self.byte_order = byte_order
+        self.nominal_power = nominal_power
+        self.overrides = dict(overrides or {})
+        self.random = random.Random(seed)
+        # func: [(address, words, entry)] sorted by address
+        self.entries = {func: sorted((int(k) - 1, register_words(reg), reg) for k, reg in registers.items())
+                        for func, registers in register_map.items()}
+        self._values_at = None
+        self._values = None
+
+    def solar(self, t):
+        """Fraction of nominal power at time t"""
+        now = datetime.fromtimestamp(t)
+        hour = now.hour + now.minute / 60 + now.second / 3600
+        return max(0.0, math.sin((hour - 6) / 12 * math.pi)) ** 1.5
+
+    def _energy_today(self, t):
+        """Wh generated since local midnight, the integral of the curve"""
+        now = datetime.fromtimestamp(t)
+        hour = now.hour + now.minute / 60 + now.second / 3600
+        steps = max(0, int((min(hour, 18) - 6) * 12))
+        midnight = t - hour * 3600
+        return sum(self.solar(midnight + (6 + i / 12) * 3600) for i in range(steps)) * self.nominal_power / 12
+
+    def _value(self, reg, t, solar, energy):
+        name = reg['name']
+        units = reg.get('units', '')
+        if name in self.overrides:
+            return self.overrides[name]
+        if name.startswith('date_'):
+            return getattr(datetime.fromtimestamp(t), name[5:])
+        power = self.nominal_power * solar * (1 + self.random.uniform(-0.01, 0.01))
+        if units == 'Wh':
+            if 'daily' in name:
+                return energy
+            return 1000 * self.nominal_power + energy
+        if units in ('kW', 'kWh'):
+            return self.nominal_power / 1000 * (1 + solar)
+        if units in ('W', 'VA', 'VAR'):
+            if name.startswith('tag_'):
+                return self.nominal_power
+            if 'reactive' in name:
+                return power * 0.05
+            if name.startswith(('pv1', 'pv2')):
+                return power / 2
+            return power
+        if units == 'V':
+            if name.startswith(('pv', 'bus')):
+                return 350 * (solar > 0) + 30 * solar
+            if 'battery' in name:
+                return 51.2
+            if 'ground' in name:
+                return -solar * 100
+            return 230 + self.random.uniform(-2, 2)
+        if units == 'A':
+            if name.startswith(('pv1', 'pv2')):
+                return power / 2 / 350
+            return power / 230 / (3 if name[-2:] in ('_A', '_B', '_C') else 1)
+        if units in ('C', '°C'):
+            return 25 + 20 * solar + self.random.uniform(-0.2, 0.2)
+        if units == 'Hz':
+            return 50 + self.random.uniform(-0.05, 0.05)
+        if units == '%':
+            return 80.0
+        if units == 'h':
+            return 20000 + t % 86400 / 3600
+        if units == 'min':
+            return max(0.0, (datetime.fromtimestamp(t).hour - 6) * 60)
+        return 0
+
+    def values(self, t=None):
+        """{name: value} of every entry at time t, computed once per second"""
+        t = time.time() if t is None else t
+        second = int(t)
+        if self._values_at != second:
+            solar = self.solar(t)
+            energy = self._energy_today(t)
+            self._values = {reg['name']: self._value(reg, t, solar, energy)
+                            for entries in self.entries.values() for _, _, reg in entries}
+            self._values_at = second
+        return self._values
+
+    def _encode(self, reg, value):
+        """The 16 bit words of an entry's value"""
+        reg_type = reg.get('type', 'uint16')
+        words, code = REGISTER_TYPES[reg_type]
+        if reg_type.startswith('float'):
+            raw = float(value) / float(reg['scale'])
+        else:
+            raw = int(round(float(value) / float(reg['scale'])))
+            bits = 16 * words
+            lo, hi = (-(1 << (bits - 1)), (1 << (bits - 1)) - 1) if reg_type.startswith('int') else (0, (1 << bits) - 1)
+            raw = min(max(raw, lo), hi)
+        parts = list(struct.unpack('>{}H'.format(words), struct.pack('>' + code, raw)))
+        if words > 1 and reg.get('word_order', self.word_order) == 'little':
+            parts.reverse()
+        if reg.get('byte_order', self.byte_order) == 'little':
+            parts = [((w & 0xff) << 8) | (w >> 8) for w in parts]
+        return parts
+
+    def words(self, func, address, count, t=None):
+        """Register words of a read, unmapped registers read as 0"""
+        values = self.values(t)
+        out = [0] * count
+        for start, words, reg in self.entries.get(func, ()):
+            offset = start - address
+            if offset + words <= 0:
+                continue
+            if offset >= count:
+                break
+            for i, w in enumerate(self._encode(reg, values[reg['name']])):
+                if 0 <= offset + i < count:
+                    out[offset + i] = w
+        return out
+
+
+class ModbusSimulator():
+    """Serves a RegisterModel over Modbus TCP, or RTU frames over TCP
+
+    Every response is delayed by latency seconds plus up to jitter either
+    way. TCP requests on one connection are answered concurrently, like a
+    gateway that pipelines, RTU requests one at a time. Reads of function
+    3 (holding) and 4 (input) registers are served for any unit.
+    """
+
+    def __init__(self, model, host='127.0.0.1', port=0, latency=0.0, jitter=0.0, framer='socket'):
+        if framer not in FRAMERS:
+            raise ValueError("Unknown framer {}".format(framer))
+        self.model = model
+        self.host = host
+        self.port = port
+        self.latency = latency
+        self.jitter = jitter
+        self.framer = framer
+        self.requests = 0
+        self._server = None
+        self._connections = set()
+        self._loop = None
+        self._thread = None
+
+    def _delay(self):
+        return max(0.0, self.latency + random.uniform(-self.jitter, self.jitter))
+
+    def _respond(self, function, address, count):
+        """Response PDU of a read request"""
+        self.requests += 1
+        func = _FUNCTIONS.get(function)
+        if func is None:
+            return struct.pack('>BB', function | 0x80, _ILLEGAL_FUNCTION)
+        if not 1 <= count <= MAX_READ or address + count > 0x10000:
+            return struct.pack('>BB', function | 0x80, _ILLEGAL_ADDRESS)
+        words = self.model.words(func, address, count)
+        return struct.pack('>BB{}H'.format(count), function, 2 * count, *words)
+
+    async def _answer_tcp(self, writer, lock, tid, unit, pdu):
+        await asyncio.sleep(self._delay())
+        if len(pdu) >= _READ_PDU.size:
+            response = self._respond(*_READ_PDU.unpack_from(pdu))
+        else:
+            response = struct.pack('>BB', pdu[0] | 0x80, _ILLEGAL_FUNCTION)
+        async with lock:
+            writer.write(_MBAP.pack(tid, 0, len(response) + 1, unit) + response)
+            await writer.drain()
+
+    async def _serve(self, reader, writer):
+        task = asyncio.current_task()
+        self._connections.add(task)
+        try:
+            if self.framer == 'socket':
+                await self._serve_tcp(reader, writer)
+            else:
+                await self._serve_rtu(reader, writer)
+        except asyncio.CancelledError:
+            pass
+        finally:
+            self._connections.discard(task)
+            writer.close()
+
+    async def _serve_tcp(self, reader, writer):
+        lock = asyncio.Lock()
+        tasks = set()
+        try:
+            while True:
+                tid, _, length, unit = _MBAP.unpack(await reader.readexactly(_MBAP.size))
+                pdu = await reader.readexactly(length - 1)
+                task = asyncio.ensure_future(self._answer_tcp(writer, lock, tid, unit, pdu))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    async def _serve_rtu(self, reader, writer):
+        try:
+            while True:
+                frame = await reader.readexactly(8)
+                if _crc16(frame[:6]) != frame[6:]:
+                    _logger.debug("Simulator: bad RTU CRC, dropping the frame")
+                    continue
+                unit = frame[0]
+                function, address, count = _READ_PDU.unpack_from(frame, 1)
+                await asyncio.sleep(self._delay())
+                response = bytes([unit]) + self._respond(function, address, count)
+                writer.write(response + _crc16(response))
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+
+    async def start(self):
+        self._server = await asyncio.start_server(self._serve, self.host, self.port)
+        self.port = self._server.sockets[0].getsockname()[1]
+        _logger.info("Simulator serving {} on {}:{}".format(self.framer, self.host, self.port))
+        return self
+
+    async def close(self):
+        if self._server is not None:
+            self._server.close()
+            for task in list(self._connections):
+                task.cancel()
+            await asyncio.gather(*self._connections, return_exceptions=True)
+            await self._server.wait_closed()
+            self._server = None
+
+    def start_thread(self):
+        """Serves from an event loop on a daemon thread, returns once listening"""
+        started = threading.Event()
+
+        def run():
+            self._loop = asyncio.new_event_loop()
+            self._loop.run_until_complete(self.start())
+            started.set()
+            self._loop.run_forever()
+            self._loop.close()
+
+        self._thread = threading.Thread(target=run, name='pvstats-simulator', daemon=True)
+        self._thread.start()
+        started.wait()
+        return self
+
+    def stop(self):
+        if self._loop is not None:
+            asyncio.run_coroutine_threadsafe(self.close(), self._loop).result()
+            self._loop.call_soon_threadsafe(self._loop.stop)
+            self._thread.join()
+            self._loop = None
+            self._thread = None
+
+
+def simulator(model, **kwargs):
+    """A ModbusSimulator of one of the supported inverter models"""
+    maps = _register_maps()
+    if model not in maps:
+        raise ValueError("No register map to simulate for {}".format(model))
+    register_map, word_order = maps[model]
+    model_kwargs = {k: kwargs.pop(k) for k in ('nominal_power', 'overrides', 'seed') if k in kwargs}
+    return ModbusSimulator(RegisterModel(register_map, word_order=word_order, **model_kwargs), **kwargs)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--model", default="sungrow-sg-ktl", choices=sorted(_register_maps()))
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=5020)
+    parser.add_argument("--framer", default="socket", choices=FRAMERS)
+    parser.add_argument("--latency", type=float, default=0.0, help="Seconds before each response")
+    parser.add_argument("--jitter", type=float, default=0.0, help="Seconds the latency varies by either way")
+    parser.add_argument("--nominal-power", type=float, default=5000, help="Peak power in W")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s: %(levelname)s %(message)s")
+
+    sim = simulator(args.model, host=args.host, port=args.port, framer=args.framer, latency=args.latency,
+                    jitter=args.jitter, nominal_power=args.nominal_power)
+
+    async def serve():
+        await sim.start()
+        await asyncio.Event().wait()
+
+    try:
+        asyncio.run(serve())
+    except KeyboardInterrupt:
+        pass
+
+
+#-----------------
+# Exported symbols
+#-----------------
+__all__ = ["RegisterModel", "ModbusSimulator", "simulator", "FRAMERS"]
+
+
+if __name__ == "__main__":
+    main()
@@ -15,6 +15,7 @@
 # limitations under the License.
 
 from pvstats.pvinverter.base import BasePVInverter
+from pvstats.numeric import number
 from datetime import datetime
 from decimal import Decimal, getcontext
 # import urllib2
@@ -32,6 +33,7 @@ class PVInverter_Solax(BasePVInverter):
     def __init__(self, cfg, **kwargs):
         self.url = "http://{}:{}/api/realTimeData.htm".format(
             cfg["host"], cfg["port"])
+        self.numeric = cfg.get('numeric', self.numeric)
 
     def connect(self):
         pass
@@ -49,11 +51,11 @@ class PVInverter_Solax(BasePVInverter):
 
         self.registers = {
             'timestamp': datetime.now(),
-            'daily_pv_energy': Decimal(data['Data'][8] * 1000),
-            'total_pv_power': Decimal(data['Data'][6]),
-            'internal_temp': Decimal(data['Data'][7]),
-            'pv1_voltage': Decimal(data['Data'][2]).quantize(Decimal('.1')),
-            'pv2_voltage': Decimal(data['Data'][3]).quantize(Decimal('.1'))
+            'daily_pv_energy': number(Decimal(data['Data'][8] * 1000), self.numeric),
+            'total_pv_power': number(data['Data'][6], self.numeric),
+            'internal_temp': number(data['Data'][7], self.numeric),
+            'pv1_voltage': number(Decimal(data['Data'][2]).quantize(Decimal('.1')), self.numeric),
+            'pv2_voltage': number(Decimal(data['Data'][3]).quantize(Decimal('.1')), self.numeric)
         }
 
 
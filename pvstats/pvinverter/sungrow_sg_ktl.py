@@ -14,7 +14,8 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-from pvstats.pvinverter.base import BasePVInverter
+from pvstats.pvinverter.modbus import BaseModbusPVInverter
+from pvstats.pvinverter.modbus_async import AsyncModbusTcpClient
 
 from pymodbus.constants import Defaults
 from pymodbus.client.sync import ModbusTcpClient
@@ -41,22 +42,18 @@ _logger = logging.getLogger(__name__)
 
 _register_map = {
   'input': {
-    '5001':  {'name': 'tag_nominal_power',                       'scale': Decimal(100),       'units': 'W',      'type': 'uint16'},
-    '5002':  {'name': 'tag_output_type',                         'scale': Decimal(1),         'units': '',       'type': 'uint16'},
+    '5001':  {'name': 'tag_nominal_power',                       'scale': Decimal(100),       'units': 'W',      'type': 'uint16', 'poll': 'static'},
+    '5002':  {'name': 'tag_output_type',                         'scale': Decimal(1),         'units': '',       'type': 'uint16', 'poll': 'static'},
     '5003':  {'name': 'daily_pv_energy',                         'scale': Decimal(100),       'units': 'Wh',     'type': 'uint16'},
-    '5004':  {'name': 'lifetime_pv_energy',                      'scale': Decimal(1000),      'units': 'Wh',     'type': 'uint32'},
-    '5005':  {'name': 'lifetime_pv_energy_2',                    'scale': Decimal(1000),      'units': 'Wh',     'type': 'uint32'},
-    '5006':  {'name': 'lifetime_runtime',                        'scale': Decimal(1),         'units': 'h',      'type': 'uint32'},
-    '5007':  {'name': 'lifetime_runtime_2',                      'scale': Decimal(1),         'units': 'h',      'type': 'uint32'},
+    '5004':  {'name': 'lifetime_pv_energy',                      'scale': Decimal(1000),      'units': 'Wh',     'type': 'uint32', 'poll': 'slow'},
+    '5006':  {'name': 'lifetime_runtime',                        'scale': Decimal(1),         'units': 'h',      'type': 'uint32', 'poll': 'slow'},
     '5008':  {'name': 'internal_temp',                           'scale': Decimal('0.1'),     'units': 'C',      'type': 'int16'},
     '5009':  {'name': 'apparent_power',                          'scale': Decimal(1),         'units': 'VA',     'type': 'uint32'},
-    '5010':  {'name': 'apparent_power_2',                        'scale': Decimal(1),         'units': 'VA',     'type': 'uint32'},
     '5011':  {'name': 'pv1_voltage',                             'scale': Decimal('0.1'),     'units': 'V',      'type': 'uint16'},
     '5012':  {'name': 'pv1_current',                             'scale': Decimal('0.1'),     'units': 'A',      'type': 'uint16'},
     '5013':  {'name': 'pv2_voltage',                             'scale': Decimal('0.1'),     'units': 'V',      'type': 'uint16'},
     '5014':  {'name': 'pv2_current',                             'scale': Decimal('0.1'),     'units': 'A',      'type': 'uint16'},
     '5017':  {'name': 'total_pv_power',                          'scale': Decimal(1),         'units': 'W',      'type': 'uint32'},
-    '5018':  {'name': 'total_pv_power_2',                        'scale': Decimal(1),         'units': 'W',      'type': 'uint32'},
     '5019':  {'name': 'grid_voltage_A',                          'scale': Decimal('0.1'),     'units': 'V',      'type': 'uint16'},
     '5020':  {'name': 'grid_voltage_B',                          'scale': Decimal('0.1'),     'units': 'V',      'type': 'uint16'},
     '5021':  {'name': 'grid_voltage_C',                          'scale': Decimal('0.1'),     'units': 'V',      'type': 'uint16'},
@@ -64,51 +61,35 @@ _register_map = {
     '5023':  {'name': 'inverter_current_B',                      'scale': Decimal('0.1'),     'units': 'A',      'type': 'uint16'},
     '5024':  {'name': 'inverter_current_C',                      'scale': Decimal('0.1'),     'units': 'A',      'type': 'uint16'},
     '5031':  {'name': 'active_power',                            'scale': Decimal(1),         'units': 'W',      'type': 'uint32'},
-    '5032':  {'name': 'active_power_2',                          'scale': Decimal(1),         'units': 'W',      'type': 'uint32'},
     '5033':  {'name': 'reactive_power',                          'scale': Decimal(1),         'units': 'VAR',    'type': 'int32'},
-    '5034':  {'name': 'reactive_power_2',                        'scale': Decimal(1),         'units': 'VAR',    'type': 'int32'},
     '5035':  {'name': 'power_factor',                            'scale': Decimal('0.001'),   'units': '',       'type': 'int16'},
     '5036':  {'name': 'grid_frequency',                          'scale': Decimal('0.1'),     'units': 'Hz',     'type': 'uint16'},
     '5038':  {'name': 'work_state',                              'scale': Decimal(1),         'units': '',       'type': 'uint16'},
-    '5039':  {'name': 'fault_year',                              'scale': Decimal(1),         'units': '',       'type': 'uint16'},
-    '5040':  {'name': 'fault_month',                             'scale': Decimal(1),         'units': '',       'type': 'uint16'},
-    '5041':  {'name': 'fault_day',                               'scale': Decimal(1),         'units': '',       'type': 'uint16'},
-    '5042':  {'name': 'fault_hour',                              'scale': Decimal(1),         'units': '',       'type': 'uint16'},
-    '5043':  {'name': 'fault_minute',                            'scale': Decimal(1),         'units': '',       'type': 'uint16'},
-    '5044':  {'name': 'fault_second',                            'scale': Decimal(1),         'units': '',       'type': 'uint16'},
+    '5039':  {'name': 'fault_year',                              'scale': Decimal(1),         'units': '',       'type': 'uint16', 'poll': 'slow'},
+    '5040':  {'name': 'fault_month',                             'scale': Decimal(1),         'units': '',       'type': 'uint16', 'poll': 'slow'},
+    '5041':  {'name': 'fault_day',                               'scale': Decimal(1),         'units': '',       'type': 'uint16', 'poll': 'slow'},
+    '5042':  {'name': 'fault_hour',                              'scale': Decimal(1),         'units': '',       'type': 'uint16', 'poll': 'slow'},
+    '5043':  {'name': 'fault_minute',                            'scale': Decimal(1),         'units': '',       'type': 'uint16', 'poll': 'slow'},
+    '5044':  {'name': 'fault_second',                            'scale': Decimal(1),         'units': '',       'type': 'uint16', 'poll': 'slow'},
     '5045':  {'name': 'tag_fault_code',                          'scale': Decimal(1),         'units': '',       'type': 'uint16'},
-    '5049':  {'name': 'tag_nominal_reactive_power',              'scale': Decimal(100),       'units': 'VA',     'type': 'uint16'},
+    '5049':  {'name': 'tag_nominal_reactive_power',              'scale': Decimal(100),       'units': 'VA',     'type': 'uint16', 'poll': 'static'},
     '5071':  {'name': 'ground_impedance',                        'scale': Decimal(1000),      'units': 'Ohm',    'type': 'uint16'},
     # '5081':  {'name': 'work_state_2',                            'scale': Decimal(1),         'units': '',       'type': 'uint32'},
-    # '5082':  {'name': 'work_state_3',                            'scale': Decimal(1),         'units': '',       'type': 'uint32'},
     '5083':  {'name': 'meter_power',                             'scale': Decimal(1),         'units': 'W',      'type': 'int32'},
-    '5084':  {'name': 'meter_power_2',                           'scale': Decimal(1),         'units': 'W',      'type': 'int32'},
     '5085':  {'name': 'meter_power_A',                           'scale': Decimal(1),         'units': 'W',      'type': 'int32'},
-    '5086':  {'name': 'meter_power_A_2',                         'scale': Decimal(1),         'units': 'W',      'type': 'int32'},
     '5087':  {'name': 'meter_power_B',                           'scale': Decimal(1),         'units': 'W',      'type': 'int32'},
-    '5088':  {'name': 'meter_power_B_2',                         'scale': Decimal(1),         'units': 'W',      'type': 'int32'},
     '5089':  {'name': 'meter_power_C',                           'scale': Decimal(1),         'units': 'W',      'type': 'int32'},
-    '5090':  {'name': 'meter_power_C_2',                         'scale': Decimal(1),         'units': 'W',      'type': 'int32'},
     '5091':  {'name': 'load_power',                              'scale': Decimal(1),         'units': 'W',      'type': 'int32'},
-    '5092':  {'name': 'load_power_2',                            'scale': Decimal(1),         'units': 'W',      'type': 'int32'},
     '5093':  {'name': 'daily_export_energy',                     'scale': Decimal(100),       'units': 'Wh',     'type': 'uint32'},
-    '5094':  {'name': 'daily_export_energy_2',                   'scale': Decimal(100),       'units': 'Wh',     'type': 'uint32'},
-    '5095':  {'name': 'lifetime_export_energy',                  'scale': Decimal(100),       'units': 'Wh',     'type': 'uint32'},
-    '5096':  {'name': 'lifetime_export_energy_2',                'scale': Decimal(100),       'units': 'Wh',     'type': 'uint32'},
+    '5095':  {'name': 'lifetime_export_energy',                  'scale': Decimal(100),       'units': 'Wh',     'type': 'uint32', 'poll': 'slow'},
     '5097':  {'name': 'daily_import_energy',                     'scale': Decimal(100),       'units': 'Wh',     'type': 'uint32'},
-    '5098':  {'name': 'daily_import_energy_2',                   'scale': Decimal(100),       'units': 'Wh',     'type': 'uint32'},
-    '5099':  {'name': 'lifetime_import_energy',                  'scale': Decimal(100),       'units': 'Wh',     'type': 'uint32'},
-    '5100':  {'name': 'lifetime_import_energy_2',                'scale': Decimal(100),       'units': 'Wh',     'type': 'uint32'},
+    '5099':  {'name': 'lifetime_import_energy',                  'scale': Decimal(100),       'units': 'Wh',     'type': 'uint32', 'poll': 'slow'},
     '5101':  {'name': 'daily_direct_consumption_energy',         'scale': Decimal(100),       'units': 'Wh',     'type': 'uint32'},
-    '5102':  {'name': 'daily_direct_consumption_energy_2',       'scale': Decimal(100),       'units': 'Wh',     'type': 'uint32'},
-    '5103':  {'name': 'lifetime_direct_consumption_energy',      'scale': Decimal(100),       'units': 'Wh',     'type': 'uint32'},
-    '5104':  {'name': 'lifetime_direct_consumption_energy_2',    'scale': Decimal(100),       'units': 'Wh',     'type': 'uint32'},
+    '5103':  {'name': 'lifetime_direct_consumption_energy',      'scale': Decimal(100),       'units': 'Wh',     'type': 'uint32', 'poll': 'slow'},
     '5113':  {'name': 'daily_runtime',                           'scale': Decimal(1),         'units': 'min',    'type': 'uint16'}, 
-    '5114':  {'name': 'tag_country',                             'scale': Decimal(1),         'units': 'UNK',    'type': 'uint16'},
-    '5128':  {'name': 'monthly_energy',                          'scale': Decimal(100),       'units': 'Wh',     'type': 'uint32'},
-    '5129':  {'name': 'monthly_energy_2',                        'scale': Decimal(100),       'units': 'Wh',     'type': 'uint32'},
-    '5144':  {'name': 'lifetime_energy_yield',                   'scale': Decimal(100),       'units': 'Wh',     'type': 'uint32'},
-    '5145':  {'name': 'lifetime_energy_yield_2',                 'scale': Decimal(100),       'units': 'Wh',     'type': 'uint32'},
+    '5114':  {'name': 'tag_country',                             'scale': Decimal(1),         'units': 'UNK',    'type': 'uint16', 'poll': 'static'},
+    '5128':  {'name': 'monthly_energy',                          'scale': Decimal(100),       'units': 'Wh',     'type': 'uint32', 'poll': 'slow'},
+    '5144':  {'name': 'lifetime_energy_yield',                   'scale': Decimal(100),       'units': 'Wh',     'type': 'uint32', 'poll': 'slow'},
     '5146':  {'name': 'negative_voltage_to_ground',              'scale': Decimal('0.1'),     'units': 'V',      'type': 'int16'},
     '5147':  {'name': 'bus_voltage',                             'scale': Decimal('0.1'),     'units': 'V',      'type': 'uint16'},  
     # '5148':  {'name': 'grid_frequency_fine',                     'scale': Decimal('0.01'),     'units': 'Hz',    'type': 'uint16'},  
@@ -122,37 +103,36 @@ _register_map = {
     '5005':  {'name': 'date_second',       'scale': 1,              'units': 'second',     'type': 'uint16'},
   }
 }
-class PVInverter_SunGrow(BasePVInverter):
+class PVInverter_SunGrow(BaseModbusPVInverter):
+    # 32 bit values are sent low word first
+    word_order = 'little'
+
     def __init__(self, cfg, **kwargs):
-        super(PVInverter_SunGrow, self).__init__()
+        super(PVInverter_SunGrow, self).__init__(cfg, cfg.get('register_map', _register_map))
         self.client = SungrowModbusTcpClient.SungrowModbusTcpClient(
             host=cfg['host'],
             port=cfg['port'],
             timeout=3,
             RetryOnEmpty=True,
             retries=3)
-        if cfg.get('register_map') is None:
-            self._register_map = _register_map
-        else:
-            self._register_map = cfg.get('register')
+
+        # Optional non-blocking client, plain Modbus TCP only
+        if cfg.get('async'):
+            self.is_async = True
+            self.async_client = AsyncModbusTcpClient(host=cfg['host'],
+                                                     port=cfg['port'],
+                                                     timeout=3,
+                                                     max_inflight=cfg.get('pipeline', 4),
+                                                     request_interval=self.request_interval)
 
     def connect(self):
         self.client.connect()
+        self.reset_poll()
 
     def close(self):
         self.client.close()
 
-    def read(self):
-        """Reads the PV inverters status"""
-
-        # Read holding and input registers in groups aligned on the 100
-        for func in self._register_map:
-            start = -1
-            for k in sorted(self._register_map[func].keys()):
-                group = int(k) - int(k) % 100
-                if (start <= group):
-                    self._load_registers(func, group, 100)
-                    start = group + 100
+    def _calculate(self):
         if len(self.registers) == 0:
             return
         # Manually calculate the power and the timestamps
@@ -160,87 +140,44 @@ class PVInverter_SunGrow(BasePVInverter):
                                             self.registers.get('pv1_voltage',0))
         self.registers['pv2_power'] = round(self.registers.get('pv2_current',0) *
                                             self.registers.get('pv2_voltage',0))
-        self.registers['timestamp'] = datetime(self.registers.get('date_year',0),
-                                               self.registers.get('date_month',0),
-                                               self.registers.get('date_day',0),
-                                               self.registers.get('date_hour',0),
-                                               self.registers.get('date_minute',0),
-                                               self.registers.get('date_second',0))
-
-    def _2x_16_to_32(self, int16_1, int16_2):
-        if int16_1 < 0 and int16_2 < 0:
-            tag = 3
-            sign = -1
-        elif int16_1 >= 0 and int16_2 >= 0:
-            tag = 2
-            sign = 1
+        self.registers['timestamp'] = datetime(int(self.registers.get('date_year',0)),
+                                               int(self.registers.get('date_month',0)),
+                                               int(self.registers.get('date_day',0)),
+                                               int(self.registers.get('date_hour',0)),
+                                               int(self.registers.get('date_minute',0)),
+                                               int(self.registers.get('date_second',0)))
+
+    def _fetch_registers(self, func, address, count):
+        if func == 'input':
+            rq = self.client.read_input_registers(address, count, unit=0x01)
+        elif func == 'holding':
+            rq = self.client.read_holding_registers(address, count, unit=0x01)
         else:
-            raise ArithmeticError("Signs don't match for ints")
-        iint16_1 = int(int16_1)
-        iint16_2 = int(int16_2)
-        hxint16_1 = hex(abs(iint16_1))
-        hxint16_2 = hex(abs(iint16_2))
-        hx16_1 = str(hxint16_1)[tag:]
-        hx16_2 = str(hxint16_2)[tag:]
-        hx32 = hx16_1 + hx16_2
-        try:
-            int32 = int(hx32, 16) * sign
-            return int32
-        except Exception as e:
-            raise e
-        
+            raise Exception("Unknown register type: {}".format(func))
+
+        if isinstance(rq, ModbusIOException):
+            _logger.error("Error: {}".format(rq))
+            raise ModbusIOException
+        return rq.registers
 
     def _load_registers(self, func, start, count=100):
         try:
-            if func == 'input':
-                rq = self.client.read_input_registers(start, count, unit=0x01)
-            elif func == 'holding':
-                # Holding registers need an offset
-                start = start - 1
-                rq = self.client.read_holding_registers(start,count,unit=0x01)
-            else:
-                raise Exception("Unknown register type: {}".format(type))
-
-            if isinstance(rq, ModbusIOException):
-                _logger.error("Error: {}".format(rq))
-                raise ModbusIOException
-
-            for x, val in enumerate(rq.registers):
-                key = str(start + x + 1)
-                _logger.debug(f'{key}: {val}')
-                if key in self._register_map[func]:
-                    reg = self._register_map[func][key]
-                    reg_name = reg.get('name')
-                    reg_scale = reg.get('scale')
-                    reg_type = reg.get('type')
-                    if reg_type == 'int16' and val >= 2**15:
-                        self.registers[reg_name] = (val - 2**16) * reg_scale
-                    elif reg_type == 'int32' and val >= 2**15:
-                        self.registers[reg_name] = (val - 2**16) * reg_scale
-                    else:
-                        self.registers[reg_name] = val * reg_scale
-                    if reg_name.endswith('_2'):
-                        reg_2 = self.registers[reg_name] / reg_scale
-                        reg_name_1 = reg_name[0:-2]
-                        reg_1 = self.registers[reg_name_1] / reg_scale
-                        self.registers[reg_name[0:-2]] = self._2x_16_to_32(
-                            reg_2, reg_1) * reg_scale
-                        self.registers.pop(reg_name)
+            self._decode_registers(func, start, self._fetch_registers(func, start, count))
         except (ModbusIOException, ConnectionException) as err:
             _logger.error("Error: %s" % err)
             _logger.debug("{}, start: {}, count: {}".format(
-                type, start, count))
+                func, start, count))
             raise err
         except Exception as err:
             _logger.error("Error: %s" % err)
             _logger.debug("{}, start: {}, count: {}".format(
-                type, start, count))
+                func, start, count))
             raise err
 
 
 class PVInverter_SunGrowRTU(PVInverter_SunGrow):
     def __init__(self, cfg, **kwargs):
-        super(PVInverter_SunGrow, self).__init__()
+        super(PVInverter_SunGrow, self).__init__(cfg, cfg.get('register_map', _register_map))
 
         # Configure the Modbus Remote Terminal Unit settings
         self.client = ModbusSerialClient(method='rtu',
@@ -254,6 +191,7 @@ class PVInverter_SunGrowRTU(PVInverter_SunGrow):
     def connect(self):
         # Connect then configure the port
         self.client.connect()
+        self.reset_poll()
 
         # Configure the RS485 port - This seems not needed
         #rs485_mode = serial.rs485.RS485Settings(delay_before_tx = 0, delay_before_rx = 0,
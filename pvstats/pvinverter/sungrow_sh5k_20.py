@@ -14,7 +14,8 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-from pvstats.pvinverter.base import BasePVInverter
+from pvstats.pvinverter.modbus import BaseModbusPVInverter
+from pvstats.pvinverter.modbus_async import AsyncModbusTcpClient
 
 from pymodbus.constants import Defaults
 from pymodbus.client.sync import ModbusTcpClient
@@ -24,7 +25,6 @@ from pymodbus.exceptions import ModbusIOException
 from pymodbus.payload import BinaryPayloadDecoder
 from SungrowModbusTcpClient.SungrowModbusTcpClient import SungrowModbusTcpClient
 from datetime import datetime
-from time import sleep
 
 import serial.rs485
 
@@ -39,8 +39,8 @@ _logger = logging.getLogger(__name__)
 _register_map = {
   'input': {
     5003:  {'name': 'daily_pv_energy', 'scale': Decimal(100), 'units': 'W', 'type': 'uint16'},
-    5004:  {'name': 'lifetime_pv_power', 'scale': Decimal(1), 'units': 'kW', 'type': 'uint16'},
-    5006:  {'name': 'total_run_time', 'scale': Decimal(1), 'units': 'W', 'type': 'uint16'},
+    5004:  {'name': 'lifetime_pv_power', 'scale': Decimal(1), 'units': 'kW', 'type': 'uint16', 'poll': 'slow'},
+    5006:  {'name': 'total_run_time', 'scale': Decimal(1), 'units': 'W', 'type': 'uint16', 'poll': 'slow'},
     5008:  {'name': 'internal_temp', 'scale': Decimal('0.1'), 'units': 'C', 'type': 'uint16'},
     5011:  {'name': 'pv1_voltage', 'scale': Decimal('0.1'), 'units': 'V', 'type': 'uint16'},
     5012:  {'name': 'pv1_current', 'scale': Decimal('0.1'), 'units': 'A', 'type': 'uint16'},
@@ -53,25 +53,25 @@ _register_map = {
     5036:  {'name': 'grid_frequency', 'scale': Decimal('0.1'), 'units': 'Hz', 'type': 'uint16'},
     13001: {'name': 'running_state', 'scale': Decimal('1'), 'units': '?', 'type': 'uint16'},
     13002: {'name': 'daily_pv_energy_10', 'scale': Decimal('0.1'), 'units': 'Wh', 'type': 'uint16'},
-    13003: {'name': 'total_pv_energy_10', 'scale': Decimal('0.1'), 'units': 'Wh', 'type': 'uint16'},
+    13003: {'name': 'total_pv_energy_10', 'scale': Decimal('0.1'), 'units': 'Wh', 'type': 'uint16', 'poll': 'slow'},
     13005: {'name': 'daily_export_energy_10', 'scale': Decimal('0.1'), 'units': 'Wh', 'type': 'uint16'},
-    13006: {'name': 'total_export_energy_10', 'scale': Decimal('0.1'), 'units': 'Wh', 'type': 'uint16'},
+    13006: {'name': 'total_export_energy_10', 'scale': Decimal('0.1'), 'units': 'Wh', 'type': 'uint16', 'poll': 'slow'},
     13008: {'name': 'load_power', 'scale': Decimal('1'), 'units': 'W', 'type': 'uint16'},
     13010: {'name': 'export_power', 'scale': Decimal('1'), 'units': 'W', 'type': 'int16'},
     13011: {'name': 'grid_import_or_export', 'scale': Decimal('1'), 'units': '?', 'type': 'int16'},
     13012: {'name': 'daily_charge_energy_10', 'scale': Decimal('0.1'), 'units': 'Wh', 'type': 'uint16'},
-    13013: {'name': 'total_charge_energy_10', 'scale': Decimal('0.1'), 'units': 'Wh', 'type': 'uint16'},
-    13015: {'name': 'co2_emission_reduction', 'scale': Decimal('0.1'), 'units': 'Kg CO2', 'type': 'uint16'},
+    13013: {'name': 'total_charge_energy_10', 'scale': Decimal('0.1'), 'units': 'Wh', 'type': 'uint16', 'poll': 'slow'},
+    13015: {'name': 'co2_emission_reduction', 'scale': Decimal('0.1'), 'units': 'Kg CO2', 'type': 'uint16', 'poll': 'slow'},
     13017: {'name': 'daily_use_energy_10', 'scale': Decimal('0.1'), 'units': 'Wh', 'type': 'uint16'},
-    13018: {'name': 'total_use_energy_10', 'scale': Decimal('0.1'), 'units': 'Wh', 'type': 'uint16'},
+    13018: {'name': 'total_use_energy_10', 'scale': Decimal('0.1'), 'units': 'Wh', 'type': 'uint16', 'poll': 'slow'},
     13020: {'name': 'battery_voltage_10', 'scale': Decimal('0.1'), 'units': 'V', 'type': 'uint16'},
     13021: {'name': 'battery_current_10', 'scale': Decimal('0.1'), 'units': 'A', 'type': 'uint16'},
     13022: {'name': 'battery_power', 'scale': Decimal('1'), 'units': 'W', 'type': 'uint16'},
     13023: {'name': 'battery_level_10', 'scale': Decimal('0.1'), 'units': '%', 'type': 'uint16'},
-    13024: {'name': 'battery_health_10', 'scale': Decimal('0.1'), 'units': '%', 'type': 'uint16'},
+    13024: {'name': 'battery_health_10', 'scale': Decimal('0.1'), 'units': '%', 'type': 'uint16', 'poll': 'slow'},
     13025: {'name': 'battery_temp_10', 'scale': Decimal('0.1'), 'units': '°C', 'type': 'uint16'},
     13026: {'name': 'daily_discharge_energy_10', 'scale': Decimal('0.1'), 'units': 'Wh', 'type': 'uint16'},
-    13027: {'name': 'total_discharge_energy_10', 'scale': Decimal('0.1'), 'units': 'Wh', 'type': 'uint16'},
+    13027: {'name': 'total_discharge_energy_10', 'scale': Decimal('0.1'), 'units': 'Wh', 'type': 'uint16', 'poll': 'slow'},
     13029: {'name': 'use_power', 'scale': Decimal('0.1'), 'units': 'W', 'type': 'uint16'},
     13031: {'name': 'inverter_current_10', 'scale': Decimal('0.1'), 'units': 'A', 'type': 'uint16'},
     13034: {'name': 'pv_power', 'scale': Decimal('0.1'), 'units': 'W', 'type': 'uint16'},
@@ -137,13 +137,36 @@ _register_map = {
     5005:  {'name': 'date_second', 'scale': 1, 'units': 'second', 'type': 'uint16'},
   }
 }
-class PVInverter_SunGrow_sh5k_20(BasePVInverter):
+class PVInverter_SunGrow_sh5k_20(BaseModbusPVInverter):
+    # 32 bit values are sent low word first
+    word_order = 'little'
+
+    # Wait 500ms between modbus reads as per https://c.tjhowse.com/misc/SolarInfo%20Logger%20User%20Manual.pdf page 89
+    # This isn't enough though. Sometimes the modbus minion doesn't respond inside the (current) five second timeout.
+    request_interval = 0.5
+
+    # This inverter has always published floats
+    numeric = 'float'
+
     def __init__(self, cfg, **kwargs):
-        super(PVInverter_SunGrow_sh5k_20, self).__init__()
+        super(PVInverter_SunGrow_sh5k_20, self).__init__(cfg, _register_map)
         self.cfg = cfg
         self.init_modbus_client()
 
+        # Optional non-blocking client, plain Modbus TCP only. The SH5K wants
+        # its requests spaced out so default to serialized reads.
+        if cfg.get('async'):
+            self.is_async = True
+            self.async_client = AsyncModbusTcpClient(host=cfg['host'],
+                                                     port=cfg['port'],
+                                                     timeout=5,
+                                                     max_inflight=cfg.get('pipeline', 1),
+                                                     request_interval=self.request_interval)
+
     def init_modbus_client(self):
+        if getattr(self, 'client', None) is not None:
+            # A new client also renegotiates the encryption key
+            self.client.close()
         self.client = SungrowModbusTcpClient(host=self.cfg['host'],
                                              port=self.cfg['port'],
                                              framer=ModbusSocketFramer,
@@ -153,84 +176,53 @@ class PVInverter_SunGrow_sh5k_20(BasePVInverter):
 
     def connect(self):
         self.client.connect()
+        self.reset_poll()
 
     def close(self):
         self.client.close()
 
-    def read(self):
-        """Reads the PV inverters status"""
-
-        # Read holding and input registers in groups aligned on the 100
-        for func in _register_map:
-            start = -1
-            for k in sorted(_register_map[func].keys()):
-                group = int(k) - int(k) % 100
-                if (start < group):
-                    # Wait 500ms between modbus reads as per https://c.tjhowse.com/misc/SolarInfo%20Logger%20User%20Manual.pdf page 89
-                    # This isn't enough though. Sometimes the modbus minion doesn't respond inside the (current) five second timeout.
-                    sleep(0.5)
-                    self._load_registers(func, group, 100)
-                    start = group + 100
-
+    def _calculate(self):
         # Manually calculate the power and the timestamps
         self.registers['pv1_power'] = round(self.registers['pv1_current'] *
                                             self.registers['pv1_voltage'])
         self.registers['pv2_power'] = round(self.registers['pv2_current'] *
                                             self.registers['pv2_voltage'])
-        self.registers['timestamp'] = datetime(self.registers['date_year'],
-                                               self.registers['date_month'],
-                                               self.registers['date_day'],
-                                               self.registers['date_hour'],
-                                               self.registers['date_minute'],
-                                               self.registers['date_second'])
-
-        floaty = {}
-        for key in self.registers.keys():
-            try:
-                floaty[key] = float(self.registers[key])
-            except:
-                floaty[key] = self.registers[key]
-        self.registers = floaty
+        self.registers['timestamp'] = datetime(int(self.registers['date_year']),
+                                               int(self.registers['date_month']),
+                                               int(self.registers['date_day']),
+                                               int(self.registers['date_hour']),
+                                               int(self.registers['date_minute']),
+                                               int(self.registers['date_second']))
+
+    def _fetch_registers(self, func, address, count):
+        if func == 'input':
+            rq = self.client.read_input_registers(address, count, unit=0x01)
+        elif func == 'holding':
+            rq = self.client.read_holding_registers(address,
+                                                    count,
+                                                    unit=0x01)
+        else:
+            raise Exception("Unknown register type: {}".format(func))
+
+        if isinstance(rq, ModbusIOException):
+            _logger.error("Error: {}".format(rq))
+            self.init_modbus_client()
+            raise ModbusIOException
+        return rq.registers
 
     def _load_registers(self, func, start, count=100):
         try:
-            if func == 'input':
-                rq = self.client.read_input_registers(start, count, unit=0x01)
-            elif func == 'holding':
-                # Holding registers need an offset
-                start = start - 1
-                rq = self.client.read_holding_registers(start,
-                                                        count,
-                                                        unit=0x01)
-            else:
-                raise Exception("Unknown register type: {}".format(type))
-
-            if isinstance(rq, ModbusIOException):
-                _logger.error("Error: {}".format(rq))
-                self.init_modbus_client()
-                raise Exception("ModbusIOException")
-
-            for x in range(0, count):
-                key = start + x + 1
-                val = rq.registers[x]
-
-                if key in _register_map[func]:
-                    reg = _register_map[func][key]
-                    self.registers[reg['name']] = val * reg['scale']
-                    if reg['type'] == 'int16' and self.registers[
-                            reg['name']] >= 2**15:
-                        self.registers[reg['name']] -= 2**16
-
+            self._decode_registers(func, start, self._fetch_registers(func, start, count))
         except Exception as err:
             _logger.error("Error: %s" % err)
             _logger.debug("{}, start: {}, count: {}".format(
-                type, start, count))
+                func, start, count))
             raise
 
 
 class PVInverter_SunGrow_sh5k_20RTU(PVInverter_SunGrow_sh5k_20):
     def __init__(self, cfg, **kwargs):
-        super(PVInverter_SunGrow_sh5k_20, self).__init__()
+        super(PVInverter_SunGrow_sh5k_20, self).__init__(cfg, _register_map)
 
         # Configure the Modbus Remote Terminal Unit settings
         self.client = ModbusSerialClient(method='rtu',
@@ -244,6 +236,7 @@ class PVInverter_SunGrow_sh5k_20RTU(PVInverter_SunGrow_sh5k_20):
     def connect(self):
         # Connect then configure the port
         self.client.connect()
+        self.reset_poll()
 
         # Configure the RS485 port - This seems not needed
         #rs485_mode = serial.rs485.RS485Settings(delay_before_tx = 0, delay_before_rx = 0,
@@ -18,13 +18,167 @@
 
 from urllib.parse import urlencode
 import http.client as httplib
+import threading
+import time
+
+# Statuses accepted by one addbatchstatus.jsp request
+MAX_BATCH_STATUS = 30
+
+_STATUS_PARAMS = (('energy_generation', 'v1'), ('power_generation', 'v2'),
+                  ('energy_consumption', 'v3'), ('power_consumption', 'v4'),
+                  ('temperature', 'v5'), ('voltage', 'v6'))
+
+# Requests per hour allowed to an API key until the server says otherwise
+DEFAULT_REQUEST_LIMIT = 60
+
+_connections = {}
+_connections_lock = threading.Lock()
+
+_limiters = {}
+_limiters_lock = threading.Lock()
+
+
+class RateLimitExceeded(Exception):
+    """The hourly request quota of the API key is used up"""
+
+    def __init__(self, delay):
+        super().__init__("PVOutput request quota used up, next request in {:.0f}s".format(delay))
+        self.delay = delay
+
+
+class RateLimiter():
+    """Token bucket for the requests made with one API key
+
+    The bucket holds up to the hourly limit and refills evenly over the
+    hour. Every response corrects it from the X-Rate-Limit-* headers, so
+    all the systems sharing a key draw from the quota the server reports.
+    """
+
+    def __init__(self, limit=DEFAULT_REQUEST_LIMIT, period=3600):
+        self.lock = threading.Lock()
+        self.limit = limit
+        self.period = period
+        self.tokens = float(limit)
+        self.updated = time.monotonic()
+        self.blocked_until = 0
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.limit, self.tokens + (now - self.updated) * self.limit / self.period)
+        self.updated = now
+        return now
+
+    def available(self):
+        """Requests that can be made now"""
+        with self.lock:
+            now = self._refill()
+            return 0 if now < self.blocked_until else self.tokens
+
+    def ready_at(self):
+        """Monotonic time of the next request allowed"""
+        with self.lock:
+            now = self._refill()
+            ready = now if self.tokens >= 1 else now + (1 - self.tokens) * self.period / self.limit
+            return max(ready, self.blocked_until)
+
+    def acquire(self):
+        """Takes a token, raises RateLimitExceeded if there is none"""
+        with self.lock:
+            now = self._refill()
+            if now >= self.blocked_until and self.tokens >= 1:
+                self.tokens -= 1
+                return
+        raise RateLimitExceeded(self.ready_at() - time.monotonic())
+
+    def update(self, headers, exceeded=False):
+        """Corrects the bucket from the rate limit headers of a response"""
+        with self.lock:
+            self._refill()
+            try:
+                self.limit = int(headers.get('X-Rate-Limit-Limit', self.limit))
+                remaining = int(headers.get('X-Rate-Limit-Remaining', 0 if exceeded else self.tokens))
+                reset = headers.get('X-Rate-Limit-Reset')
+            except ValueError:
+                return
+            self.tokens = min(self.tokens, remaining)
+            if remaining < 1 and reset is not None:
+                self.blocked_until = self.updated + max(0, int(reset) - time.time())
+
+    def min_batch(self, batch_size):
+        """Statuses worth a request, one while half the quota is left rising to a full batch"""
+        fraction = self.available() / self.limit
+        if fraction >= 0.5:
+            return 1
+        return max(1, round(batch_size * (1 - 2 * fraction)))
+
+
+def rate_limiter(api_key, limit=DEFAULT_REQUEST_LIMIT):
+    """The RateLimiter shared by every client using the API key"""
+    with _limiters_lock:
+        if api_key not in _limiters:
+            _limiters[api_key] = RateLimiter(limit)
+        return _limiters[api_key]
+
+
+class _Connection():
+    """A kept-alive connection to a PVOutput host, shared by its clients"""
+
+    def __init__(self, host, tls, timeout):
+        self.host = host
+        self.tls = tls
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        self.conn = None
+
+    def request(self, method, path, body, headers):
+        """Returns the status, body and headers of the response, reconnecting once if the connection went stale"""
+        with self.lock:
+            for attempt in range(2):
+                if self.conn is None:
+                    cls = httplib.HTTPSConnection if self.tls else httplib.HTTPConnection
+                    self.conn = cls(self.host, timeout=self.timeout)
+                try:
+                    self.conn.request(method, path, body, headers)
+                    response = self.conn.getresponse()
+                    # Always read the whole response so the connection can be reused
+                    data = response.read()
+                except (httplib.HTTPException, OSError):
+                    self.close()
+                    if attempt:
+                        raise
+                    continue
+                if response.will_close:
+                    self.close()
+                return response.status, data.decode('utf-8', 'replace'), response.headers
+
+    def close(self):
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+
+
+def _connection(host, tls, timeout):
+    with _connections_lock:
+        key = (host, tls)
+        if key not in _connections:
+            _connections[key] = _Connection(host, tls, timeout)
+        return _connections[key]
+
+
+def _check(status, body):
+    if status == 400:
+        raise ValueError(body)
+    if status != 200:
+        raise Exception(body)
 
 
 class PVOutputClient():
-    def __init__(self, host, api_key, system_id):
+    def __init__(self, host, api_key, system_id, tls=True, timeout=30, request_limit=DEFAULT_REQUEST_LIMIT):
         self.host = host
         self.api_key = api_key
         self.system_id = system_id
+        self.connection = _connection(host, tls, timeout)
+        self.limiter = rate_limiter(api_key, request_limit)
 
     def add_output(self,
                    date,
@@ -65,12 +219,9 @@ class PVOutputClient():
         if import_shoulder:
             params['is'] = import_shoulder
 
-        response = self.make_request('POST', path, params)
+        params = urlencode(params)
 
-        if response.status == 400:
-            raise ValueError(response.read())
-        if response.status != 200:
-            raise Exception(response.read())
+        _check(*self.make_request('POST', path, params))
 
     def add_status(self,
                    date,
@@ -103,12 +254,35 @@ class PVOutputClient():
             params['c1'] = 1
         params = urlencode(params)
 
-        response = self.make_request('POST', path, params)
+        _check(*self.make_request('POST', path, params))
+
+    def add_batch_status(self, statuses, cumulative=False, batch_size=MAX_BATCH_STATUS):
+        """
+		Uploads many statuses, batch_size per request
+
+		Each status is a dict of the add_status arguments. Returns a
+		(date, time, added) tuple per status, added is False for a status
+		PVOutput already held.
+		"""
+        path = '/service/r2/addbatchstatus.jsp'
+        results = []
+        for start in range(0, len(statuses), batch_size):
+            batch = []
+            for status in statuses[start:start + batch_size]:
+                values = [status['date'], status['time']]
+                values += ['' if status.get(k) is None else str(status[k]) for k, _ in _STATUS_PARAMS]
+                batch.append(','.join(values).rstrip(','))
+            params = {'data': ';'.join(batch)}
+            if cumulative:
+                params['c1'] = 1
 
-        if response.status == 400:
-            raise ValueError(response.read())
-        if response.status != 200:
-            raise Exception(response.read())
+            status, body = self.make_request('POST', path, urlencode(params))
+            _check(status, body)
+            for result in body.strip().split(';'):
+                if result:
+                    date, time, added = result.split(',')[:3]
+                    results.append((date, time, added == '1'))
+        return results
 
     def get_status(self, date=None, time=None):
         """
@@ -122,14 +296,10 @@ class PVOutputClient():
             params['t'] = time
         params = urlencode(params)
 
-        response = self.make_request("GET", path, params)
+        status, body = self.make_request("GET", path + '?' + params)
+        _check(status, body)
 
-        if response.status == 400:
-            raise ValueError(response.read())
-        if response.status != 200:
-            raise Exception(response.read())
-
-        rsp = response.read().split(",")
+        rsp = body.split(",")
         return {
             'date': rsp[0],
             'time': rsp[1],
@@ -150,31 +320,34 @@ class PVOutputClient():
         params = {'d': date, 't': time}
         params = urlencode(params)
 
-        response = self.make_request("POST", path, params)
-
-        if response.status == 400:
-            raise ValueError(response.read())
-        if response.status != 200:
-            raise Exception(response.read())
+        status, body = self.make_request("POST", path, params)
+        _check(status, body)
 
-        return response.read()
+        return body
 
     def make_request(self, method, path, params=None):
-        conn = httplib.HTTPConnection(self.host)
+        """Sends a request over the shared connection, returns the status and body
+
+        Raises RateLimitExceeded instead of sending when the API key has no
+        requests left this hour.
+        """
+        self.limiter.acquire()
         headers = {
             'Content-type': 'application/x-www-form-urlencoded',
             'Accept': 'text/plain',
             'X-Pvoutput-Apikey': self.api_key,
-            'X-Pvoutput-SystemId': self.system_id
+            'X-Pvoutput-SystemId': self.system_id,
+            'X-Rate-Limit': '1'
         }
-        conn.request(method, path, params, headers)
-
-        return conn.getresponse()
+        status, body, response_headers = self.connection.request(method, path, params, headers)
+        self.limiter.update(response_headers, exceeded=(status == 403 and 'Exceeded' in body))
+        return status, body
 
 
 #-----------------
 # Exported symbols
 #-----------------
-__all__ = ["PVOutputClient"]
+__all__ = ["PVOutputClient", "RateLimiter", "RateLimitExceeded", "rate_limiter", "MAX_BATCH_STATUS",
+           "DEFAULT_REQUEST_LIMIT"]
 
 
@@ -15,14 +15,22 @@
 # limitations under the License.
 
 import abc
-import json
+import os
 import time
+from datetime import datetime
 
 from influxdb import InfluxDBClient
-from pvstats.pvoutput import PVOutputClient
+from pvstats.pvoutput import PVOutputClient, RateLimitExceeded, MAX_BATCH_STATUS, DEFAULT_REQUEST_LIMIT
+from pvstats.serialize import Encoder, Pretty, field_payload
+from pvstats.history import RingHistory, numeric_fields
+from pvstats.archive import ArchiveWriter
+from pvstats import analytics
+from pvstats.analytics import DayBuffer, summarize, combine, output_params, local_date
+from pvstats.fanout import PVReportChannel
+from pvstats.aggregate import WindowAggregator, AggregatedReport
+from pvstats.deadband import DeadbandReport
 
 #import context
-import json
 import paho.mqtt.client as mqtt
 
 import logging
@@ -39,66 +47,234 @@ class BasePVOutput():
     def publish(self, data):
         pass
 
+    def publish_batch(self, samples):
+        """Publishes a backlog of samples, oldest first"""
+        for data in samples:
+            self.publish(data)
+
+    def flush(self):
+        """Sends anything the report is holding back"""
+        pass
+
+    def flush_deadline(self):
+        """Monotonic time by which held back samples must be flushed, None if none are held"""
+        return None
+
+    def held(self):
+        """How many of the latest samples published are held back, None if not known
+
+        A spooled channel commits the samples before them. Unknown means
+        every sample since the report last had no flush deadline.
+        """
+        return None if self.flush_deadline() is not None else 0
+
+    def close(self):
+        self.flush()
+
 
 class PVReport_pvoutput(BasePVOutput):
+    """Uploads averaged statuses to one or more PVOutput systems
+
+    'systems' maps inverter names to system ids, inverters not listed go to
+    'system_id'. Each status averages a rate_limit window of samples, time
+    weighted so uneven sample periods do not skew it, and is stamped with
+    the time of its last sample, so it stays on the day it was sampled.
+    Statuses wait in a per system queue for the API key's RateLimiter. While more than half the hourly quota is left each status
+    is uploaded at once, as the quota runs out statuses are held and
+    uploaded together with addbatchstatus.jsp. Held statuses are flushed
+    after max_hold seconds, as soon as the quota allows.
+
+    With 'output' set the day's samples of each system are also kept, and
+    once a sample of the next day arrives their analytics summary is
+    uploaded with addoutput.jsp. This needs NumPy.
+    """
+
     def __init__(self, cfg):
-        self.samples = []
         self.rate_limit = int(cfg['rate_limit'])
-        self.last_status = time.time()
-
-        self.client = PVOutputClient(cfg['host'], cfg['key'], cfg['system_id'])
+        self.system_id = cfg.get('system_id')
+        self.systems = cfg.get('systems', {})
+        self.batch_size = int(cfg.get('batch_size', MAX_BATCH_STATUS))
+        self.max_hold = float(cfg.get('max_hold', 3600))
+        self.max_pending = int(cfg.get('max_pending', 2000))
+        self.windows = WindowAggregator(self.rate_limit,
+                                        functions={'energy_generation': 'last', 'sample_time': 'last'},
+                                        default='time_mean', max_gap=3 * self.rate_limit)
+        self.pending = {}
+        # Number of the first sample of each pending status
+        self.origins = {}
+        self.clients = {}
+        self.host = cfg['host']
+        self.key = cfg['key']
+        self.tls = cfg.get('tls', True)
+        self.request_limit = int(cfg.get('requests_per_hour', DEFAULT_REQUEST_LIMIT))
+        self._held_since = None
+        self.output = cfg.get('output', False)
+        if self.output and analytics.numpy is None:
+            raise RuntimeError("numpy is not installed, it is needed for the PVOutput 'output'")
+        self.clip_limit = cfg.get('clip_limit')
+        # system id: (date, {inverter: DayBuffer}) of the day being collected
+        self.days = {}
+        self.outputs = []
+
+    def _client(self, system_id):
+        if system_id not in self.clients:
+            self.clients[system_id] = PVOutputClient(self.host, self.key, system_id, tls=self.tls,
+                                                     request_limit=self.request_limit)
+        return self.clients[system_id]
 
     def publish(self, data):
-        sample = {
-            'date': data['timestamp'].strftime("%Y%m%d"),
-            'time': data['timestamp'].strftime("%H:%M"),
-            'energy_generation': data['daily_pv_energy'],
-            'power_generation': data['total_pv_power'],
-            'temperature': data['internal_temp'],
-            'voltage': (data['pv1_voltage'] + data['pv2_voltage'])
-        }
-
-        if (time.time() - self.last_status > 3 * self.rate_limit):
-            # If the last successful sample was a long time ago, flush the samples
-            self.samples = []
-
-        self.samples.append(sample)
-
-        if (time.time() - self.last_status > self.rate_limit):
-            # Last result: Date, Time & EnergyGeneration
-            # Average:     PowerGeneration, Temperature & Voltage
-            # Note: This asssumes all samples are sampled at the same sample rate
-            d = {
-                'date':
-                self.samples[-1]['date'],
-                'time':
-                self.samples[-1]['time'],
-                'energy_generation':
-                self.samples[-1]['energy_generation'],
-                'power_generation':
-                sum(s['power_generation']
-                    for s in self.samples) / len(self.samples),
-                'temperature':
-                sum(s['temperature']
-                    for s in self.samples) / len(self.samples),
-                'voltage':
-                sum(s['voltage'] for s in self.samples) / len(self.samples)
-            }
-
-            # Clear out the old results
-            self.last_status = time.time()
-            self.samples = []
-
-            # Send the new result to the server
-            self.client.add_status(d['date'],
-                                   d['time'],
-                                   energy_generation=d['energy_generation'],
-                                   power_generation=d['power_generation'],
-                                   temperature=d['temperature'],
-                                   voltage=d['voltage'])
+        self.publish_batch([data])
+
+    def _queue(self, windows):
+        for w, origin in zip(windows, self.windows.take_origins()):
+            system_id = self.systems.get(w.get('tag_inverter'), self.system_id)
+            if system_id is None:
+                continue
+            self.origins.setdefault(system_id, []).append(origin)
+            stamp = datetime.fromtimestamp(w['sample_time'])
+            self.pending.setdefault(system_id, []).append({
+                'date': stamp.strftime("%Y%m%d"),
+                'time': stamp.strftime("%H:%M"),
+                'energy_generation': round(w['energy_generation']),
+                'power_generation': round(w['power_generation']),
+                'temperature': round(w['temperature'], 1),
+                'voltage': round(w['voltage'], 1)
+            })
+
+    def _collect(self, data):
+        system_id = self.systems.get(data.get('tag_inverter'), self.system_id)
+        if system_id is None:
+            return
+        day = local_date(data['timestamp'])
+        current = self.days.get(system_id)
+        if current is None or day > current[0]:
+            if current is not None:
+                self._close_day(system_id, *current)
+            current = self.days[system_id] = (day, {})
+        elif day < current[0]:
+            return
+        buffers = current[1]
+        buffer = buffers.get(data.get('tag_inverter'))
+        if buffer is None:
+            buffer = buffers[data.get('tag_inverter')] = DayBuffer()
+        buffer.append(data)
+
+    def _close_day(self, system_id, day, buffers):
+        summary = combine([summarize(*buffer.arrays(), clip_limit=self.clip_limit)
+                           for buffer in buffers.values()])
+        _log.info("PVOutput system {} {}: {}".format(system_id, day, summary))
+        params = output_params(day, summary)
+        if params is not None:
+            self.outputs.append((system_id, params))
+
+    def publish_batch(self, samples):
+        for data in samples:
+            if self.output:
+                self._collect(data)
+            timestamp = data['timestamp']
+            self._queue(self.windows.add({
+                'timestamp': timestamp,
+                'sample_time': timestamp if isinstance(timestamp, (int, float)) else timestamp.timestamp(),
+                'tag_inverter': data.get('tag_inverter'),
+                'energy_generation': data['daily_pv_energy'],
+                'power_generation': data['total_pv_power'],
+                'temperature': data['internal_temp'],
+                'voltage': data['pv1_voltage'] + data['pv2_voltage']
+            }))
+
+        try:
+            self._upload(force=False)
+        except RateLimitExceeded as err:
+            _log.info("{}, holding the statuses".format(err))
+        except Exception as err:
+            _log.warning("PVOutput upload failed, holding the statuses: {}".format(err))
+
+    def _upload(self, force):
+        """Sends the pending statuses the rate limiter allows, and any end of day outputs
+
+        Statuses and outputs PVOutput rejects are dropped, on any other
+        error they are held for the next upload.
+        """
+        try:
+            for system_id, statuses in self.pending.items():
+                client = self._client(system_id)
+                while statuses and (force or len(statuses) >= client.limiter.min_batch(self.batch_size)):
+                    batch = statuses[:self.batch_size]
+                    try:
+                        if len(batch) == 1:
+                            client.add_status(**batch[0])
+                        else:
+                            client.add_batch_status(batch, batch_size=self.batch_size)
+                    except ValueError as err:
+                        # Rejected outright, sending them again would fail the same way
+                        _log.error("PVOutput system {} rejected {} statuses, dropping them: {}".format(
+                            system_id, len(batch), err))
+                    del statuses[:len(batch)]
+                    del self.origins[system_id][:len(batch)]
+            while self.outputs:
+                system_id, params = self.outputs[0]
+                try:
+                    self._client(system_id).add_output(**params)
+                except ValueError as err:
+                    _log.error("PVOutput system {} rejected the output of {}, dropping it: {}".format(
+                        system_id, params['date'], err))
+                self.outputs.pop(0)
+        finally:
+            held = sum(len(statuses) for statuses in self.pending.values())
+            if not held:
+                self._held_since = None
+            elif self._held_since is None:
+                self._held_since = time.monotonic()
+            for system_id, statuses in self.pending.items():
+                if len(statuses) > self.max_pending:
+                    _log.warning("PVOutput unreachable, dropping {} statuses".format(len(statuses) - self.max_pending))
+                    del statuses[:-self.max_pending]
+                    del self.origins[system_id][:-self.max_pending]
+
+    def flush(self):
+        self._queue(self.windows.close_due(time.monotonic() - self.rate_limit))
+        self._upload(force=True)
+
+    def close(self):
+        self._queue(self.windows.close())
+        self._upload(force=True)
+
+    def flush_deadline(self):
+        deadline = None
+        end = self.windows.next_close()
+        if end is not None:
+            # Close a window nothing else arrived for
+            deadline = end + self.rate_limit
+        if self._held_since is not None:
+            ready = max(self._client(system_id).limiter.ready_at()
+                        for system_id, statuses in self.pending.items() if statuses)
+            held = max(self._held_since + self.max_hold, ready)
+            deadline = held if deadline is None else min(deadline, held)
+        return deadline
+
+    def held(self):
+        """Samples of open windows and pending statuses
+
+        The day's samples kept for 'output' are not counted, the summary of
+        a day cut short by a restart is not uploaded.
+        """
+        first = self.windows.held_from()
+        for origins in self.origins.values():
+            if origins:
+                first = min(first, origins[0])
+        return self.windows.added - first
 
 
 class PVReport_mqtt(BasePVOutput):
+    """Publishes samples to MQTT
+
+    'payload' selects the encoding of the sample published to 'topic', one
+    of the serialize FORMATS ('json', pretty printed, by default) or 'none'.
+    With 'fields' set each field is also published to its own retained
+    topic, <topic>/<field> or <topic>/<inverter>/<field> for a named
+    inverter, as plain text, and only when its value changed.
+    """
+
     def __init__(self, cfg):
         self.client = mqtt.Client()
 
@@ -110,24 +286,186 @@ class PVReport_mqtt(BasePVOutput):
         if cfg['tls']:
             self.client.tls_set()
 
-        # Connect and run the call back functions
-        self.client.connect(cfg['host'], cfg['port'])
-        self.client.loop_start()
+        # In flight window and offline queue
+        self.client.max_inflight_messages_set(int(cfg.get('max_inflight', 20)))
+        self.client.max_queued_messages_set(int(cfg.get('max_queued', 0)))
+        self.client.on_connect = self._on_connect
 
         # Save config data for later
         self.topic = cfg['topic']
         self.qos = cfg['qos']
+        self.payload = cfg.get('payload', 'json')
+        self.encoder = None if self.payload == 'none' else Encoder(self.payload, cfg.get('schema'))
+        self.fields = bool(cfg.get('fields', False))
+        self.field_qos = cfg.get('field_qos', self.qos)
+        self.retain = bool(cfg.get('retain', True))
+        # Payload last published to each field topic
+        self._published = {}
+
+        # Connect and run the call back functions
+        self.client.connect(cfg['host'], cfg['port'])
+        self.client.loop_start()
+
+    def _on_connect(self, client, userdata, flags, rc):
+        # Republish every field after a reconnect, the broker may have lost them
+        self._published = {}
+
+    def _send(self, topic, payload, qos, retain=False):
+        info = self.client.publish(topic, payload, qos=qos, retain=retain)
+        if info.rc != mqtt.MQTT_ERR_SUCCESS:
+            raise IOError("MQTT publish failed: {}".format(mqtt.error_string(info.rc)))
 
     def publish(self, data):
-        d = json.dumps(data,
-                       sort_keys=True,
-                       indent=2,
-                       separators=(',', ': '),
-                       default=str)
-        self.client.publish(self.topic, d, qos=self.qos)
+        if self.encoder is not None:
+            self._send(self.topic, self.encoder.encode(data), self.qos)
+
+        if self.fields:
+            published = self._published
+            inverter = data.get('tag_inverter')
+            prefix = self.topic + ('/{}/'.format(inverter) if inverter else '/')
+            for k, v in data.items():
+                if k == 'tag_inverter':
+                    continue
+                topic = prefix + k
+                payload = field_payload(v)
+                if published.get(topic) != payload:
+                    self._send(topic, payload, self.field_qos, self.retain)
+                    published[topic] = payload
+
+
+def _escape_key(key):
+    """Escapes a measurement, tag key, tag value or field key for line protocol"""
+    return str(key).replace('\\', '\\\\').replace(' ', '\\ ').replace(',', '\\,').replace('=', '\\=').replace('\n', '\\n')
+
+
+def _string_value(value):
+    return '"{}"'.format(str(value).replace('\\', '\\\\').replace('"', '\\"'))
+
+
+def _field_value(value):
+    """Formats a line protocol field value, typed as the influxdb client would"""
+    if isinstance(value, bool):
+        return 'true' if value else 'false'
+    if isinstance(value, int):
+        return '{}i'.format(value)
+    if isinstance(value, str):
+        return _string_value(value)
+    return repr(float(value))
+
+
+# Line protocol field formats of the schema value types
+_FIELD_TYPES = {
+    'float': lambda v: repr(float(v)),
+    'int': lambda v: '{}i'.format(int(v)),
+    'string': _string_value,
+    'bool': lambda v: 'true' if v else 'false',
+}
+
+# What to do with new values of a tag past max_tag_values
+CARDINALITY_POLICIES = ('warn', 'drop', 'field')
+
+
+class _InfluxSchema():
+    """Maps sample keys to InfluxDB tags and fields
+
+    Each key is resolved once, from the report's 'schema' entry or else by
+    its name: tag_ keys become tags without the prefix, date_ keys (the
+    inverter clock) are dropped, everything else, fault_ times included,
+    is a field. A schema entry is "tag", "field", "drop" or an object with
+    'as', the field value 'type' and a 'name' to write it under.
+
+    Tags hold the values series are indexed by, so each tag's distinct
+    values are counted. Past max_tag_values the cardinality policy warns,
+    drops the tag from the point or writes the value as a field instead.
+    """
+
+    def __init__(self, schema=None, max_tag_values=100, cardinality='drop'):
+        if cardinality not in CARDINALITY_POLICIES:
+            raise ValueError("Unknown cardinality policy {}".format(cardinality))
+        self.schema = schema or {}
+        self.max_tag_values = int(max_tag_values)
+        self.cardinality = cardinality
+        self.columns = {}
+        self.tag_values = {}
+        self.refused = 0
+
+    def _resolve(self, key):
+        entry = self.schema.get(key)
+        if isinstance(entry, str):
+            entry = {'as': entry}
+        if entry is None:
+            if key == 'timestamp' or key.startswith('date_'):
+                entry = {'as': 'drop'}
+            elif key.startswith('tag_'):
+                entry = {'as': 'tag', 'name': key[4:]}
+            else:
+                entry = {'as': 'field'}
+        kind = entry.get('as', 'field')
+        if kind == 'drop':
+            column = None
+        elif kind in ('tag', 'field'):
+            value_type = entry.get('type')
+            if value_type is not None and value_type not in _FIELD_TYPES:
+                raise ValueError("Unknown InfluxDB type {} for {}".format(value_type, key))
+            column = (kind, _escape_key(entry.get('name', key)), _FIELD_TYPES.get(value_type, _field_value))
+        else:
+            raise ValueError("Unknown InfluxDB schema entry {} for {}".format(kind, key))
+        self.columns[key] = column
+        return column
+
+    def _tag_ok(self, name, value):
+        """Counts the tag value, False if the point must not carry it as a tag"""
+        values = self.tag_values.setdefault(name, set())
+        if value in values:
+            return True
+        if len(values) < self.max_tag_values:
+            values.add(value)
+            return True
+        self.refused += 1
+        if self.refused == 1 or self.refused % 1000 == 0:
+            _log.warning("InfluxDB tag {} has over {} values, {} the new ones ({} so far)".format(
+                name, self.max_tag_values,
+                {'warn': 'still writing', 'drop': 'dropping', 'field': 'writing as fields'}[self.cardinality],
+                self.refused))
+        return self.cardinality == 'warn'
+
+    def split(self, data, tags):
+        """Returns the escaped tags dict, updated from the sample, and the field list"""
+        fields = []
+        columns = self.columns
+        for (k, v) in data.items():
+            if k in columns:
+                column = columns[k]
+            else:
+                column = self._resolve(k)
+            if column is None or v is None:
+                continue
+            kind, name, format = column
+            if kind == 'tag':
+                value = _escape_key(v)
+                if value == '':
+                    continue
+                if self._tag_ok(name, value):
+                    tags[name] = value
+                    continue
+                if self.cardinality == 'drop':
+                    continue
+            fields.append(name + '=' + format(v))
+        return tags, fields
+
+
+# Timestamp multipliers of the line protocol precisions
+_PRECISION = {'s': 1, 'ms': 10**3, 'u': 10**6, 'n': 10**9}
 
 
 class PVReport_influxdb(BasePVOutput):
+    """Writes samples to InfluxDB in batches of line protocol points
+
+    Points carry the sample timestamp and are written once batch_size are
+    held or the oldest is flush_interval seconds old. Rewriting a point is
+    harmless, InfluxDB keeps one point per series and timestamp.
+    """
+
     def __init__(self, cfg):
         self.client = InfluxDBClient(cfg['host'],
                                      cfg['port'],
@@ -135,36 +473,173 @@ class PVReport_influxdb(BasePVOutput):
                                      cfg['password'],
                                      cfg['db'],
                                      ssl=cfg['ssl'],
-                                     verify_ssl=cfg['verify_ssl'])
-        self.measurement = cfg['measurement']
-        self.tags = cfg['tags']
+                                     verify_ssl=cfg['verify_ssl'],
+                                     gzip=cfg.get('gzip', False))
+        self.measurement = _escape_key(cfg['measurement'])
+        # Line protocol has no empty tag values, a tag configured empty is left out
+        self.tags = {_escape_key(k): _escape_key(v) for k, v in cfg['tags'].items() if v not in ('', None)}
+        self.schema = _InfluxSchema(cfg.get('schema'), cfg.get('max_tag_values', 100),
+                                    cfg.get('cardinality', 'drop'))
+        self.precision = cfg.get('precision', 's')
+        if self.precision not in _PRECISION:
+            raise ValueError("Unknown InfluxDB precision {}".format(self.precision))
+        self.batch_size = int(cfg.get('batch_size', 100))
+        self.flush_interval = float(cfg.get('flush_interval', 60))
+        # Points kept for a retry while InfluxDB is unreachable
+        self.max_pending = int(cfg.get('max_pending', 10 * self.batch_size))
+
+        self._lines = []
+        self._held_since = None
+
+    def _line(self, data):
+        tags, fields = self.schema.split(data, dict(self.tags))
+        if not fields:
+            return None
+
+        line = self.measurement
+        for k in sorted(tags):
+            line += ',' + k + '=' + tags[k]
+        line += ' ' + ','.join(fields)
+
+        timestamp = data.get('timestamp')
+        if timestamp is not None:
+            if not isinstance(timestamp, (int, float)):
+                timestamp = timestamp.timestamp()
+            line += ' {}'.format(int(round(timestamp * _PRECISION[self.precision])))
+        return line
 
     def publish(self, data):
-        # TODO
-        fields = {}
-        tags = {}
+        line = self._line(data)
+        if line is None:
+            return
+        self._lines.append(line)
+        if self._held_since is None:
+            self._held_since = time.monotonic()
+        if len(self._lines) >= self.batch_size or time.monotonic() - self._held_since >= self.flush_interval:
+            self.flush()
+
+    def publish_batch(self, samples):
+        self._lines.extend(line for line in map(self._line, samples) if line is not None)
+        if self._held_since is None:
+            self._held_since = time.monotonic()
+        self.flush()
+
+    def flush_deadline(self):
+        if self._held_since is None:
+            return None
+        return self._held_since + self.flush_interval
+
+    def flush(self):
+        if not self._lines:
+            return
+        try:
+            target = self.client.write_points(self._lines,
+                                              time_precision=self.precision,
+                                              batch_size=self.batch_size,
+                                              protocol='line')
+            if not target:
+                raise IOError("Not sent to InfluxDB")
+        except Exception:
+            # Keep the points for the next flush, not before the next interval
+            if len(self._lines) > self.max_pending:
+                _log.warning("InfluxDB unreachable, dropping {} points".format(len(self._lines) - self.max_pending))
+                del self._lines[:-self.max_pending]
+            self._held_since = time.monotonic()
+            raise
+        _log.info("Sent {} points to InfluxDB".format(len(self._lines)))
+        self._lines = []
+        self._held_since = None
+
+
+class PVReport_history(BasePVOutput):
+    """Keeps the recent samples of each inverter in a RingHistory
+
+    One file per inverter, <path>/<name>.ring, holding the last 'capacity'
+    samples of the numeric fields of its first sample, or of 'fields'.
+    """
 
-        for (k, v) in data.items():
-            if not k.startswith("date_") and not k.startswith(
-                    "fault_") and not k.startswith(
-                        "tag_") and k != "timestamp":
-                fields[k] = v
-            elif k.startswith("fault_"):
-                tags[k] = v
-            elif k.startswith("tag_"):
-                tags[k[4:]] = v
-
-        tags.update(self.tags)
-        metrics = [{
-            'measurement': self.measurement,
-            'tags': tags,
-            'fields': fields
-        }]
-        target = self.client.write_points(metrics)
-        if target:
-            _log.info("Sent to InfluxDB")
-        else:
-            _log.error("Not sent to InfluxDB")
+    def __init__(self, cfg):
+        self.path = cfg['path']
+        self.capacity = int(cfg.get('capacity', 8640))
+        self.fields = cfg.get('fields')
+        self.histories = {}
+        os.makedirs(self.path, exist_ok=True)
+
+    def history(self, name, sample=None):
+        history = self.histories.get(name)
+        if history is None:
+            path = os.path.join(self.path, '{}.ring'.format(name))
+            fields = self.fields or (numeric_fields(sample) if sample is not None else None)
+            history = self.histories[name] = RingHistory(path, fields, self.capacity)
+        return history
+
+    def publish(self, data):
+        timestamp = data['timestamp']
+        if not isinstance(timestamp, (int, float)):
+            timestamp = timestamp.timestamp()
+        self.history(data.get('tag_inverter') or 'inverter', data).append(timestamp, data)
+
+    def flush(self):
+        for history in self.histories.values():
+            history.flush()
+
+    def close(self):
+        for history in self.histories.values():
+            history.close()
+        self.histories = {}
+
+
+class PVReport_archive(BasePVOutput):
+    """Archives the samples of each inverter with an ArchiveWriter
+
+    One directory per inverter, <path>/<name>, of compressed chunks of
+    'chunk_seconds' of the numeric fields, or of 'fields'. A chunk is
+    written early once it has been open for 'flush_interval' seconds,
+    chunk_seconds by default, e.g. when the inverter goes quiet at night.
+    """
+
+    def __init__(self, cfg):
+        self.path = cfg['path']
+        self.chunk_seconds = int(cfg.get('chunk_seconds', 3600))
+        self.flush_interval = float(cfg.get('flush_interval', self.chunk_seconds))
+        self.fields = cfg.get('fields')
+        self.writers = {}
+        self.received = 0
+        # Writer name: (number of the first sample held, monotonic time it arrived)
+        self._held = {}
+
+    def writer(self, name):
+        writer = self.writers.get(name)
+        if writer is None:
+            writer = self.writers[name] = ArchiveWriter(os.path.join(self.path, name),
+                                                        self.chunk_seconds, self.fields)
+        return writer
+
+    def publish(self, data):
+        name = data.get('tag_inverter') or 'inverter'
+        writer = self.writer(name)
+        if writer.append(data['timestamp'], data) and writer.held() == 1:
+            self._held[name] = (self.received, time.monotonic())
+        self.received += 1
+
+    def flush(self):
+        for writer in self.writers.values():
+            writer.flush()
+        self._held = {}
+
+    def flush_deadline(self):
+        if not self._held:
+            return None
+        return min(arrived for _, arrived in self._held.values()) + self.flush_interval
+
+    def held(self):
+        if not self._held:
+            return 0
+        return self.received - min(first for first, _ in self._held.values())
+
+    def close(self):
+        self.flush()
+        self.writers = {}
 
 
 class PVReport_test(BasePVOutput):
@@ -172,15 +647,10 @@ class PVReport_test(BasePVOutput):
         pass
 
     def publish(self, data):
-        _log.info(
-            json.dumps(data,
-                       sort_keys=True,
-                       indent=4,
-                       separators=(',', ': '),
-                       default=str))
+        _log.info("%s", Pretty(data))
 
 
-def PVReportFactory(cfg):
+def _report(cfg):
     if (cfg['type'] == "test"):
         return PVReport_test(cfg)
     elif (cfg['type'] == "pvoutput"):
@@ -189,11 +659,36 @@ def PVReportFactory(cfg):
         return PVReport_mqtt(cfg)
     elif (cfg['type'] == "influxdb"):
         return PVReport_influxdb(cfg)
+    elif (cfg['type'] == "history"):
+        return PVReport_history(cfg)
+    elif (cfg['type'] == "archive"):
+        return PVReport_archive(cfg)
     else:
         #    raise ValueError("Unable to find PVReport for {}".format(cfg['type']))
         _log.debug("Unable to find PVReport for {}".format(cfg['type']))
 
 
+def PVReportFactory(cfg):
+    """Builds a report, publishing on its own worker queue unless queue_size is 0
+
+    A report with an 'aggregate' entry is sent windowed aggregates instead
+    of the raw samples, one with a 'deadband' entry only significant changes,
+    of the aggregates if both are set. PVOutput needs whole samples, so
+    takes no deadband.
+    """
+    if cfg.get('deadband') and cfg['type'] == "pvoutput":
+        raise ValueError("PVOutput report {} needs whole samples, it cannot take a deadband".format(
+            cfg.get('name', cfg['type'])))
+    report = _report(cfg)
+    if report is not None and cfg.get('deadband'):
+        report = DeadbandReport(report, cfg['deadband'])
+    if report is not None and cfg.get('aggregate'):
+        report = AggregatedReport(report, cfg['aggregate'])
+    if report is None or cfg.get('queue_size') == 0:
+        return report
+    return PVReportChannel(report, cfg)
+
+
 #-----------------
 # Exported symbols
 #-----------------
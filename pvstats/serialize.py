@@ -0,0 +1,173 @@
+#!/usr/bin/env python
+
+# Copyright 2018 Paul Archer
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+import math
+from datetime import datetime
+from decimal import Decimal
+
+from pvstats.numeric import ScaledInt, json_default
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+# Sample encodings, 'json' is the pretty printed form
+FORMATS = ('json', 'compact', 'orjson', 'msgpack')
+
+_encode_string = json.encoder.encode_basestring_ascii
+
+
+def pretty(data):
+    """Indented JSON with sorted keys, for people to read"""
+    return json.dumps(data, sort_keys=True, indent=4, separators=(',', ': '), default=json_default)
+
+
+def compact_default(value):
+    """json.dumps() default for compact payloads, numbers stay numbers"""
+    if isinstance(value, (Decimal, ScaledInt)):
+        return float(value)
+    if isinstance(value, datetime):
+        return value.isoformat()
+    return str(value)
+
+
+def field_payload(value):
+    """Plain text form of a single value"""
+    if isinstance(value, datetime):
+        return value.isoformat()
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+
+def _float(v):
+    return repr(v) if math.isfinite(v) else 'null'
+
+
+def _decimal(v):
+    return str(v) if v.is_finite() else 'null'
+
+
+# Compact JSON of a value, by exact type
+_VALUES = {
+    float: _float,
+    int: str,
+    Decimal: _decimal,
+    ScaledInt: str,
+    str: _encode_string,
+    bool: lambda v: 'true' if v else 'false',
+    type(None): lambda v: 'null',
+    datetime: lambda v: '"' + v.isoformat() + '"',
+}
+
+
+class Encoder():
+    """Encodes samples in one of the FORMATS
+
+    The compact JSON encoder writes the values itself, Decimals keep their
+    exact digits. The encoded "key": prefix of every field is computed once,
+    and so is the encoded field of the 'static' fields (by default the tag_
+    ones) for as long as its value stays the same. Fields follow the
+    'schema' key order, when given, then the sample order.
+
+    'orjson' falls back to 'compact' when orjson is not installed.
+    """
+
+    def __init__(self, format='compact', schema=None, static=None):
+        if format not in FORMATS:
+            raise ValueError("Unknown encoding {}".format(format))
+        if format == 'msgpack' and msgpack is None:
+            raise RuntimeError("msgpack is not installed")
+        if format == 'orjson' and orjson is None:
+            format = 'compact'
+        self.format = format
+        self.schema = list(schema or ())
+        self._schema_keys = frozenset(self.schema)
+        self.static = static
+        self._keys = {}
+        self._fields = {}
+
+    def _is_static(self, key):
+        if self.static is None:
+            return key.startswith('tag_')
+        return key in self.static
+
+    def _key(self, key):
+        prefix = self._keys.get(key)
+        if prefix is None:
+            prefix = self._keys[key] = _encode_string(str(key)) + ':'
+        return prefix
+
+    def _field(self, key, value):
+        cached = self._fields.get(key)
+        if cached is not None and cached[0] == value and type(cached[0]) is type(value):
+            return cached[1]
+        field = self._key(key) + self._value(value)
+        if self._is_static(key):
+            self._fields[key] = (value, field)
+        return field
+
+    def _value(self, value):
+        encode = _VALUES.get(type(value))
+        if encode is None:
+            return json.dumps(value, default=compact_default)
+        return encode(value)
+
+    def _compact(self, data):
+        if self.schema:
+            keys = [k for k in self.schema if k in data]
+            keys += [k for k in data if k not in self._schema_keys]
+        else:
+            keys = data
+        return '{' + ','.join([self._field(k, data[k]) for k in keys]) + '}'
+
+    def encode(self, data):
+        """Returns the encoded sample as bytes"""
+        if self.format == 'compact':
+            return self._compact(data).encode('ascii')
+        if self.format == 'orjson':
+            return orjson.dumps(data, default=compact_default, option=orjson.OPT_NON_STR_KEYS)
+        if self.format == 'msgpack':
+            return msgpack.packb(data, default=compact_default)
+        return pretty(data).encode('utf-8')
+
+
+class Pretty():
+    """Formats a sample as pretty JSON only when converted to a string
+
+    For log calls, e.g. _log.debug("%s", Pretty(registers)), so nothing is
+    formatted unless the record is emitted.
+    """
+    __slots__ = ('data',)
+
+    def __init__(self, data):
+        self.data = data
+
+    def __str__(self):
+        return pretty(self.data)
+
+
+#-----------------
+# Exported symbols
+#-----------------
+__all__ = ["Encoder", "Pretty", "pretty", "compact_default", "field_payload", "FORMATS"]
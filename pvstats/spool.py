@@ -0,0 +1,283 @@
+#!/usr/bin/env python
+
+# Copyright 2018 Paul Archer
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+import os
+import struct
+import time
+import zlib
+from datetime import datetime
+from decimal import Decimal
+
+from pvstats.numeric import ScaledInt
+
+import logging
+
+_log = logging.getLogger(__name__)
+
+# Record header: payload length and CRC32 of the payload
+_HEADER = struct.Struct('>II')
+
+_SEGMENT_SUFFIX = '.seg'
+_CURSOR = 'cursor'
+
+# What to do when the spool is full
+EVICTION_POLICIES = ('drop-oldest', 'drop-newest')
+
+
+def _encode_value(value):
+    if isinstance(value, datetime):
+        return {'$dt': value.isoformat()}
+    if isinstance(value, Decimal):
+        return {'$dec': str(value)}
+    if isinstance(value, ScaledInt):
+        return {'$si': [value.raw, value.exponent]}
+    return str(value)
+
+
+def _decode_value(obj):
+    if len(obj) == 1:
+        if '$dt' in obj:
+            return datetime.fromisoformat(obj['$dt'])
+        if '$dec' in obj:
+            return Decimal(obj['$dec'])
+        if '$si' in obj:
+            return ScaledInt(*obj['$si'])
+    return obj
+
+
+def encode_sample(sample):
+    """Serialises a sample, keeping datetime, Decimal and ScaledInt values"""
+    return json.dumps(sample, separators=(',', ':'), default=_encode_value).encode('utf-8')
+
+
+def decode_sample(data):
+    return json.loads(data.decode('utf-8'), object_hook=_decode_value)
+
+
+class Spool():
+    """Durable append-only queue of samples for one report
+
+    Samples are appended as length and CRC framed records to numbered
+    segment files. A cursor file records the segment and offset of the
+    first sample not yet delivered. Appends are flushed to the OS at once
+    and fsynced at most every fsync_interval seconds. Segments are deleted
+    once delivered. When the spool grows past max_bytes, 'drop-oldest'
+    deletes the oldest segments and 'drop-newest' refuses new samples.
+
+    With readonly set an existing spool is only read, e.g. while its report
+    runs: the directory is not created, a torn last record is left alone
+    and appends and commits fail.
+
+    Not thread safe, the report channel serialises access.
+    """
+
+    def __init__(self, path, max_bytes=256 * 2**20, segment_bytes=4 * 2**20,
+                 fsync_interval=1.0, eviction='drop-oldest', readonly=False):
+        if eviction not in EVICTION_POLICIES:
+            raise ValueError("Unknown spool eviction policy {}".format(eviction))
+        self.path = path
+        self.max_bytes = max_bytes
+        self.segment_bytes = min(segment_bytes, max_bytes)
+        self.fsync_interval = fsync_interval
+        self.eviction = eviction
+        self.evicted_bytes = 0
+        self.rejected = 0
+        self.readonly = readonly
+
+        if not readonly:
+            os.makedirs(path, exist_ok=True)
+        self._segments = sorted(int(name[:-len(_SEGMENT_SUFFIX)]) for name in os.listdir(path)
+                                if name.endswith(_SEGMENT_SUFFIX))
+        self._cursor = self._load_cursor()
+        self._writer = None
+        self._dirty = False
+        self._last_sync = time.monotonic()
+
+        if self._segments and not readonly:
+            self._recover(self._segments[-1])
+        self._sizes = {n: os.path.getsize(self._segment_path(n)) for n in self._segments}
+
+    def _segment_path(self, number):
+        return os.path.join(self.path, '{:016d}{}'.format(number, _SEGMENT_SUFFIX))
+
+    def _load_cursor(self):
+        if not self._segments:
+            return (0, 0)
+        try:
+            with open(os.path.join(self.path, _CURSOR)) as f:
+                segment, offset = (int(x) for x in f.read().split())
+        except (OSError, ValueError):
+            return (self._segments[0], 0)
+        if segment < self._segments[0] or segment > self._segments[-1]:
+            return (self._segments[0], 0)
+        return (segment, offset)
+
+    def _save_cursor(self):
+        tmp = os.path.join(self.path, _CURSOR + '.tmp')
+        with open(tmp, 'w') as f:
+            f.write('{} {}\n'.format(*self._cursor))
+        os.replace(tmp, os.path.join(self.path, _CURSOR))
+
+    def _recover(self, number):
+        """Truncates a torn record left at the end of the last segment"""
+        path = self._segment_path(number)
+        good = 0
+        with open(path, 'rb') as f:
+            data = f.read()
+        while good + _HEADER.size <= len(data):
+            length, crc = _HEADER.unpack_from(data, good)
+            end = good + _HEADER.size + length
+            if end > len(data) or zlib.crc32(data[good + _HEADER.size:end]) != crc:
+                break
+            good = end
+        if good != len(data):
+            _log.warning("Spool {}: discarding {} torn bytes".format(self.path, len(data) - good))
+            with open(path, 'r+b') as f:
+                f.truncate(good)
+
+    def size(self):
+        """Bytes held on disk, delivered records of the current segment included"""
+        return sum(self._sizes.values())
+
+    def _check_writable(self):
+        if self.readonly:
+            raise IOError("Spool {} is open read only".format(self.path))
+
+    def append(self, sample):
+        self._check_writable()
+        payload = encode_sample(sample)
+        record = _HEADER.pack(len(payload), zlib.crc32(payload)) + payload
+
+        if self.size() + len(record) > self.max_bytes:
+            if self.eviction == 'drop-newest':
+                self.rejected += 1
+                return False
+            self._evict(len(record))
+
+        if self._writer is None or self._sizes[self._segments[-1]] + len(record) > self.segment_bytes:
+            self._roll(len(record))
+        self._writer.write(record)
+        self._writer.flush()
+        self._sizes[self._segments[-1]] += len(record)
+        self._dirty = True
+        self.maybe_sync()
+        return True
+
+    def _roll(self, needed):
+        """Opens the segment to append to, starting a new one when the last is full"""
+        if self._writer is not None:
+            self.sync()
+            self._writer.close()
+            self._writer = None
+        if not self._segments or self._sizes[self._segments[-1]] + needed > self.segment_bytes:
+            number = self._segments[-1] + 1 if self._segments else 0
+            self._segments.append(number)
+            self._sizes[number] = 0
+        self._writer = open(self._segment_path(self._segments[-1]), 'ab')
+
+    def _evict(self, needed):
+        """Deletes the oldest segments until the record fits"""
+        while self.size() + needed > self.max_bytes and len(self._segments) > 1:
+            number = self._segments.pop(0)
+            self.evicted_bytes += self._sizes.pop(number)
+            os.remove(self._segment_path(number))
+            if self._cursor[0] <= number:
+                self._cursor = (self._segments[0], 0)
+                self._save_cursor()
+            _log.warning("Spool {}: full, evicted segment {}".format(self.path, number))
+
+    def maybe_sync(self):
+        if self._dirty and time.monotonic() - self._last_sync >= self.fsync_interval:
+            self.sync()
+
+    def sync(self):
+        """Forces the appended records to disk"""
+        if self._writer is not None and self._dirty:
+            os.fsync(self._writer.fileno())
+        self._dirty = False
+        self._last_sync = time.monotonic()
+
+    def read(self, max_records, position=None, positions=None):
+        """Returns up to max_records undelivered samples and the position after them
+
+        Reading starts at the cursor, or at a position returned by an earlier
+        read that the cursor has not passed. The position after each sample
+        is appended to the positions list, if given.
+        """
+        segment, offset = max(position or self._cursor, self._cursor)
+        samples = []
+        while len(samples) < max_records and segment in self._sizes:
+            if offset >= self._sizes[segment]:
+                later = [n for n in self._segments if n > segment]
+                if not later:
+                    break
+                segment, offset = later[0], 0
+                continue
+            size = self._sizes[segment]
+            with open(self._segment_path(segment), 'rb') as f:
+                f.seek(offset)
+                while len(samples) < max_records and offset + _HEADER.size <= size:
+                    length, crc = _HEADER.unpack(f.read(_HEADER.size))
+                    payload = f.read(length)
+                    if len(payload) != length or zlib.crc32(payload) != crc:
+                        _log.error("Spool {}: corrupt record in segment {}, skipping the rest".format(self.path, segment))
+                        offset = size
+                        break
+                    samples.append(decode_sample(payload))
+                    offset += _HEADER.size + length
+                    if positions is not None:
+                        positions.append((segment, offset))
+            if len(samples) < max_records:
+                # Step over a truncated tail
+                offset = size
+        return samples, (segment, offset)
+
+    def commit(self, position):
+        """Marks everything before position as delivered
+
+        A position the cursor has passed, e.g. by an eviction, is ignored.
+        """
+        self._check_writable()
+        if position < self._cursor:
+            return
+        self._cursor = position
+        self._save_cursor()
+        for number in [n for n in self._segments if n < position[0]]:
+            self._segments.remove(number)
+            del self._sizes[number]
+            os.remove(self._segment_path(number))
+
+    def pending_bytes(self, position=None):
+        """Bytes of undelivered samples, or of those after position"""
+        segment, offset = position or self._cursor
+        return sum(size for n, size in self._sizes.items() if n >= segment) - offset
+
+    def pending(self, position=None):
+        """True if there are undelivered samples, or samples after position"""
+        return self.pending_bytes(position) > 0
+
+    def close(self):
+        if self._writer is not None:
+            self.sync()
+            self._writer.close()
+            self._writer = None
+
+
+#-----------------
+# Exported symbols
+#-----------------
+__all__ = ["Spool", "EVICTION_POLICIES", "encode_sample", "decode_sample"]
@@ -53,5 +53,8 @@ setup(
         'pymodbus', 'influxdb', 'paho-mqtt', 'pyserial >= 2.6', 'pycryptodome',
         'SungrowModbusTcpClient', 'Astral'
     ],
+    extras_require={
+        'analytics': ['numpy'],
+    },
     platforms=['Linux', 'Mac OS X', 'Win'],
 )
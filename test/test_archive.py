@@ -0,0 +1,125 @@
+#!/usr/bin/env python
+
+# Copyright 2018 Paul Archer
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import math
+import os
+import struct
+from datetime import datetime, timezone
+
+import pytest
+
+from pvstats.archive import ArchiveWriter, ArchiveReader, encode_times, decode_times, encode_values, decode_values
+
+# 2024-06-01 23:00 UTC, an hour before a partition boundary
+EVENING = int(datetime(2024, 6, 1, 23, 0, tzinfo=timezone.utc).timestamp())
+
+
+def _bits(values):
+    return [struct.pack('<d', v) for v in values]
+
+
+def _times_round_trip(times):
+    assert decode_times(encode_times(times), len(times)) == times
+
+
+@pytest.mark.parametrize('dod', [0, 1, -1, 63, 64, -63, 65, -64, 255, 256, -255, 257, -256,
+                                 2047, 2048, -2047, 2049, -2048, 10**6, -10**6])
+def test_times_dod_buckets(dod):
+    start = EVENING * 1000
+    _times_round_trip([start, start + 10000, start + 20000 + dod, start + 30000 + dod, start + 40000])
+
+
+def test_times_large_jumps():
+    start = EVENING * 1000
+    _times_round_trip([start, start + 2**40, start + 2**40 + 1, start - 2**40, start])
+    _times_round_trip([-5, 0, 2**40, -2**40, 3])
+
+
+def test_times_single_and_regular():
+    _times_round_trip([EVENING * 1000])
+    times = [EVENING * 1000 + 10000 * i for i in range(500)]
+    _times_round_trip(times)
+    # Past the first delta a steady cadence costs one bit per sample
+    assert len(encode_times(times)) <= 8 + 9 + 500 // 8 + 1
+
+
+@pytest.mark.parametrize('values', [
+    [1.0],
+    [230.5] * 20,
+    [0.0, -0.0, 1.0, -1.0, 5e-324, -5e-324, 2.2250738585072014e-308, 1.7976931348623157e308],
+    [float('nan'), 1.0, float('nan'), float('inf'), float('-inf'), 0.0],
+    [i * 0.1 for i in range(200)],
+    [1.0, 2.0**-1074, 1.0, 2.0**1023, 3.0],
+])
+def test_values_round_trip(values):
+    decoded = decode_values(encode_values(values), len(values))
+    assert _bits(decoded) == _bits(values)
+
+
+def _write(path, start, count, step=10, chunk_seconds=3600):
+    writer = ArchiveWriter(path, chunk_seconds)
+    for i in range(count):
+        sample = {'power': float(i), 'temperature': 20.0 + i % 7}
+        if i % 5 == 0:
+            del sample['temperature']
+        if i >= count // 2:
+            sample['voltage'] = 230.0
+        writer.append(start + i * step, sample)
+    writer.close()
+
+
+def test_read_across_a_day_boundary(tmp_path):
+    path = str(tmp_path / 'inverter')
+    # 23:00 to 01:00 UTC, two partitions
+    _write(path, EVENING, 720)
+    reader = ArchiveReader(path)
+    assert reader.partitions() == ['2024-06-01', '2024-06-02']
+
+    times, columns = reader.read(EVENING + 1800, EVENING + 5400)
+    assert list(times) == [EVENING + 1800 + 10 * i for i in range(360)]
+    assert list(columns['power']) == [180.0 + i for i in range(360)]
+    # Missing values and fields that appear later read as NaN
+    assert math.isnan(columns['temperature'][0])
+    assert columns['temperature'][1] == 20.0 + 181 % 7
+    assert math.isnan(columns['voltage'][0])
+    assert columns['voltage'][-1] == 230.0
+
+    times, columns = reader.read(EVENING + 3590, EVENING + 3610, fields=['power'])
+    assert list(times) == [EVENING + 3590, EVENING + 3600]
+    assert list(columns) == ['power']
+
+
+def test_torn_index_record_is_ignored(tmp_path):
+    path = str(tmp_path / 'inverter')
+    _write(path, EVENING, 100)
+    index = os.path.join(path, '2024-06-01.idx')
+    with open(index, 'ab') as f:
+        f.write(b'\x01\x02\x03')
+    times, _ = ArchiveReader(path).read()
+    assert len(times) == 100
+
+
+def test_corrupt_chunk_is_skipped(tmp_path):
+    path = str(tmp_path / 'inverter')
+    _write(path, EVENING - 3600, 720)
+    # Damage the first of the two chunks of 2024-06-01
+    with open(os.path.join(path, '2024-06-01.dat'), 'r+b') as f:
+        f.seek(20)
+        byte = f.read(1)
+        f.seek(20)
+        f.write(bytes([byte[0] ^ 0xff]))
+    times, _ = ArchiveReader(path).read()
+    assert list(times) == [EVENING + 10 * i for i in range(360)]
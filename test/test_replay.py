@@ -0,0 +1,60 @@
+#!/usr/bin/env python
+
+# Copyright 2018 Paul Archer
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from datetime import datetime, timedelta
+
+from pvstats.pvinverter.capture import CaptureWriter
+from pvstats.pvinverter.planner import plan_reads
+from pvstats.pvinverter.replay import PVInverter_Replay
+from pvstats.pvinverter.simulator import RegisterModel
+from pvstats.pvinverter import sungrow_sg_ktl
+
+START = datetime(2024, 6, 1, 12, 0, 0).timestamp()
+
+
+def _capture(path, times):
+    model = RegisterModel(sungrow_sg_ktl._register_map, word_order=sungrow_sg_ktl.PVInverter_SunGrow.word_order,
+                          seed=1)
+    plan = plan_reads(model.register_map)
+    writer = CaptureWriter(path, {'model': 'sungrow-sg-ktl'})
+    for t in times:
+        writer.write(t, [(func, address, model.words(func, address, count, t)) for func, address, count in plan])
+    writer.close()
+
+
+def _replay(path, reads, **cfg):
+    inverter = PVInverter_Replay(dict(cfg, file=path, speed=0))
+    inverter.connect()
+    stamps = []
+    for _ in range(reads):
+        inverter.read()
+        stamps.append(inverter.registers['timestamp'])
+    return stamps
+
+
+def test_replay_decodes_recorded_times(tmp_path):
+    path = str(tmp_path / 'day.pvcap')
+    _capture(path, [START, START + 10])
+    assert _replay(path, 2) == [datetime.fromtimestamp(START), datetime.fromtimestamp(START + 10)]
+
+
+def test_looped_replay_keeps_time_increasing(tmp_path):
+    path = str(tmp_path / 'day.pvcap')
+    _capture(path, [START, START + 10])
+    stamps = _replay(path, 6, loop=True)
+    assert all(b > a for a, b in zip(stamps, stamps[1:]))
+    # Each pass follows one cycle after the previous one
+    assert stamps == [datetime.fromtimestamp(START) + timedelta(seconds=10 * i) for i in range(6)]
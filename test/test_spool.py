@@ -0,0 +1,131 @@
+#!/usr/bin/env python
+
+# Copyright 2018 Paul Archer
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+
+import pytest
+
+from pvstats.poller import build_engine
+from pvstats.spool import Spool
+
+
+def _segments(path):
+    return sorted(os.path.join(path, name) for name in os.listdir(path) if name.endswith('.seg'))
+
+
+def _fill(path, count, **kwargs):
+    spool = Spool(path, **kwargs)
+    for i in range(count):
+        assert spool.append({'timestamp': 1000 + i, 'value': i})
+    spool.close()
+
+
+def test_torn_record_is_truncated(tmp_path):
+    path = str(tmp_path / 'spool')
+    _fill(path, 3)
+    segment = _segments(path)[-1]
+    good = os.path.getsize(segment)
+    # A header promising more payload than was written
+    with open(segment, 'ab') as f:
+        f.write(b'\x00\x00\x00\x40\x12\x34\x56\x78{"timest')
+
+    spool = Spool(path)
+    assert os.path.getsize(segment) == good
+    samples, _ = spool.read(10)
+    assert [s['value'] for s in samples] == [0, 1, 2]
+
+    # Appends carry on after the good records
+    spool.append({'timestamp': 2000, 'value': 3})
+    samples, _ = spool.read(10)
+    assert [s['value'] for s in samples] == [0, 1, 2, 3]
+    spool.close()
+
+
+def test_partial_header_is_truncated(tmp_path):
+    path = str(tmp_path / 'spool')
+    _fill(path, 2)
+    segment = _segments(path)[-1]
+    good = os.path.getsize(segment)
+    with open(segment, 'ab') as f:
+        f.write(b'\x00\x00')
+
+    spool = Spool(path)
+    assert os.path.getsize(segment) == good
+    assert [s['value'] for s in spool.read(10)[0]] == [0, 1]
+    spool.close()
+
+
+def test_commit_survives_reopen(tmp_path):
+    path = str(tmp_path / 'spool')
+    _fill(path, 5)
+
+    spool = Spool(path)
+    positions = []
+    samples, _ = spool.read(2, positions=positions)
+    assert [s['value'] for s in samples] == [0, 1]
+    spool.commit(positions[-1])
+    spool.close()
+
+    spool = Spool(path)
+    samples, position = spool.read(10)
+    assert [s['value'] for s in samples] == [2, 3, 4]
+    spool.commit(position)
+    assert not spool.pending()
+    spool.close()
+
+    assert not Spool(path).pending()
+
+
+def test_commit_deletes_delivered_segments(tmp_path):
+    path = str(tmp_path / 'spool')
+    _fill(path, 20, segment_bytes=100)
+    assert len(_segments(path)) > 2
+
+    spool = Spool(path, segment_bytes=100)
+    samples, position = spool.read(15)
+    spool.commit(position)
+    spool.close()
+    assert len(_segments(path)) < 6
+
+    spool = Spool(path, segment_bytes=100)
+    assert [s['value'] for s in spool.read(10)[0]] == list(range(15, 20))
+    spool.close()
+
+
+def test_readonly_leaves_torn_record(tmp_path):
+    path = str(tmp_path / 'spool')
+    _fill(path, 2)
+    segment = _segments(path)[-1]
+    with open(segment, 'ab') as f:
+        f.write(b'\x00\x00')
+    size = os.path.getsize(segment)
+
+    spool = Spool(path, readonly=True)
+    assert [s['value'] for s in spool.read(10)[0]] == [0, 1]
+    with pytest.raises(IOError):
+        spool.append({'timestamp': 0})
+    assert os.path.getsize(segment) == size
+
+    with pytest.raises(FileNotFoundError):
+        Spool(str(tmp_path / 'missing'), readonly=True)
+
+
+def test_spooled_reports_need_unique_names(tmp_path):
+    spool = str(tmp_path / 'spool')
+    cfg = {'inverters': [], 'sample_period': 10,
+           'reports': [{'type': 'test', 'spool': spool}, {'type': 'test', 'spool': spool}]}
+    with pytest.raises(ValueError):
+        build_engine(cfg)